@@ -0,0 +1,3 @@
+"""
+Benchmarks y corpus de referencia para medir las optimizaciones del backend.
+"""
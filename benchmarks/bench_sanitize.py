@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark del detector de prompt injection.
+
+Compara la implementación original (un re.search por patrón) con la alternancia compilada
+y con la validación por lotes que usa /api/chat para el historial.
+
+Uso:
+    python -m benchmarks.bench_sanitize [--iterations 20]
+"""
+import argparse
+import logging
+import os
+import time
+
+os.environ.setdefault("GEMINI_API_KEY", "benchmark_key")
+
+from services.gemini_service import sanitize_input, sanitize_fields
+from benchmarks.sanitize_corpus import legacy_sanitize_input, regression_corpus
+
+
+def _measure(label: str, func, iterations: int, items: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    elapsed = time.perf_counter() - start
+    per_item_us = elapsed / (iterations * items) * 1_000_000
+    print(f"   {label:<28} {elapsed * 1000:9.1f} ms  ({per_item_us:6.2f} µs/texto)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del detector de prompt injection")
+    parser.add_argument("--iterations", type=int, default=20, help="Repeticiones del corpus completo")
+    args = parser.parse_args()
+
+    # Los textos maliciosos del corpus generarían miles de warnings
+    logging.disable(logging.WARNING)
+
+    corpus = regression_corpus()
+    fields = [(text, 500) for text in corpus]
+    print(f"📊 Corpus: {len(corpus)} textos × {args.iterations} iteraciones")
+
+    legacy = _measure(
+        "Original (re.search × N)",
+        lambda: [legacy_sanitize_input(text) for text in corpus],
+        args.iterations, len(corpus)
+    )
+    compiled = _measure(
+        "Compilado (sanitize_input)",
+        lambda: [sanitize_input(text) for text in corpus],
+        args.iterations, len(corpus)
+    )
+    batch = _measure(
+        "Lotes (sanitize_fields)",
+        lambda: sanitize_fields(fields),
+        args.iterations, len(corpus)
+    )
+
+    print(f"\n⚡ Compilado: {legacy / compiled:.1f}x más rápido que el original")
+    print(f"⚡ Lotes:     {legacy / batch:.1f}x más rápido que el original")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Dobles locales de los servicios externos para pruebas de carga sin red ni API keys.
+
+- Gemini: modelo falso con la interfaz de genai.GenerativeModel (generate_content normal y
+  en streaming) que duerme en el hilo del executor como lo haría la llamada real.
+- WeatherAPI y Unsplash: httpx.MockTransport que responde con el JSON de cada API.
+- Firebase: reemplazo de auth.verify_id_token que acepta cualquier token.
+
+Cada doble tiene una distribución de latencia y una tasa de error configurables.
+"""
+import asyncio
+import random
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+import httpx
+from google.api_core import exceptions as google_exceptions
+
+# Plan de ejemplo con las secciones que produce el prompt real
+FAKE_PLAN_SECTIONS = [
+    "¡Prepárate para un viaje inolvidable!\n\n",
+    "## 🏨 ALOJAMIENTO\n- **Hotel Centro** - Opción económica y céntrica.\n\n",
+    "## 🥘 GASTRONOMÍA\n- **Plato típico** - Imperdible en el mercado local.\n\n",
+    "## 💎 LUGARES\n- **Casco histórico** - Recorrido a pie de medio día.\n\n",
+    "## 💡 CONSEJOS\n- Llevar efectivo para los mercados.\n\n",
+    "## 💰 COSTOS\n- Alojamiento: 40-60 USD por noche.\n"
+]
+FAKE_PLAN = "".join(FAKE_PLAN_SECTIONS)
+
+
+class LatencyDistribution:
+    """
+    Distribución de latencias (en segundos) definida con una especificación de texto.
+
+    Formatos:
+        "fixed:0.5"            siempre 0.5 s
+        "uniform:0.2,0.8"      uniforme entre 0.2 y 0.8 s
+        "normal:1.0,0.2"       normal con media 1.0 y desviación 0.2 (nunca negativa)
+        "lognormal:2.0,0.5"    log-normal con mediana 2.0 y sigma 0.5 (cola larga, como Gemini)
+        "0.5"                  equivalente a "fixed:0.5"
+    """
+
+    def __init__(self, spec: str, rng: Optional[random.Random] = None):
+        self.spec = spec
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+        kind, _, params = spec.partition(":")
+        if not params:
+            kind, params = "fixed", kind
+        self.kind = kind.strip().lower()
+        self.params = [float(value) for value in params.split(",")]
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if self.kind not in expected or len(self.params) != expected[self.kind]:
+            raise ValueError(f"Distribución de latencia inválida: '{spec}'")
+
+    def sample(self) -> float:
+        # random.Random no es thread-safe para reproducibilidad: los dobles se usan desde hilos
+        with self._lock:
+            if self.kind == "fixed":
+                return self.params[0]
+            if self.kind == "uniform":
+                return self._rng.uniform(*self.params)
+            if self.kind == "normal":
+                return max(0.0, self._rng.gauss(*self.params))
+            median, sigma = self.params
+            return self._rng.lognormvariate(0.0, sigma) * median
+
+    def chance(self, probability: float) -> bool:
+        """True con la probabilidad dada (usa el mismo generador, reproducible con semilla)."""
+        if probability <= 0:
+            return False
+        with self._lock:
+            return self._rng.random() < probability
+
+
+class StandIn:
+    """Configuración y contadores de un doble: latencia, tasa de error y llamadas atendidas."""
+
+    def __init__(self, name: str, latency: str, error_rate: float = 0.0, seed: Optional[int] = None):
+        self.name = name
+        self.latency = LatencyDistribution(latency, random.Random(seed))
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def next_call(self) -> tuple:
+        """Registra una llamada y devuelve (latencia, debe_fallar)."""
+        delay = self.latency.sample()
+        fail = self.latency.chance(self.error_rate)
+        with self._lock:
+            self.calls += 1
+            if fail:
+                self.errors += 1
+        return delay, fail
+
+    def stats(self) -> Dict:
+        return {
+            "latency": self.latency.spec,
+            "error_rate": self.error_rate,
+            "calls": self.calls,
+            "errors": self.errors
+        }
+
+
+class _FakeFinishReason:
+    name = "STOP"
+
+
+class _FakeCandidate:
+    finish_reason = _FakeFinishReason()
+
+
+class _FakeChunk:
+    def __init__(self, text: str):
+        self.text = text
+        self.candidates = [_FakeCandidate()]
+
+
+class FakeGeminiResponse:
+    """Respuesta con la forma de la del SDK: .text, .candidates y iterable en streaming."""
+
+    def __init__(self, parts: List[str], chunk_delay: float = 0.0):
+        self._parts = parts
+        self._chunk_delay = chunk_delay
+        self.text = "".join(parts)
+        self.candidates = [_FakeCandidate()]
+
+    def __iter__(self) -> Iterator[_FakeChunk]:
+        for part in self._parts:
+            if self._chunk_delay:
+                time.sleep(self._chunk_delay)
+            yield _FakeChunk(part)
+
+
+class FakeGeminiModel:
+    """
+    Reemplazo de genai.GenerativeModel.
+
+    La latencia se duerme de forma bloqueante (la llamada real bloquea el hilo del executor);
+    en streaming se reparte entre los fragmentos. Los errores se lanzan como los del SDK
+    (429 TooManyRequests) para que el límite adaptativo reaccione igual que en producción.
+    """
+
+    def __init__(self, stand_in: StandIn, parts: Optional[List[str]] = None):
+        self.stand_in = stand_in
+        self.parts = parts or FAKE_PLAN_SECTIONS
+
+    def generate_content(self, prompt, stream: bool = False, **kwargs) -> FakeGeminiResponse:
+        delay, fail = self.stand_in.next_call()
+        if fail:
+            time.sleep(delay)
+            raise google_exceptions.TooManyRequests("Resource has been exhausted (fake)")
+        if stream:
+            # La latencia se reparte entre los fragmentos
+            return FakeGeminiResponse(self.parts, chunk_delay=delay / len(self.parts))
+        time.sleep(delay)
+        return FakeGeminiResponse(self.parts)
+
+
+def weather_payload(destination: str) -> Dict:
+    """JSON con la forma de la respuesta de WeatherAPI.com /v1/current.json."""
+    return {
+        "location": {"name": destination, "localtime": "2024-06-15 14:30"},
+        "current": {"temp_c": 24.0, "feelslike_c": 26.0, "condition": {"text": "Soleado"}}
+    }
+
+
+def unsplash_payload(query: str, count: int) -> Dict:
+    """JSON con la forma de la respuesta de Unsplash /search/photos."""
+    slug = query.replace(" ", "-")
+    return {
+        "results": [
+            {"urls": {"regular": f"https://images.unsplash.com/fake-{slug}-{i}"}}
+            for i in range(count)
+        ]
+    }
+
+
+def create_mock_transport(weather: StandIn, unsplash: StandIn) -> httpx.MockTransport:
+    """
+    Transporte httpx que atiende WeatherAPI y Unsplash sin red.
+
+    La latencia se espera con asyncio.sleep (las llamadas reales no bloquean el event loop);
+    los errores se responden como 503.
+    """
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if "weatherapi" in request.url.host:
+            stand_in = weather
+        elif "unsplash" in request.url.host:
+            stand_in = unsplash
+        else:
+            return httpx.Response(404, json={"error": "host desconocido"})
+
+        delay, fail = stand_in.next_call()
+        await asyncio.sleep(delay)
+        if fail:
+            return httpx.Response(503, json={"error": "fake upstream error"})
+
+        params = request.url.params
+        if stand_in is weather:
+            return httpx.Response(200, json=weather_payload(params.get("q", "")))
+        return httpx.Response(200, json=unsplash_payload(params.get("query", ""), int(params.get("per_page", "8"))))
+
+    return httpx.MockTransport(handler)
+
+
+def create_fake_verify_id_token(stand_in: StandIn):
+    """
+    Reemplazo de firebase_admin.auth.verify_id_token.
+
+    Acepta cualquier token y usa el propio token como uid (un token por usuario virtual);
+    los errores se lanzan como token inválido.
+    """
+
+    def verify_id_token(token: str, *args, **kwargs) -> Dict:
+        delay, fail = stand_in.next_call()
+        time.sleep(delay)
+        if fail:
+            raise ValueError("Token inválido (fake)")
+        return {"uid": token, "exp": time.time() + 3600}
+
+    return verify_id_token
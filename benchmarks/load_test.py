@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga de extremo a extremo del backend, sin red ni API keys.
+
+Levanta la app FastAPI en el mismo proceso con dobles locales de Gemini, WeatherAPI,
+Unsplash y Firebase (ver benchmarks/fakes.py), lanza /api/plan, /api/chat y
+/api/plan/stream con una concurrencia objetivo y reporta RPS, percentiles de latencia y
+tasas de error en JSON. Con la misma semilla y los mismos parámetros la carga generada es
+la misma, para comparar el antes y el después de cada cambio de rendimiento.
+
+Uso:
+    python -m benchmarks.load_test --concurrency 20 --requests 300
+    python -m benchmarks.load_test --mix plan=0.5,chat=0.4,stream=0.1 \\
+        --gemini-latency lognormal:2.0,0.5 --gemini-error-rate 0.02 --output reporte.json
+    python -m benchmarks.load_test --transport http   # a través de uvicorn en localhost
+
+El reporte JSON se imprime en stdout (o se guarda con --output); el resumen legible va a stderr.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from benchmarks.fakes import (
+    StandIn,
+    FakeGeminiModel,
+    create_mock_transport,
+    create_fake_verify_id_token
+)
+
+DESTINATIONS = [
+    "Cartagena", "Lima", "Cusco", "Buenos Aires", "Ciudad de México", "Madrid", "Barcelona",
+    "París", "Roma", "Lisboa", "Tokio", "Kioto", "Bangkok", "Nueva York", "Montreal",
+    "Santiago", "Quito", "Medellín", "La Habana", "Oaxaca", "Marrakech", "Estambul",
+    "Atenas", "Praga", "Viena", "Berlín", "Ámsterdam", "Londres", "Dublín", "Sídney"
+]
+STYLES = ["aventura", "relajación", "cultural", "gastronómico"]
+BUDGETS = ["económico", "moderado", "lujo"]
+CHAT_MESSAGES = [
+    "¿Qué me recomiendas para cenar cerca del centro?",
+    "¿Cuál es el mejor barrio para alojarme?",
+    "¿Necesito reservar con anticipación los museos?",
+    "¿Cómo me muevo del aeropuerto al hotel?"
+]
+
+ENDPOINTS = {
+    "plan": "/api/plan",
+    "chat": "/api/chat",
+    "stream": "/api/plan/stream"
+}
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Percentil q (0-100) con interpolación lineal sobre valores ya ordenados."""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    """p50/p95/p99, media y máximo en milisegundos."""
+    values = sorted(latencies)
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0, "max": 0.0}
+    return {
+        "p50": round(percentile(values, 50) * 1000, 1),
+        "p95": round(percentile(values, 95) * 1000, 1),
+        "p99": round(percentile(values, 99) * 1000, 1),
+        "mean": round(sum(values) / len(values) * 1000, 1),
+        "max": round(values[-1] * 1000, 1)
+    }
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """Convierte "plan=0.7,chat=0.3" en pesos normalizados por endpoint."""
+    weights = {}
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"Endpoint desconocido en --mix: '{name}' (usa {', '.join(ENDPOINTS)})")
+        weights[name] = float(weight or 1)
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("--mix debe tener al menos un peso positivo")
+    return {name: weight / total for name, weight in weights.items()}
+
+
+def configure_environment(workdir: str, args) -> None:
+    """
+    Variables de entorno de la app para la prueba (antes de importar main).
+
+    Cachés y estadísticas van a un directorio temporal para que cada corrida empiece en frío.
+    """
+    os.environ["GEMINI_API_KEY"] = "loadtest"
+    os.environ["WEATHER_API_KEY"] = "loadtest"
+    os.environ["UNSPLASH_ACCESS_KEY"] = "loadtest"
+    os.environ["CACHE_DIR"] = workdir
+    os.environ["STATS_FILE"] = os.path.join(workdir, "stats.json")
+    os.environ["STATS_DB_PATH"] = os.path.join(workdir, "stats.sqlite3")
+    os.environ["AUTH_CERT_REFRESH_SECONDS"] = "0"
+    if args.no_plan_cache:
+        os.environ["PLAN_CACHE_TTL_SECONDS"] = "0"
+
+
+class Workload:
+    """Genera las solicitudes de la prueba de forma reproducible a partir de una semilla."""
+
+    def __init__(self, mix: Dict[str, float], destinations: int, seed: int):
+        self._rng = random.Random(seed)
+        self._names = list(mix)
+        self._weights = [mix[name] for name in self._names]
+        self._destinations = DESTINATIONS[:max(1, min(destinations, len(DESTINATIONS)))]
+
+    def next_request(self) -> Tuple[str, Dict]:
+        endpoint = self._rng.choices(self._names, weights=self._weights)[0]
+        body = {
+            "destination": self._rng.choice(self._destinations),
+            "date": self._rng.choice(["junio", "diciembre", "semana santa"]),
+            "budget": self._rng.choice(BUDGETS),
+            "style": self._rng.choice(STYLES)
+        }
+        if endpoint == "chat":
+            body["message"] = self._rng.choice(CHAT_MESSAGES)
+            body["history"] = [
+                {"role": "user", "parts": f"Quiero viajar a {body['destination']}"},
+                {"role": "model", "parts": "¡Excelente elección! Aquí tienes un plan..."}
+            ]
+        return endpoint, body
+
+
+async def run_load(client: httpx.AsyncClient, args, workload: Workload) -> Tuple[Dict[str, list], float]:
+    """
+    Lanza la carga en lazo cerrado: `concurrency` usuarios virtuales, cada uno con su propio
+    token, envían una solicitud tras otra hasta completar --requests o --duration.
+
+    Returns:
+        Tuple[Dict[str, list], float]: (resultados por endpoint, segundos transcurridos)
+    """
+    results: Dict[str, list] = {name: [] for name in ENDPOINTS}
+    remaining = {"count": args.requests}
+    deadline = time.perf_counter() + args.duration if args.duration else None
+
+    async def virtual_user(user_id: int):
+        headers = {"Authorization": f"Bearer loadtest-user-{user_id}"}
+        while True:
+            if deadline is not None:
+                if time.perf_counter() >= deadline:
+                    return
+            elif remaining["count"] <= 0:
+                return
+            remaining["count"] -= 1
+            endpoint, body = workload.next_request()
+
+            start = time.perf_counter()
+            try:
+                response = await client.post(ENDPOINTS[endpoint], json=body, headers=headers)
+                await response.aread()
+                outcome = str(response.status_code)
+                if endpoint == "stream" and response.status_code == 200 and "event: error" in response.text:
+                    outcome = "stream_error"
+            except Exception as e:
+                outcome = type(e).__name__
+            results[endpoint].append((time.perf_counter() - start, outcome))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(virtual_user(i) for i in range(args.concurrency)))
+    return results, time.perf_counter() - start
+
+
+def build_report(args, results: Dict[str, list], elapsed: float, stand_ins: List[StandIn], server: Dict) -> Dict:
+    """Arma el reporte JSON: totales, percentiles y errores por endpoint."""
+    all_latencies = []
+    all_errors = 0
+    endpoints = {}
+    for name, samples in results.items():
+        if not samples:
+            continue
+        latencies = [latency for latency, _ in samples]
+        outcomes = Counter(outcome for _, outcome in samples)
+        errors = sum(count for outcome, count in outcomes.items() if outcome != "200")
+        endpoints[name] = {
+            "requests": len(samples),
+            "rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+            "errors": errors,
+            "error_rate": round(errors / len(samples), 4),
+            "latency_ms": latency_summary(latencies),
+            "outcomes": dict(sorted(outcomes.items()))
+        }
+        all_latencies.extend(latencies)
+        all_errors += errors
+
+    total = len(all_latencies)
+    return {
+        "config": {
+            "transport": args.transport,
+            "concurrency": args.concurrency,
+            "requests": args.requests if not args.duration else None,
+            "duration_s": args.duration or None,
+            "mix": args.mix,
+            "destinations": args.destinations,
+            "plan_cache": not args.no_plan_cache,
+            "rate_limit": args.rate_limit,
+            "seed": args.seed
+        },
+        "elapsed_s": round(elapsed, 3),
+        "requests": total,
+        "rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "errors": all_errors,
+        "error_rate": round(all_errors / total, 4) if total else 0.0,
+        "latency_ms": latency_summary(all_latencies),
+        "endpoints": endpoints,
+        "stand_ins": {stand_in.name: stand_in.stats() for stand_in in stand_ins},
+        "server": server
+    }
+
+
+def print_summary(report: Dict) -> None:
+    out = sys.stderr
+    latency = report["latency_ms"]
+    print(f"\n📊 {report['requests']} solicitudes en {report['elapsed_s']:.1f}s "
+          f"({report['rps']:.1f} RPS, concurrencia {report['config']['concurrency']})", file=out)
+    print(f"   Latencia total: p50={latency['p50']:.0f}ms p95={latency['p95']:.0f}ms p99={latency['p99']:.0f}ms", file=out)
+    print(f"   Errores: {report['errors']} ({report['error_rate'] * 100:.1f}%)", file=out)
+    for name, stats in report["endpoints"].items():
+        latency = stats["latency_ms"]
+        print(f"   {name:<7} {stats['requests']:>5} sol. {stats['rps']:>7.1f} RPS  "
+              f"p50={latency['p50']:>7.0f}ms p95={latency['p95']:>7.0f}ms p99={latency['p99']:>7.0f}ms  "
+              f"errores={stats['error_rate'] * 100:.1f}%  {stats['outcomes']}", file=out)
+
+
+async def _serve_uvicorn(app, port: int):
+    """Arranca uvicorn en este mismo event loop (los dobles viven en este proceso)."""
+    import uvicorn
+
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on")
+    server = uvicorn.Server(config)
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+async def main_async(args) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="viajeia-loadtest-")
+    configure_environment(workdir, args)
+
+    gemini = StandIn("gemini", args.gemini_latency, args.gemini_error_rate, seed=args.seed + 1)
+    weather = StandIn("weatherapi", args.weather_latency, args.weather_error_rate, seed=args.seed + 2)
+    unsplash = StandIn("unsplash", args.unsplash_latency, args.unsplash_error_rate, seed=args.seed + 3)
+    firebase = StandIn("firebase", args.firebase_latency, args.firebase_error_rate, seed=args.seed + 4)
+
+    # Importar la app solo después de configurar el entorno
+    import main
+    from firebase_admin import auth
+
+    auth.verify_id_token = create_fake_verify_id_token(firebase)
+    main.FIREBASE_INITIALIZED = True
+    main.limiter.enabled = args.rate_limit
+
+    gemini_service = main.get_gemini_service()
+    fake_model = FakeGeminiModel(gemini)
+    gemini_service.model = fake_model
+    # Con un SDK que soporta system_instruction, cada variante usa el doble sin caché de contexto
+    gemini_service.instruction_models = {variant: fake_model for variant in gemini_service.instruction_models}
+    gemini_service.context_cache_enabled = False
+    transport = create_mock_transport(weather, unsplash)
+    # Los servicios reutilizan el cliente ya asignado en lugar de crear uno en el lifespan
+    main.get_weather_service().client = httpx.AsyncClient(transport=transport)
+    main.get_unsplash_service().client = httpx.AsyncClient(transport=transport)
+
+    workload = Workload(parse_mix(args.mix), args.destinations, args.seed)
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    if args.transport == "http":
+        server, server_task = await _serve_uvicorn(main.app, args.port)
+        try:
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=timeout, limits=limits) as client:
+                results, elapsed = await run_load(client, args, workload)
+        finally:
+            server.should_exit = True
+            await server_task
+    else:
+        async with main.lifespan(main.app):
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=main.app),
+                base_url="http://loadtest",
+                timeout=timeout
+            ) as client:
+                results, elapsed = await run_load(client, args, workload)
+
+    server_stats = {
+        "gemini_concurrency": gemini_service.concurrency_stats(),
+        "plan_cache": gemini_service.plan_cache.stats(),
+        "weather_cache": main.get_weather_service().cache_stats(),
+        "image_cache": main.get_unsplash_service().cache_stats(),
+        "plan_dedup": main.plan_singleflight.stats()
+    }
+    return build_report(args, results, elapsed, [gemini, weather, unsplash, firebase], server_stats)
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Prueba de carga del backend con dobles locales")
+    parser.add_argument("--concurrency", type=int, default=10, help="Usuarios virtuales simultáneos")
+    parser.add_argument("--requests", type=int, default=200, help="Solicitudes totales (ignorado con --duration)")
+    parser.add_argument("--duration", type=float, default=0, help="Segundos de carga (en lugar de --requests)")
+    parser.add_argument("--mix", default="plan=0.6,chat=0.3,stream=0.1", help="Pesos por endpoint: plan, chat, stream")
+    parser.add_argument("--destinations", type=int, default=len(DESTINATIONS), help="Destinos distintos (menos = más aciertos de caché)")
+    parser.add_argument("--no-plan-cache", action="store_true", help="Desactiva la caché de planes (PLAN_CACHE_TTL_SECONDS=0)")
+    parser.add_argument("--rate-limit", action="store_true", help="Mantiene el rate limiting por usuario activo")
+    parser.add_argument("--transport", choices=["asgi", "http"], default="asgi",
+                        help="asgi: en proceso sin sockets; http: uvicorn en localhost")
+    parser.add_argument("--port", type=int, default=8765, help="Puerto de uvicorn con --transport http")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Timeout por solicitud del cliente")
+    parser.add_argument("--seed", type=int, default=42, help="Semilla de la carga y de los dobles")
+    parser.add_argument("--gemini-latency", default="lognormal:1.0,0.4", help="Distribución de latencia de Gemini")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0, help="Fracción de llamadas a Gemini que fallan con 429")
+    parser.add_argument("--weather-latency", default="lognormal:0.08,0.3")
+    parser.add_argument("--weather-error-rate", type=float, default=0.0)
+    parser.add_argument("--unsplash-latency", default="lognormal:0.12,0.3")
+    parser.add_argument("--unsplash-error-rate", type=float, default=0.0)
+    parser.add_argument("--firebase-latency", default="fixed:0.01")
+    parser.add_argument("--firebase-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="Archivo donde guardar el reporte JSON (por defecto, stdout)")
+    parser.add_argument("--verbose", action="store_true", help="Mantiene los logs de la app")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if not args.verbose:
+        # La app registra varias líneas por solicitud: a esta escala el logging domina la medición
+        logging.disable(logging.CRITICAL)
+
+    report = asyncio.run(main_async(args))
+    print_summary(report)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"\n💾 Reporte guardado en {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
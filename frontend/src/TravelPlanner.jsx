@@ -59,6 +59,7 @@ const TravelPlanner = () => {
   
   const {
     travelData,
+    updatePlanText,
     loading,
     error,
     chatInitialMessage,
@@ -160,6 +161,7 @@ const TravelPlanner = () => {
               user={user}
               API_URL={API_URL}
               initialMessage={chatInitialMessage}
+              onPlanUpdate={updatePlanText}
             />
           )}
 
@@ -7,8 +7,18 @@ import React, { useState, useEffect, useRef, useCallback, memo } from 'react';
 import ReactMarkdown from 'react-markdown';
 import { Loader2, Send, MessageCircle, User, Bot } from 'lucide-react';
 import { toast } from 'sonner';
+import { fetchWithRetry, newIdempotencyKey } from './utils/request';
 
-const ChatWithAlex = memo(({ travelData, formData, user, API_URL, initialMessage }) => {
+// Nombres de las secciones del plan que el backend puede regenerar por separado
+const SECTION_LABELS = {
+  alojamiento: 'Alojamiento',
+  gastronomia: 'Gastronomía',
+  lugares: 'Lugares',
+  consejos: 'Consejos',
+  costos: 'Costos'
+};
+
+const ChatWithAlex = memo(({ travelData, formData, user, API_URL, initialMessage, onPlanUpdate }) => {
   // Estado del chat completamente aislado - NO causa re-renders del padre
   const [chatHistory, setChatHistory] = useState([]);
   const [chatMessage, setChatMessage] = useState('');
@@ -16,6 +26,8 @@ const ChatWithAlex = memo(({ travelData, formData, user, API_URL, initialMessage
   const messagesEndRef = useRef(null);
   const chatContainerRef = useRef(null);
   const hasInitializedRef = useRef(false);
+  // Sesión del servidor: guarda el historial, así solo se envía el mensaje nuevo
+  const sessionIdRef = useRef(null);
 
   // Inicializar el chat con el mensaje inicial (solo una vez)
   useEffect(() => {
@@ -86,9 +98,10 @@ const ChatWithAlex = memo(({ travelData, formData, user, API_URL, initialMessage
         'Authorization': authHeader, // Always include since we verified user exists
       };
       
-      const apiResponse = await fetch(`${API_URL}/api/chat`, {
+      // Una clave por mensaje: los reintentos de red/5xx no agregan el turno dos veces
+      const sendChat = (sessionId) => fetchWithRetry(`${API_URL}/api/chat`, {
         method: 'POST',
-        headers,
+        headers: { ...headers, 'Idempotency-Key': newIdempotencyKey() },
         body: JSON.stringify({
           destination: formData.destination.trim(),
           date: formData.date_start && formData.date_end 
@@ -97,10 +110,22 @@ const ChatWithAlex = memo(({ travelData, formData, user, API_URL, initialMessage
           budget: formData.budget || '',
           style: formData.style || '',
           message: userMessage,
-          history: chatHistory
+          // El clima y las imágenes ya se muestran con el plan: el chat no los necesita
+          skip_enrichment: true,
+          // Permite al backend encontrar el plan en caché para editarlo por secciones
+          user_currency: Intl.NumberFormat().resolvedOptions().currency || 'USD',
+          ...(sessionId ? { session_id: sessionId } : { history: chatHistory })
         }),
       });
 
+      let apiResponse = await sendChat(sessionIdRef.current);
+
+      // La sesión del servidor expiró: abrir una nueva enviando el historial completo
+      if (apiResponse.status === 404 && sessionIdRef.current) {
+        sessionIdRef.current = null;
+        apiResponse = await sendChat(null);
+      }
+
       if (apiResponse.status === 401) {
         const errorData = await apiResponse.json().catch(() => ({ detail: 'Token de autorización requerido. Por favor, inicia sesión.' }));
         const errorMsg = errorData.detail || 'Token de autorización requerido. Por favor, inicia sesión.';
@@ -116,6 +141,9 @@ const ChatWithAlex = memo(({ travelData, formData, user, API_URL, initialMessage
       }
 
       const data = await apiResponse.json();
+      if (data.session_id) {
+        sessionIdRef.current = data.session_id;
+      }
       
       if (data.finish_reason && data.finish_reason !== 'STOP') {
         toast.warning('Nota: La respuesta fue cortada por límite de longitud.', {
@@ -123,6 +151,17 @@ const ChatWithAlex = memo(({ travelData, formData, user, API_URL, initialMessage
         });
       }
       
+      // Edición del plan: se actualiza el plan de arriba y el chat solo resume el cambio
+      if (data.changed_sections?.length && onPlanUpdate) {
+        onPlanUpdate(data.gemini_response);
+        const labels = data.changed_sections.map(key => SECTION_LABELS[key] || key).join(', ');
+        setChatHistory(prev => [...prev, {
+          role: 'model',
+          parts: `✏️ ¡Hecho! Actualicé **${labels}** en tu plan. Revisa los detalles arriba. ☝️`
+        }]);
+        return;
+      }
+
       const newModelMessage = { role: 'model', parts: data.gemini_response };
       setChatHistory(prev => [...prev, newModelMessage]);
 
@@ -133,7 +172,7 @@ const ChatWithAlex = memo(({ travelData, formData, user, API_URL, initialMessage
     } finally {
       setChatLoading(false);
     }
-  }, [chatMessage, travelData, formData, user, chatHistory, API_URL]);
+  }, [chatMessage, travelData, formData, user, chatHistory, API_URL, onPlanUpdate]);
 
   // Handler para teclas - prevenir submit de form
   const handleKeyDown = useCallback((e) => {
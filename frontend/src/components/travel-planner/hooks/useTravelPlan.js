@@ -6,6 +6,7 @@ import { useState, useCallback } from 'react';
 import { toast } from 'sonner';
 import DOMPurify from 'dompurify';
 import { saveHistoryToFirebase } from '../utils/firebase';
+import { fetchWithRetry, newIdempotencyKey } from '../utils/request';
 
 const API_URL = import.meta.env.VITE_API_URL || 
                 (typeof window !== 'undefined' && window.location.hostname.includes('railway.app') 
@@ -71,9 +72,11 @@ export const useTravelPlan = (user, formData, setFormData, destinationInputRef,
       const headers = {
         'Content-Type': 'application/json',
         'Authorization': authHeader, // Always include since we verified user exists
+        // Una clave por plan pedido: los reintentos de red/5xx reciben la respuesta ya generada
+        'Idempotency-Key': newIdempotencyKey(),
       };
       
-      const apiResponse = await fetch(`${API_URL}/api/plan`, {
+      const apiResponse = await fetchWithRetry(`${API_URL}/api/plan`, {
         method: 'POST',
         headers,
         body: JSON.stringify({
@@ -152,8 +155,14 @@ export const useTravelPlan = (user, formData, setFormData, destinationInputRef,
     }
   }, [formData.date_start, formData.date_end, formData.budget, formData.style, user, setFormData, destinationInputRef, destinationValueRef]);
 
+  // Reemplaza el texto del plan (ediciones por sección desde el chat) sin volver a consultar
+  const updatePlanText = useCallback((planText) => {
+    setTravelData(prev => (prev ? { ...prev, gemini_response: planText } : prev));
+  }, []);
+
   return {
     travelData,
+    updatePlanText,
     loading,
     error,
     chatInitialMessage,
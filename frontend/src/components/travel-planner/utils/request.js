@@ -0,0 +1,54 @@
+/**
+ * request.js - Envío de solicitudes con Idempotency-Key y reintento automático
+ */
+
+// Estados que indican un fallo temporal del servidor o de un proxy intermedio
+const RETRYABLE_STATUS = new Set([502, 503, 504]);
+
+// Espera máxima entre reintentos aunque el servidor pida más (Retry-After)
+const MAX_RETRY_DELAY_MS = 10000;
+
+/**
+ * Genera una Idempotency-Key nueva. Se crea una por acción del usuario y se reutiliza en
+ * sus reintentos, para que el backend devuelva la respuesta ya generada en lugar de repetirla.
+ *
+ * @returns {string} - Clave única
+ */
+export const newIdempotencyKey = () =>
+  crypto.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+/**
+ * fetch con reintentos ante errores de red o respuestas 502/503/504.
+ *
+ * Cada reintento envía exactamente las mismas opciones (incluida la Idempotency-Key), así
+ * que si la solicitud original sí llegó al servidor el reintento recibe su respuesta.
+ *
+ * @param {string} url - URL de la solicitud
+ * @param {Object} options - Opciones de fetch (deben incluir el header Idempotency-Key)
+ * @param {Object} [config]
+ * @param {number} [config.retries=2] - Reintentos después del primer intento
+ * @param {number} [config.baseDelayMs=1000] - Espera inicial (se duplica en cada reintento)
+ * @returns {Promise<Response>} - La última respuesta (o el último error de red)
+ */
+export const fetchWithRetry = async (url, options, { retries = 2, baseDelayMs = 1000 } = {}) => {
+  for (let attempt = 0; ; attempt++) {
+    let response;
+    try {
+      response = await fetch(url, options);
+    } catch (err) {
+      // Error de red (p. ej. conexión móvil cortada): la respuesta pudo haberse generado igual
+      if (attempt >= retries || err.name !== 'TypeError') throw err;
+      await sleep(baseDelayMs * 2 ** attempt);
+      continue;
+    }
+
+    if (!RETRYABLE_STATUS.has(response.status) || attempt >= retries) {
+      return response;
+    }
+    const retryAfter = Number(response.headers.get('Retry-After'));
+    const delay = retryAfter > 0 ? retryAfter * 1000 : baseDelayMs * 2 ** attempt;
+    await sleep(Math.min(delay, MAX_RETRY_DELAY_MS));
+  }
+};
@@ -6,13 +6,17 @@ import logging
 from logging.handlers import RotatingFileHandler
 import traceback
 import asyncio
+import hashlib
 import json
-from typing import Optional, List, Dict
-from collections import Counter
-from datetime import datetime
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional, List, Dict, Set, Tuple, Type
 from fastapi import FastAPI, HTTPException, Request, Depends, Header
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from slowapi import Limiter, _rate_limit_exceeded_handler
@@ -23,18 +27,48 @@ from slowapi.errors import RateLimitExceeded
 import firebase_admin
 from firebase_admin import credentials, auth
 
-from services.gemini_service import get_gemini_service, sanitize_input
+from services.auth_service import get_token_verifier
+from services.cache import SingleFlight
+from services.concurrency import OverloadedError
+from services.gemini_service import (
+    CHARS_PER_TOKEN,
+    CHAT_HISTORY_MESSAGE_MAX_TOKENS,
+    PLAN_SECTIONS,
+    detect_plan_edit,
+    get_gemini_service,
+    plan_cache_key,
+    sanitize_fields,
+    split_plan_sections,
+    trim_history
+)
 from services.weather_service import get_weather_service
+from services.chat_sessions import CHAT_ENRICHMENT_TTL_SECONDS, build_enrichment, get_chat_session_store
+from services.chat_summary import get_chat_summarizer
+from services.plan_jobs import JobLimitError, get_plan_job_queue
+from services.idempotency import IDEMPOTENCY_KEY_MAX_LENGTH, IdempotencyConflictError, get_idempotency_store
 from services.unsplash_service import get_unsplash_service
+from services.stats_store import get_stats_store
+from services.tracing import TraceIdFilter, TracingMiddleware, span, traced
+from services.metrics import (
+    CONTENT_TYPE_LATEST,
+    RATE_LIMIT_REJECTIONS,
+    MetricsMiddleware,
+    record_finish_reason,
+    render as render_metrics,
+    service_stats
+)
 
 # Cargar variables de entorno
 load_dotenv()
 
-# Configurar logging
+# Configurar logging (cada línea lleva el trace id de la solicitud en curso, "-" fuera de una)
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] - %(message)s'
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format=LOG_FORMAT
 )
+for root_handler in logging.getLogger().handlers:
+    root_handler.addFilter(TraceIdFilter())
 logger = logging.getLogger(__name__)
 
 # Configurar logging a archivo (RotatingFileHandler)
@@ -51,7 +85,8 @@ file_handler = RotatingFileHandler(
     encoding='utf-8'
 )
 file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+file_handler.addFilter(TraceIdFilter())
 logger.addHandler(file_handler)
 logger.info(f"✅ Logging configurado: logs se guardarán en {log_file_path}")
 
@@ -179,9 +214,10 @@ async def verify_token(
             detail="Formato de autorización inválido. Usa 'Bearer <token>'."
         )
     
-    # Verificar el token con Firebase
+    # Verificar el token con Firebase (fuera del event loop y con caché hasta su expiración)
     try:
-        decoded_token = auth.verify_id_token(token)
+        with span("auth"):
+            decoded_token = await get_token_verifier().verify(token)
         uid = decoded_token.get("uid")
         if not uid:
             logger.warning("⚠️  Token válido pero sin UID")
@@ -189,7 +225,7 @@ async def verify_token(
                 status_code=401,
                 detail="Token inválido: UID no encontrado."
             )
-        # Almacenar uid en request.state para uso en rate limiting
+        # Almacenar uid en request.state para uso en rate limiting (evita verificar el token dos veces)
         request.state.uid = uid
         logger.info(f"✅ Token verificado para usuario: {uid}")
         return uid
@@ -206,46 +242,10 @@ async def verify_token(
             detail="Token de autorización inválido o expirado."
         )
 
-# Sistema de métricas simple (en memoria - se puede persistir en archivo si es necesario)
-STATS_FILE = "stats.json"
-stats = {
-    "total_plans_generated": 0,
-    "destinations_counter": {},
-    "last_reset": datetime.now().isoformat()
-}
-
-# Cargar stats desde archivo si existe
-def load_stats():
-    """Carga estadísticas desde archivo si existe."""
-    global stats
-    try:
-        if os.path.exists(STATS_FILE):
-            with open(STATS_FILE, 'r') as f:
-                loaded_stats = json.load(f)
-                stats.update(loaded_stats)
-            logger.info(f"📊 Estadísticas cargadas: {stats['total_plans_generated']} planes generados")
-    except Exception as e:
-        logger.warning(f"⚠️  No se pudo cargar stats.json: {e}. Iniciando con valores por defecto.")
-
-def save_stats():
-    """Guarda estadísticas en archivo."""
-    try:
-        with open(STATS_FILE, 'w') as f:
-            json.dump(stats, f, indent=2)
-    except Exception as e:
-        logger.warning(f"⚠️  No se pudo guardar stats.json: {e}")
-
 def increment_plan_counter(destination: str):
     """Incrementa el contador de planes y actualiza el ranking de destinos."""
-    global stats
-    stats["total_plans_generated"] += 1
-    if destination:
-        destination_lower = destination.strip().lower()
-        stats["destinations_counter"][destination_lower] = stats["destinations_counter"].get(destination_lower, 0) + 1
-    save_stats()
-
-# Cargar stats al iniciar
-load_stats()
+    # Solo actualiza memoria: el guardado en disco ocurre en lote en segundo plano
+    get_stats_store().record_plan(destination)
 
 # Validar API KEY al iniciar - Validación estricta (falla si no existe)
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -263,11 +263,49 @@ if not GEMINI_API_KEY or not GEMINI_API_KEY.strip():
 else:
     logger.info("✅ GEMINI_API_KEY encontrada y validada")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Ciclo de vida de la aplicación.
+    
+    Al iniciar crea los clientes HTTP compartidos de Weather y Unsplash (pool de conexiones
+    con keep-alive), lanza la precarga de certificados de Firebase y el guardado periódico de
+    estadísticas; al apagar cierra todo para no dejar sockets, tareas ni
+    conexiones a SQLite abiertas.
+    """
+    weather_service = get_weather_service()
+    unsplash_service = get_unsplash_service()
+    token_verifier = get_token_verifier()
+    stats_store = get_stats_store()
+    await stats_store.start()
+    await weather_service.startup()
+    await unsplash_service.startup()
+    # Workers de la cola de planes: retoman los trabajos que quedaron pendientes
+    get_plan_job_queue().start(run_plan_job)
+    if FIREBASE_INITIALIZED:
+        token_verifier.start_certificate_refresh(firebase_app)
+    try:
+        yield
+    finally:
+        # Primero lo que todavía genera trabajo (cola de planes y resúmenes): usan los
+        # clientes HTTP y registran estadísticas, que se cierran después
+        await get_plan_job_queue().stop()
+        await get_chat_summarizer().drain()
+        await token_verifier.stop_certificate_refresh()
+        await weather_service.shutdown()
+        await unsplash_service.shutdown()
+        # Cachés en disco: checkpoint del WAL y cierre de conexiones (importante en recargas)
+        await get_idempotency_store().close()
+        await get_chat_session_store().close()
+        # Último flush de estadísticas para no perder los eventos pendientes
+        await stats_store.stop()
+
 # Inicializar FastAPI
 app = FastAPI(
     title="ViajeIA API",
     description="API para recomendaciones de viaje con Google Gemini",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Función personalizada para rate limiting por User ID
@@ -276,9 +314,10 @@ def get_rate_limit_key(request: Request):
     Obtiene la clave para rate limiting basada en User ID desde token de Firebase.
     
     Estrategia:
-    1. Intenta extraer y verificar el token de Firebase del header Authorization
-    2. Si el token es válido, usa el UID del usuario (cada usuario tiene su propio contador)
-    3. Si NO hay token o es inválido, usa get_remote_address (IP) como fallback
+    1. Si verify_token ya autenticó la solicitud, usa el UID guardado en request.state
+       (la dependencia se resuelve antes de que slowapi evalúe el límite)
+    2. Si no, busca el token en la caché de tokens ya verificados (sin bloquear el event loop)
+    3. Si NO hay token o no está verificado, usa get_remote_address (IP) como fallback
     
     Args:
         request: Request de FastAPI
@@ -286,6 +325,10 @@ def get_rate_limit_key(request: Request):
     Returns:
         str: Clave única para rate limiting (User ID o IP)
     """
+    uid = getattr(request.state, "uid", None)
+    if uid:
+        return f"user:{uid}"
+    
     # Intentar leer el header Authorization
     authorization = request.headers.get("Authorization")
     
@@ -294,15 +337,9 @@ def get_rate_limit_key(request: Request):
             # Extraer el token del formato "Bearer <token>"
             scheme, token = authorization.split(" ", 1)
             if scheme.lower() == "bearer" and FIREBASE_INITIALIZED:
-                try:
-                    # Verificar el token con Firebase
-                    decoded_token = auth.verify_id_token(token)
-                    uid = decoded_token.get("uid")
-                    if uid:
-                        return f"user:{uid}"
-                except Exception:
-                    # Si la verificación falla, continuar con IP fallback
-                    pass
+                decoded_token = get_token_verifier().get_cached(token)
+                if decoded_token and decoded_token.get("uid"):
+                    return f"user:{decoded_token['uid']}"
         except ValueError:
             # Si el formato es inválido, continuar con IP fallback
             pass
@@ -317,6 +354,7 @@ app.state.limiter = limiter
 # Personalizar el handler de rate limit exceeded con mensaje en español
 def rate_limit_handler(request: Request, exc: RateLimitExceeded):
     """Handler personalizado para errores de rate limiting."""
+    RATE_LIMIT_REJECTIONS.labels(route=request.url.path).inc()
     response = JSONResponse(
         status_code=429,
         content={"detail": "Has alcanzado el límite de consultas. Espera un momento."}
@@ -375,6 +413,47 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+# Métricas por ruta (agregado después de CORS: queda por fuera de CORS)
+app.add_middleware(MetricsMiddleware)
+
+# Trazas por solicitud (el más externo): Server-Timing, X-Trace-Id y trace id en los logs
+app.add_middleware(TracingMiddleware)
+
+# Contadores de cachés, gates y executors, leídos en cada scrape de /metrics
+CACHE_COUNTERS = ("hits", "misses", "evictions", "expirations", "stale_served", "disk_hits", "upstream_calls", "coalesced")
+service_stats.register("plan_cache", lambda: get_gemini_service().plan_cache.stats(), counters=CACHE_COUNTERS)
+service_stats.register("weather_cache", lambda: get_weather_service().cache_stats(), counters=CACHE_COUNTERS)
+service_stats.register("image_cache", lambda: get_unsplash_service().cache_stats(), counters=CACHE_COUNTERS)
+service_stats.register("token_cache", lambda: get_token_verifier().cache_stats(), counters=CACHE_COUNTERS + ("verifications",))
+service_stats.register("chat_sessions", lambda: get_chat_session_store().stats(), counters=CACHE_COUNTERS + ("created", "not_found"))
+service_stats.register("chat_summary", lambda: get_chat_summarizer().stats(), counters=("runs", "folded_messages", "failures", "skipped"))
+service_stats.register("plan_dedup", lambda: plan_singleflight.stats(), counters=("executed", "coalesced"))
+service_stats.register(
+    "idempotency",
+    lambda: get_idempotency_store().stats(),
+    counters=CACHE_COUNTERS + ("stored", "replayed", "attached", "conflicts")
+)
+service_stats.register(
+    "plan_jobs",
+    lambda: get_plan_job_queue().stats(),
+    counters=("submitted", "deduplicated", "rejected", "completed", "failed", "requeued", "purged")
+)
+service_stats.register(
+    "gemini_concurrency",
+    lambda: get_gemini_service().concurrency_stats(),
+    counters=("admitted", "rejected", "timed_out", "adaptive_increases", "adaptive_decreases",
+              "adaptive_throttled", "adaptive_timeouts", "adaptive_unavailable", "adaptive_latency_spikes")
+)
+service_stats.register(
+    "executor",
+    # Tareas esperando hilo y en curso en cada executor dedicado
+    lambda: {
+        "gemini": get_gemini_service().executor_stats(),
+        "firebase_verify": get_token_verifier().executor_stats()
+    },
+    counters=("gemini_completed", "firebase_verify_completed")
+)
+
 
 # Modelos Pydantic para validación de requests
 class TravelRequest(BaseModel):
@@ -408,7 +487,10 @@ class ChatRequest(BaseModel):
     budget: str
     style: str
     message: str  # Nuevo mensaje del usuario
-    history: List[ChatMessage] = []  # Historial de mensajes anteriores
+    history: List[ChatMessage] = []  # Historial de mensajes anteriores (solo sin session_id)
+    session_id: Optional[str] = None  # Sesión del servidor que ya guarda el historial
+    skip_enrichment: bool = False  # True: no consultar clima ni imágenes (el cliente ya los tiene)
+    user_currency: str = "USD"  # Moneda con la que se pidió el plan (para encontrarlo en caché al editarlo)
 
 
 class ChatResponse(BaseModel):
@@ -417,6 +499,251 @@ class ChatResponse(BaseModel):
     weather: Optional[Dict] = None
     images: List[str] = []
     info: Optional[Dict] = None
+    session_id: Optional[str] = None
+    changed_sections: Optional[List[str]] = None  # Secciones del plan regeneradas (solo en ediciones)
+
+
+def validate_travel_request(travel_request: TravelRequest) -> str:
+    """
+    Valida y sanitiza los campos de una solicitud de plan de viaje.
+    
+    Args:
+        travel_request: TravelRequest recibido en /api/plan o /api/plan/stream
+    
+    Returns:
+        str: El destino ya limpio (sin espacios extremos)
+    
+    Raises:
+        HTTPException: 400 si algún campo está vacío, es demasiado largo o contiene patrones no permitidos
+    """
+    # Validar que el destino no esté vacío
+    if not travel_request.destination or not travel_request.destination.strip():
+        raise HTTPException(
+            status_code=400,
+            detail="El destino no puede estar vacío. Por favor, proporciona un destino para tu viaje."
+        )
+    
+    # Sanitizar el destino (máximo 100 caracteres) y los campos opcionales no vacíos
+    # (máximo 50) con una sola pasada del detector de prompt injection
+    destination_raw = travel_request.destination.strip()
+    fields = [("destino", destination_raw, 100)]
+    if travel_request.date:
+        fields.append(("fecha", travel_request.date, 50))
+    if travel_request.budget:
+        fields.append(("presupuesto", travel_request.budget, 50))
+    if travel_request.style:
+        fields.append(("estilo", travel_request.style, 50))
+    
+    results = sanitize_fields([(text, max_length) for _, text, max_length in fields])
+    for (field_name, _, _), (is_valid, error_msg) in zip(fields, results):
+        if is_valid:
+            continue
+        if field_name == "destino":
+            logger.warning(f"⚠️  Intento de prompt injection o input inválido en destino: {error_msg}")
+            raise HTTPException(
+                status_code=400,
+                detail=error_msg
+            )
+        raise HTTPException(status_code=400, detail=f"Campo '{field_name}' inválido: {error_msg}")
+    destination = destination_raw
+    
+    return destination
+
+
+def history_message_parts(msg) -> str:
+    """Texto de un mensaje del historial (dict, modelo Pydantic u objeto con .parts)."""
+    if isinstance(msg, dict):
+        return msg.get('parts', '')
+    if hasattr(msg, 'model_dump'):
+        return msg.model_dump().get('parts', '')
+    if hasattr(msg, 'dict'):
+        return msg.dict().get('parts', '')
+    return getattr(msg, 'parts', '')
+
+
+def build_chat_history(history: List, history_parts: List[str], rejected: Set[int]) -> List[Dict]:
+    """
+    Convierte el historial recibido a diccionarios, omitiendo los mensajes rechazados.
+    
+    Args:
+        history: Mensajes tal como llegaron en ChatRequest.history
+        history_parts: Texto de cada mensaje (ver history_message_parts)
+        rejected: Índices de los mensajes que no pasaron la sanitización
+    
+    Returns:
+        List[Dict]: Mensajes en formato {"role": ..., "parts": ...}
+    """
+    sanitized_history = []
+    for i, (msg, parts) in enumerate(zip(history, history_parts)):
+        if i in rejected:
+            continue
+        
+        # Mantener el formato original del mensaje
+        if isinstance(msg, dict):
+            sanitized_history.append(msg)
+        elif hasattr(msg, 'model_dump'):
+            sanitized_history.append(msg.model_dump())
+        elif hasattr(msg, 'dict'):
+            sanitized_history.append(msg.dict())
+        else:
+            sanitized_history.append({
+                "role": getattr(msg, 'role', 'user'),
+                "parts": str(parts)
+            })
+    return sanitized_history
+
+
+def build_travel_response(
+    gemini_response: str,
+    finish_reason: str,
+    weather_data: Optional[Dict],
+    images: Optional[List[str]]
+) -> Dict:
+    """
+    Arma la respuesta de /api/plan y /api/chat (TravelResponse / ChatResponse).
+    
+    Args:
+        gemini_response: Texto generado por Gemini
+        finish_reason: Razón de finalización de la generación
+        weather_data: Clima del destino o None si no está disponible
+        images: URLs de imágenes (cualquier otro valor se trata como lista vacía)
+    
+    Returns:
+        Dict: Respuesta con gemini_response, finish_reason, weather, images e info
+    """
+    return {
+        "gemini_response": gemini_response,
+        "finish_reason": finish_reason,  # Información sobre si la respuesta fue cortada
+        **build_weather_payload(weather_data),
+        "images": images if isinstance(images, list) else []
+    }
+
+
+def build_weather_payload(weather_data: Optional[Dict]) -> Dict:
+    """
+    Campos weather e info de TravelResponse (también el evento weather de /api/plan/stream).
+    
+    Args:
+        weather_data: Clima del destino o None si no está disponible
+    
+    Returns:
+        Dict: {"weather": {...} | None, "info": {"local_time": ...} | None}
+    """
+    if not weather_data or not isinstance(weather_data, dict):
+        return {"weather": None, "info": None}
+    return {
+        "weather": {
+            "temp": weather_data.get("temp"),
+            "condition": weather_data.get("condition"),
+            "feels_like": weather_data.get("feels_like")
+        },
+        "info": {"local_time": weather_data.get("local_time", "N/A")}
+    }
+
+
+def overloaded_http_exception(exc: OverloadedError) -> HTTPException:
+    """Convierte la saturación de Gemini en un 503 con Retry-After."""
+    logger.warning(f"🚦 Gemini saturado, solicitud rechazada: {exc}")
+    return HTTPException(
+        status_code=503,
+        detail="El servicio está saturado en este momento. Intenta de nuevo en unos segundos.",
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+# Generaciones de planes en curso: solicitudes idénticas simultáneas (misma clave que la
+# caché de planes) esperan la misma llamada a Gemini en lugar de lanzar una nueva
+plan_singleflight = SingleFlight(name="plan")
+
+
+class PlanStreamAbandoned(Exception):
+    """El stream que generaba el plan se cortó (cliente desconectado) antes de terminarlo."""
+
+
+async def run_plan_generation(
+    gemini_service,
+    destination: str,
+    date: str,
+    budget: str,
+    style: str,
+    user_currency: str,
+    check_cache: bool = True
+) -> Tuple[str, str]:
+    """
+    Genera el plan con concurrencia acotada hacia Gemini y deduplicación en vuelo.
+    
+    Args:
+        check_cache: Consultar la caché de planes (False si el llamador ya la consultó)
+    
+    Returns:
+        Tuple[str, str]: (recomendación, finish_reason)
+    
+    Raises:
+        OverloadedError: Si Gemini está saturado
+    """
+    key = plan_cache_key(destination, date, budget, style, user_currency)
+    while True:
+        if plan_singleflight.in_flight(key):
+            logger.info(f"🔗 Generación idéntica en curso para '{destination}': esperando su resultado")
+        try:
+            return await plan_singleflight.run(
+                key,
+                lambda: gemini_service.generate_travel_recommendation_async(
+                    destination=destination,
+                    date=date,
+                    budget=budget,
+                    style=style,
+                    user_currency=user_currency,
+                    check_cache=check_cache
+                )
+            )
+        except PlanStreamAbandoned:
+            # La generación compartida era un stream cuyo cliente se desconectó: se reintenta
+            logger.info(f"🔁 El stream que generaba el plan de '{destination}' se canceló: generando de nuevo")
+
+
+async def run_plan_job(payload: Dict) -> Dict:
+    """
+    Genera la respuesta de /api/plan para un trabajo de la cola (ver services/plan_jobs.py).
+    
+    Args:
+        payload: Campos ya validados de la solicitud (destination, date, budget, style, user_currency)
+    
+    Returns:
+        Dict: La misma respuesta que /api/plan
+    
+    Raises:
+        OverloadedError: Si Gemini está saturado (el trabajo vuelve a la cola)
+        Exception: Si Gemini falla
+    """
+    destination = payload["destination"]
+    gemini_result, weather_data, images = await asyncio.gather(
+        run_plan_generation(
+            get_gemini_service(),
+            destination=destination,
+            date=payload["date"],
+            budget=payload["budget"],
+            style=payload["style"],
+            user_currency=payload["user_currency"]
+        ),
+        get_weather_service().get_weather(destination),
+        get_unsplash_service().get_destination_images(destination, count=8),
+        return_exceptions=True
+    )
+    if isinstance(gemini_result, Exception):
+        raise gemini_result
+    gemini_response, finish_reason = gemini_result
+    record_finish_reason("plan_job", finish_reason)
+    
+    if isinstance(weather_data, Exception):
+        logger.warning(f"⚠️  Error al obtener clima (continuando sin clima): {type(weather_data).__name__}: {weather_data}")
+        weather_data = None
+    if isinstance(images, Exception):
+        logger.warning(f"⚠️  Error al obtener imágenes (continuando sin imágenes): {type(images).__name__}: {images}")
+        images = []
+    
+    increment_plan_counter(destination)
+    return build_travel_response(gemini_response, finish_reason, weather_data, images)
 
 
 @app.get("/")
@@ -427,6 +754,7 @@ async def root():
         "status": "ok",
         "endpoints": {
             "plan": "/api/plan",
+            "plan_stream": "/api/plan/stream",
             "chat": "/api/chat",
             "health": "/health"
         }
@@ -452,6 +780,16 @@ async def health_check():
         }
 
 
+@app.get("/metrics")
+async def metrics():
+    """
+    Métricas en formato Prometheus: solicitudes y latencias por ruta, llamadas a Gemini,
+    WeatherAPI, Unsplash y Firebase, finish_reason, rate limiting, colas y cachés.
+    """
+    # Content-Type completo en el header (media_type agregaría un segundo charset)
+    return Response(content=render_metrics(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
 @app.get("/api/stats")
 async def get_stats():
     """
@@ -461,19 +799,49 @@ async def get_stats():
         Dict con:
         - total_plans_generated: Número total de planes generados
         - top_destinations: Lista de los destinos más populares
+        - plan_cache: Contadores de la caché de planes (hits, misses, ocupación)
+        - weather_cache: Contadores de la caché de clima (incluye datos stale y llamadas coalescidas)
+        - image_cache: Contadores de la caché de imágenes (memoria + disco)
+        - plan_dedup: Generaciones de planes ejecutadas vs. coalescidas con una idéntica en curso
+        - token_cache: Verificaciones de tokens de Firebase reales vs. servidas desde caché
+        - chat_sessions: Sesiones de chat guardadas en el servidor (backend, ocupación, expiradas)
+        - chat_summary: Resúmenes de conversaciones largas generados en segundo plano
+        - plan_jobs: Trabajos de la cola de planes (encolados, deduplicados, terminados, fallidos)
+        - idempotency: Respuestas guardadas por Idempotency-Key y reintentos repetidos o en espera
+        - stats_store: Estado del guardado en lote de estadísticas (flushes, eventos pendientes)
+        - gemini_concurrency: Llamadas a Gemini en curso, en cola, rechazadas, tiempos de espera
+          y el límite adaptativo actual (aumentos, recortes, 429, timeouts)
     """
     try:
         # Obtener top 5 destinos
-        destinations_counter = Counter(stats["destinations_counter"])
+        # Con el backend SQLite es una consulta a disco: fuera del event loop
+        summary = await asyncio.get_running_loop().run_in_executor(
+            None, get_stats_store().summary, 5
+        )
         top_destinations = [
             {"destination": dest.capitalize(), "count": count}
-            for dest, count in destinations_counter.most_common(5)
+            for dest, count in summary["top_destinations"]
         ]
         
         return {
-            "total_plans_generated": stats["total_plans_generated"],
+            "total_plans_generated": summary["total_plans_generated"],
             "top_destinations": top_destinations,
-            "last_reset": stats.get("last_reset", "N/A")
+            "last_reset": summary.get("last_reset", "N/A"),
+            "stats_store": get_stats_store().store_stats(),
+            "plan_cache": get_gemini_service().plan_cache.stats(),
+            "weather_cache": get_weather_service().cache_stats(),
+            "image_cache": get_unsplash_service().cache_stats(),
+            "plan_dedup": plan_singleflight.stats(),
+            "token_cache": get_token_verifier().cache_stats(),
+            "chat_sessions": get_chat_session_store().stats(),
+            "chat_summary": get_chat_summarizer().stats(),
+            "plan_jobs": get_plan_job_queue().stats(),
+            "idempotency": get_idempotency_store().stats(),
+            "gemini_concurrency": get_gemini_service().concurrency_stats(),
+            "executor": {
+                "gemini": get_gemini_service().executor_stats(),
+                "firebase_verify": get_token_verifier().executor_stats()
+            }
         }
     except Exception as e:
         logger.error(f"❌ Error al obtener estadísticas: {e}")
@@ -483,11 +851,128 @@ async def get_stats():
         )
 
 
-@app.post("/api/plan")
+def idempotency_key(request: Request) -> Optional[str]:
+    """
+    Header Idempotency-Key de la solicitud (None si no viene).
+    
+    Raises:
+        HTTPException: 400 si la clave está vacía o es demasiado larga
+    """
+    key = request.headers.get("Idempotency-Key")
+    if key is None:
+        return None
+    key = key.strip()
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Idempotency-Key inválida: debe tener entre 1 y {IDEMPOTENCY_KEY_MAX_LENGTH} caracteres."
+        )
+    return key
+
+
+def request_fingerprint(body: BaseModel) -> str:
+    """Huella del cuerpo ya validado: la misma clave con otro cuerpo es un conflicto."""
+    return hashlib.sha256(
+        json.dumps(jsonable_encoder(body), sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class IdempotentReplay(Exception):
+    """Reintento con una Idempotency-Key ya respondida: se devuelve la respuesta guardada."""
+
+    def __init__(self, response: Dict):
+        super().__init__("Idempotency-Key ya respondida")
+        self.response = response
+
+
+def idempotent_replay_handler(request: Request, exc: IdempotentReplay):
+    """Devuelve la respuesta guardada de un reintento (con el header Idempotent-Replayed)."""
+    return JSONResponse(content=exc.response, headers={"Idempotent-Replayed": "true"})
+
+app.add_exception_handler(IdempotentReplay, idempotent_replay_handler)
+
+
+def replay_idempotent(scope: str, model: Type[BaseModel]) -> Callable[..., Awaitable[None]]:
+    """
+    Dependency que responde los reintentos con Idempotency-Key antes del rate limiting.
+    
+    Las dependencias se resuelven antes de que slowapi evalúe el límite, así que un reintento
+    cuya respuesta ya existe (o cuya solicitud original sigue en curso) no consume la cuota
+    del usuario. Lo demás (primera solicitud, cuerpo inválido) sigue por el endpoint.
+    
+    Args:
+        scope: Endpoint ("plan", "chat"), igual que en with_idempotency
+        model: Modelo del cuerpo de la solicitud
+    """
+    async def dependency(request: Request, uid: str = Depends(verify_token)) -> None:
+        key = idempotency_key(request)
+        if key is None:
+            return
+        try:
+            body = model(**json.loads(await request.body()))
+        except (ValueError, TypeError):
+            return  # El endpoint responde el error de validación
+        try:
+            response = await get_idempotency_store().replay(uid, scope, key, request_fingerprint(body))
+        except IdempotencyConflictError:
+            raise HTTPException(
+                status_code=422,
+                detail="Esta Idempotency-Key ya se usó con una solicitud distinta."
+            )
+        if response is not None:
+            raise IdempotentReplay(response)
+    
+    return dependency
+
+
+async def with_idempotency(
+    request: Request,
+    uid: str,
+    scope: str,
+    body: BaseModel,
+    handler: Callable[[], Awaitable[Dict]]
+):
+    """
+    Aplica el header Idempotency-Key (ver services/idempotency.py) a un endpoint.
+    
+    Sin el header ejecuta handler normalmente. Con el header, un reintento con la misma clave
+    y el mismo cuerpo recibe la respuesta guardada (con el header Idempotent-Replayed) o espera
+    a la solicitud original si sigue en curso. Los reintentos normalmente ya los respondió
+    replay_idempotent antes del rate limiting; aquí se cubre el que llega en paralelo.
+    
+    Raises:
+        HTTPException: 400 si la clave es inválida, 422 si ya se usó con otro cuerpo
+    """
+    key = idempotency_key(request)
+    if key is None:
+        return await handler()
+    try:
+        response, replayed = await get_idempotency_store().run(uid, scope, key, request_fingerprint(body), handler)
+    except IdempotencyConflictError:
+        raise HTTPException(
+            status_code=422,
+            detail="Esta Idempotency-Key ya se usó con una solicitud distinta."
+        )
+    if replayed:
+        return JSONResponse(content=response, headers={"Idempotent-Replayed": "true"})
+    return response
+
+
+@app.post("/api/plan", dependencies=[Depends(replay_idempotent("plan", TravelRequest))])
 @limiter.limit("5/minute")
 async def create_travel_plan(request: Request, travel_request: TravelRequest, uid: str = Depends(verify_token)):
     """
-    Endpoint principal para generar recomendaciones de viaje con datos en tiempo real.
+    Endpoint principal para generar recomendaciones de viaje (ver generate_travel_plan).
+    
+    Acepta el header Idempotency-Key: un reintento con la misma clave recibe la misma
+    respuesta sin volver a generar el plan ni contarlo en las estadísticas.
+    """
+    return await with_idempotency(request, uid, "plan", travel_request, lambda: generate_travel_plan(travel_request))
+
+
+async def generate_travel_plan(travel_request: TravelRequest) -> Dict:
+    """
+    Genera la recomendación de viaje con datos en tiempo real.
     
     Recibe una solicitud del usuario y consulta en paralelo:
     - Gemini para la recomendación de viaje
@@ -495,7 +980,7 @@ async def create_travel_plan(request: Request, travel_request: TravelRequest, ui
     - Unsplash para imágenes del destino
     
     Args:
-        request: TravelRequest con la query del usuario y preferencias opcionales
+        travel_request: TravelRequest con la query del usuario y preferencias opcionales
         
     Returns:
         TravelResponse con la recomendación de Gemini, clima, imágenes e información adicional
@@ -506,39 +991,8 @@ async def create_travel_plan(request: Request, travel_request: TravelRequest, ui
     try:
         logger.info(f"📨 Nueva solicitud recibida: Destino={travel_request.destination}, Fecha={travel_request.date}, Presupuesto={travel_request.budget}, Estilo={travel_request.style}, Moneda={travel_request.user_currency}")
         
-        # Validar que el destino no esté vacío
-        if not travel_request.destination or not travel_request.destination.strip():
-            raise HTTPException(
-                status_code=400,
-                detail="El destino no puede estar vacío. Por favor, proporciona un destino para tu viaje."
-            )
-        
-        # Sanitizar y validar el destino (máximo 100 caracteres para destinos)
-        destination_raw = travel_request.destination.strip()
-        is_valid, error_msg = sanitize_input(destination_raw, max_length=100)
-        if not is_valid:
-            logger.warning(f"⚠️  Intento de prompt injection o input inválido en destino: {error_msg}")
-            raise HTTPException(
-                status_code=400,
-                detail=error_msg
-            )
-        destination = destination_raw
-        
-        # Sanitizar otros campos opcionales si no están vacíos
-        if travel_request.date:
-            is_valid, error_msg = sanitize_input(travel_request.date, max_length=50)
-            if not is_valid:
-                raise HTTPException(status_code=400, detail=f"Campo 'fecha' inválido: {error_msg}")
-        
-        if travel_request.budget:
-            is_valid, error_msg = sanitize_input(travel_request.budget, max_length=50)
-            if not is_valid:
-                raise HTTPException(status_code=400, detail=f"Campo 'presupuesto' inválido: {error_msg}")
-        
-        if travel_request.style:
-            is_valid, error_msg = sanitize_input(travel_request.style, max_length=50)
-            if not is_valid:
-                raise HTTPException(status_code=400, detail=f"Campo 'estilo' inválido: {error_msg}")
+        with span("validate"):
+            destination = validate_travel_request(travel_request)
         
         # Obtener servicios con manejo de errores
         try:
@@ -575,16 +1029,13 @@ async def create_travel_plan(request: Request, travel_request: TravelRequest, ui
         # Verificar que los argumentos sean correctos antes de enviar
         logger.info(f"📤 Enviando a Gemini: destination='{destination}', date='{travel_request.date}', budget='{travel_request.budget}', style='{travel_request.style}', currency='{travel_request.user_currency}'")
         
-        loop = asyncio.get_event_loop()
-        gemini_task = loop.run_in_executor(
-            None,
-            lambda: gemini_service.generate_travel_recommendation(
-                destination=destination,
-                date=travel_request.date or "",
-                budget=travel_request.budget or "",
-                style=travel_request.style or "",
-                user_currency=travel_request.user_currency or "USD"
-            )
+        gemini_task = run_plan_generation(
+            gemini_service,
+            destination=destination,
+            date=travel_request.date or "",
+            budget=travel_request.budget or "",
+            style=travel_request.style or "",
+            user_currency=travel_request.user_currency or "USD"
         )
         
         # Llamadas asíncronas a Weather y Unsplash (con fallback si los servicios no están disponibles)
@@ -602,15 +1053,17 @@ async def create_travel_plan(request: Request, travel_request: TravelRequest, ui
                 return []
             images_task = empty_images()
         
-        # Esperar todas las respuestas en paralelo
+        # Esperar todas las respuestas en paralelo (cada una medida como etapa de la traza)
         gemini_result, weather_data, images = await asyncio.gather(
-            gemini_task,
-            weather_task,
-            images_task,
+            traced("gemini", gemini_task),
+            traced("weather", weather_task),
+            traced("images", images_task),
             return_exceptions=True
         )
         
         # Manejar errores individuales sin fallar toda la respuesta
+        if isinstance(gemini_result, OverloadedError):
+            raise overloaded_http_exception(gemini_result)
         if isinstance(gemini_result, Exception):
             error_type = type(gemini_result).__name__
             error_message = str(gemini_result)
@@ -630,6 +1083,7 @@ async def create_travel_plan(request: Request, travel_request: TravelRequest, ui
         
         # Desempaquetar la tupla (respuesta, finish_reason)
         gemini_response, finish_reason = gemini_result
+        record_finish_reason("plan", finish_reason)
         
         # Fallo gracioso: Si weather o images fallan, continuar con valores por defecto
         if isinstance(weather_data, Exception):
@@ -654,12 +1108,6 @@ async def create_travel_plan(request: Request, travel_request: TravelRequest, ui
                 logger.warning(f"📋 No se pudo obtener traceback completo. Error: {error_message}")
             images = []
         
-        # Construir objeto info con datos adicionales
-        info = {}
-        if weather_data and isinstance(weather_data, dict):
-            info["local_time"] = weather_data.get("local_time", "N/A")
-            # Opcional: agregar currency si se implementa en el futuro
-        
         logger.info("✅ Recomendación generada con datos en tiempo real")
         logger.info(f"📊 Resumen: Gemini={'✅' if gemini_response else '❌'}, Weather={'✅' if weather_data else '❌'}, Images={'✅' if images else '❌'}, FinishReason={finish_reason}")
         
@@ -667,17 +1115,7 @@ async def create_travel_plan(request: Request, travel_request: TravelRequest, ui
         increment_plan_counter(destination)
         
         # Devolver respuesta con nueva estructura (siempre incluir respuesta de Gemini)
-        return {
-            "gemini_response": gemini_response,
-            "finish_reason": finish_reason,  # Información sobre si la respuesta fue cortada
-            "weather": {
-                "temp": weather_data.get("temp") if weather_data and isinstance(weather_data, dict) else None,
-                "condition": weather_data.get("condition") if weather_data and isinstance(weather_data, dict) else None,
-                "feels_like": weather_data.get("feels_like") if weather_data and isinstance(weather_data, dict) else None
-            } if weather_data else None,
-            "images": images if isinstance(images, list) else [],
-            "info": info if info else None
-        }
+        return build_travel_response(gemini_response, finish_reason, weather_data, images)
         
     except HTTPException:
         # Re-lanzar HTTPExceptions sin modificar
@@ -706,17 +1144,373 @@ async def create_travel_plan(request: Request, travel_request: TravelRequest, ui
         )
 
 
-@app.post("/api/chat")
+def format_sse(event: str, data: Dict) -> str:
+    """Formatea un evento Server-Sent Events con payload JSON."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/api/plan/stream")
+@limiter.limit("5/minute")
+async def create_travel_plan_stream(request: Request, travel_request: TravelRequest, uid: str = Depends(verify_token)):
+    """
+    Variante en streaming (Server-Sent Events) de /api/plan.
+
+    Envía el texto de Gemini a medida que se genera, en lugar de esperar la respuesta completa.
+    Clima e imágenes se envían como eventos separados apenas se resuelven.
+
+    Comparte la caché de planes y la deduplicación en vuelo con /api/plan: un plan en caché o
+    una generación idéntica en curso se envía como un único fragmento sin ocupar un turno de
+    Gemini, y las solicitudes idénticas que llegan durante el stream esperan su resultado.
+    Con GEMINI_PLAN_MODE=sections el plan tampoco se transmite por fragmentos: llega en un
+    único chunk cuando están todas las secciones (y la saturación llega como evento error).
+
+    Eventos emitidos:
+    - chunk: {"text": "..."} por cada fragmento de texto de Gemini
+    - weather: {"weather": {...} | null, "info": {...} | null}
+    - images: {"images": [...]}
+    - error: {"detail": "..."} si Gemini falla (el stream termina después)
+    - done: la misma respuesta que /api/plan (build_travel_response), siempre como último evento exitoso
+
+    Raises:
+        HTTPException: Errores de validación (400), de configuración (500) o Gemini saturado (503)
+            antes de iniciar el stream
+    """
+    logger.info(f"📨 Nueva solicitud en streaming: Destino={travel_request.destination}, Fecha={travel_request.date}, Presupuesto={travel_request.budget}, Estilo={travel_request.style}, Moneda={travel_request.user_currency}")
+
+    with span("validate"):
+        destination = validate_travel_request(travel_request)
+
+    try:
+        gemini_service = get_gemini_service()
+    except Exception as e:
+        logger.error(f"❌ Error al inicializar Gemini Service: {e}")
+        logger.error(f"📋 Traceback completo:\n{traceback.format_exc()}")
+        raise HTTPException(
+            status_code=500,
+            detail="Error de configuración del servidor. Por favor, contacta al administrador."
+        )
+
+    weather_service = get_weather_service()
+    unsplash_service = get_unsplash_service()
+    plan_fields = {
+        "destination": destination,
+        "date": travel_request.date or "",
+        "budget": travel_request.budget or "",
+        "style": travel_request.style or "",
+        "user_currency": travel_request.user_currency or "USD"
+    }
+    key = plan_cache_key(**plan_fields)
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    # Señal para que el hilo de Gemini deje de consumir el stream si el cliente se desconecta
+    cancelled = threading.Event()
+
+    def produce_gemini():
+        # Corre en el executor: el SDK de Gemini en streaming es síncrono
+        try:
+            with span("gemini"):
+                for kind, payload in gemini_service.stream_travel_recommendation(**plan_fields):
+                    if cancelled.is_set():
+                        logger.info("🛑 Cliente desconectado: deteniendo streaming de Gemini")
+                        return
+                    loop.call_soon_threadsafe(queue.put_nowait, ("gemini", kind, payload))
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, ("gemini", "error", e))
+            raise  # Para que el gate informe el error al límite adaptativo
+
+    # Una sola consulta a la caché por solicitud; con una generación idéntica en curso se
+    # espera esa (y la caché solo se consulta si terminó justo antes)
+    in_flight = plan_singleflight.in_flight(key)
+    cached = None if in_flight else gemini_service.plan_cache.get(key)
+    generation: Optional[asyncio.Future] = None
+    if cached is None and not in_flight and gemini_service.plan_mode == "single":
+        generation = plan_singleflight.lead(key)
+        # Reservar el turno de Gemini antes de responder: si está saturado se devuelve 503
+        # en lugar de abrir un stream que quedaría esperando
+        admitted = loop.create_future()
+        gemini_task = asyncio.create_task(gemini_service.stream_bounded(produce_gemini, admitted))
+        gemini_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        try:
+            await asyncio.wait({admitted, gemini_task}, return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            gemini_task.cancel()
+            generation.set_exception(PlanStreamAbandoned())
+            raise
+        if not admitted.done():
+            error = gemini_task.exception()
+            generation.set_exception(error)
+            if isinstance(error, OverloadedError):
+                raise overloaded_http_exception(error)
+            raise error
+
+    def abandon_generation():
+        # Si el stream nunca llegó a iniciarse (cliente desconectado antes), cortar aquí
+        cancelled.set()
+        if generation is not None and not generation.done():
+            generation.set_exception(PlanStreamAbandoned())
+
+    async def event_stream():
+        async def fetch_shared_plan():
+            # Generación idéntica en curso, o plan por secciones (no se transmite por fragmentos)
+            try:
+                with span("gemini"):
+                    recommendation, finish_reason = await run_plan_generation(
+                        gemini_service, **plan_fields, check_cache=in_flight
+                    )
+            except Exception as e:
+                await queue.put(("gemini", "error", e))
+                return
+            await queue.put(("gemini", "chunk", recommendation))
+            await queue.put(("gemini", "done", finish_reason))
+
+        async def fetch_weather():
+            try:
+                with span("weather"):
+                    weather_data = await weather_service.get_weather(destination)
+            except Exception as e:
+                logger.warning(f"⚠️  Error al obtener clima (continuando sin clima): {type(e).__name__}: {e}")
+                weather_data = None
+            await queue.put(("weather", weather_data))
+
+        async def fetch_images():
+            try:
+                with span("images"):
+                    images = await unsplash_service.get_destination_images(destination, count=8)
+            except Exception as e:
+                logger.warning(f"⚠️  Error al obtener imágenes (continuando sin imágenes): {type(e).__name__}: {e}")
+                images = []
+            await queue.put(("images", images if isinstance(images, list) else []))
+
+        tasks = [
+            asyncio.create_task(fetch_weather()),
+            asyncio.create_task(fetch_images())
+        ]
+        if cached is not None:
+            logger.info(f"⚡ Plan servido desde caché para '{destination}'")
+            queue.put_nowait(("gemini", "chunk", cached[0]))
+            queue.put_nowait(("gemini", "done", cached[1]))
+        elif generation is None:
+            tasks.append(asyncio.create_task(fetch_shared_plan()))
+        pending = {"gemini", "weather", "images"}
+        finish_reason = None
+        weather_data = None
+        images = []
+        parts = []
+
+        try:
+            while pending:
+                item = await queue.get()
+                source = item[0]
+
+                if source == "weather":
+                    pending.discard("weather")
+                    weather_data = item[1]
+                    yield format_sse("weather", build_weather_payload(weather_data))
+
+                elif source == "images":
+                    pending.discard("images")
+                    images = item[1]
+                    yield format_sse("images", {"images": images})
+
+                else:
+                    _, kind, payload = item
+                    if kind == "chunk":
+                        parts.append(payload)
+                        yield format_sse("chunk", {"text": payload})
+                    elif kind == "done":
+                        pending.discard("gemini")
+                        finish_reason = payload
+                        if generation is not None and not generation.done():
+                            generation.set_result(("".join(parts), finish_reason))
+                    else:
+                        logger.error(f"❌ Error en Gemini (streaming): {type(payload).__name__}: {payload}")
+                        if generation is not None and not generation.done():
+                            generation.set_exception(payload)
+                        if isinstance(payload, OverloadedError):
+                            yield format_sse("error", {
+                                "detail": "El servicio está saturado en este momento. Intenta de nuevo en unos segundos.",
+                                "retry_after": payload.retry_after
+                            })
+                        else:
+                            yield format_sse("error", {"detail": "Ocurrió un error consultando a la IA"})
+                        return
+
+            logger.info(f"✅ Plan en streaming completado (finish_reason={finish_reason})")
+            record_finish_reason("plan_stream", finish_reason)
+            increment_plan_counter(destination)
+            # El último evento es la misma respuesta que /api/plan
+            yield format_sse("done", build_travel_response("".join(parts), finish_reason, weather_data, images))
+
+        finally:
+            cancelled.set()
+            # Quienes esperaban este stream generan el plan por su cuenta
+            if generation is not None and not generation.done():
+                generation.set_exception(PlanStreamAbandoned())
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # Evita que proxies (nginx/Railway) acumulen el stream
+        },
+        background=BackgroundTask(abandon_generation)
+    )
+
+
+@app.post("/api/plan/jobs", status_code=202)
+@limiter.limit("5/minute")
+async def create_plan_job(request: Request, travel_request: TravelRequest, uid: str = Depends(verify_token)):
+    """
+    Variante asíncrona de /api/plan: encola la generación y responde de inmediato.
+    
+    El plan se genera en un worker del servidor; el cliente consulta
+    GET /api/plan/jobs/{job_id} o se suscribe a GET /api/plan/jobs/{job_id}/events (SSE).
+    Una solicitud idéntica a un trabajo pendiente del mismo usuario devuelve ese trabajo.
+    
+    Returns:
+        Dict: job_id, status, deduplicated y las URLs de consulta
+    
+    Raises:
+        HTTPException: 400 si la solicitud es inválida, 429 si el usuario ya tiene el máximo
+            de trabajos pendientes, 503 si la cola está llena
+    """
+    with span("validate"):
+        destination = validate_travel_request(travel_request)
+    payload = {
+        "destination": destination,
+        "date": travel_request.date or "",
+        "budget": travel_request.budget or "",
+        "style": travel_request.style or "",
+        "user_currency": travel_request.user_currency or "USD"
+    }
+    dedup_key = json.dumps(plan_cache_key(**payload), ensure_ascii=False)
+    
+    try:
+        job, deduplicated = await get_plan_job_queue().submit_async(uid, payload, dedup_key)
+    except JobLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except OverloadedError as e:
+        raise overloaded_http_exception(e)
+    
+    logger.info(f"📥 Trabajo de plan {job['job_id']} {'reutilizado' if deduplicated else 'encolado'}: Destino={destination}")
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "deduplicated": deduplicated,
+        "status_url": f"/api/plan/jobs/{job['job_id']}",
+        "events_url": f"/api/plan/jobs/{job['job_id']}/events"
+    }
+
+
+@app.get("/api/plan/jobs/{job_id}")
+@limiter.limit("60/minute")
+async def get_plan_job(request: Request, job_id: str, uid: str = Depends(verify_token)):
+    """
+    Estado de un trabajo de plan: queued, running, done (con result) o failed (con error).
+    
+    Raises:
+        HTTPException: 404 si no existe, expiró o es de otro usuario
+    """
+    job = await get_plan_job_queue().get_async(job_id, uid)
+    if job is None:
+        raise HTTPException(status_code=404, detail="El trabajo no existe o expiró.")
+    return job
+
+
+@app.get("/api/plan/jobs/{job_id}/events")
+@limiter.limit("30/minute")
+async def plan_job_events(request: Request, job_id: str, uid: str = Depends(verify_token)):
+    """
+    Suscripción (Server-Sent Events) al estado de un trabajo de plan.
+    
+    Eventos emitidos:
+    - status: {"status": "queued" | "running", "queue_position": int | null} en cada cambio
+    - result: la respuesta de /api/plan cuando el trabajo termina
+    - error: {"detail": "..."} si el trabajo falla o expira
+    - done: siempre como último evento
+    
+    Raises:
+        HTTPException: 404 si no existe, expiró o es de otro usuario
+    """
+    plan_jobs = get_plan_job_queue()
+    job = await plan_jobs.get_async(job_id, uid)
+    if job is None:
+        raise HTTPException(status_code=404, detail="El trabajo no existe o expiró.")
+    
+    async def event_stream():
+        current = job
+        last_status = None
+        last_sent = time.monotonic()
+        while True:
+            if current is None:
+                yield format_sse("error", {"detail": "El trabajo no existe o expiró."})
+                break
+            if current["status"] == "done":
+                yield format_sse("result", current["result"])
+                break
+            if current["status"] == "failed":
+                yield format_sse("error", {"detail": current["error"]})
+                break
+            if current["status"] != last_status:
+                last_status = current["status"]
+                last_sent = time.monotonic()
+                yield format_sse("status", {"status": current["status"], "queue_position": current["queue_position"]})
+            elif time.monotonic() - last_sent > 15:
+                # Comentario SSE para que el proxy no cierre una conexión sin tráfico
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            # Los cambios de este proceso despiertan al instante; los de otros, en el siguiente sondeo
+            await plan_jobs.wait_for_change(plan_jobs.poll_interval)
+            current = await plan_jobs.get_async(job_id, uid)
+        yield format_sse("done", {"job_id": job_id})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+@app.post("/api/chat", dependencies=[Depends(replay_idempotent("chat", ChatRequest))])
 @limiter.limit("10/minute")
 async def chat_with_memory(request: Request, chat_request: ChatRequest, uid: str = Depends(verify_token)):
     """
-    Endpoint para chat continuo con memoria conversacional.
+    Endpoint para chat continuo con memoria conversacional (ver generate_chat_reply).
+    
+    Acepta el header Idempotency-Key: un reintento con la misma clave recibe la misma
+    respuesta sin agregar otra vez el turno a la sesión.
+    """
+    return await with_idempotency(request, uid, "chat", chat_request, lambda: generate_chat_reply(chat_request, uid))
+
+
+async def generate_chat_reply(chat_request: ChatRequest, uid: str) -> Dict:
+    """
+    Genera la respuesta de chat con memoria conversacional.
+    
+    Recibe un nuevo mensaje del usuario y genera una respuesta contextualizada usando Gemini.
+    
+    El historial vive en una sesión del servidor (ver services/chat_sessions.py): la respuesta
+    incluye session_id y en los siguientes turnos basta enviar ese session_id con el mensaje
+    nuevo. Sin session_id se abre una sesión nueva, sembrada con el history enviado (así
+    siguen funcionando los clientes que reenvían la conversación completa).
+    
+    El clima y las imágenes se consultan una vez por destino y sesión (se reutilizan durante
+    CHAT_ENRICHMENT_TTL_SECONDS); con skip_enrichment=true no se consultan.
     
-    Recibe un nuevo mensaje del usuario junto con el historial de conversación
-    y genera una respuesta contextualizada usando Gemini.
+    Si el mensaje pide cambiar una parte del plan ("cambia los hoteles por algo más barato")
+    y hay un plan guardado en la sesión o en caché, solo se regeneran esas secciones: la
+    respuesta es el plan completo actualizado y changed_sections lista lo que cambió.
     
     Args:
-        request: ChatRequest con el nuevo mensaje y el historial de conversación
+        chat_request: ChatRequest con el nuevo mensaje y el historial de conversación
+        uid: Usuario autenticado (dueño de la sesión)
         
     Returns:
         ChatResponse con la respuesta de Gemini, clima, imágenes e información adicional
@@ -740,9 +1534,48 @@ async def chat_with_memory(request: Request, chat_request: ChatRequest, uid: str
                 detail="El mensaje no puede estar vacío."
             )
         
-        # Sanitizar y validar el destino (máximo 100 caracteres)
+        # Con session_id el historial ya está en el servidor (sanitizado en su momento): no
+        # se vuelve a escanear y se ignora el que envíe el cliente
+        session_store = get_chat_session_store()
+        if chat_request.session_id:
+            session = await session_store.get_async(chat_request.session_id, uid)
+            if session is None:
+                raise HTTPException(
+                    status_code=404,
+                    detail="La sesión de chat no existe o expiró. Inicia una nueva conversación."
+                )
+            client_history = []
+        else:
+            session = session_store.new_session(
+                uid, chat_request.destination, chat_request.date, chat_request.budget, chat_request.style
+            )
+            client_history = chat_request.history
+        
+        # Recortar el historial al presupuesto de tokens antes de validarlo: solo se sanitiza
+        # lo que se va a enviar, y los mensajes largos (planes completos) llegan abreviados
+        full_history = build_chat_history(
+            client_history,
+            [history_message_parts(msg) for msg in client_history],
+            set()
+        )
+        limited_history = trim_history(full_history)
+        if len(limited_history) < len(full_history):
+            logger.info(f"📚 Historial limitado a {len(limited_history)} mensajes (de {len(full_history)} totales) por presupuesto de tokens")
+        history_parts = [history_message_parts(msg) for msg in limited_history]
+        
+        # Sanitizar destino (máximo 100 caracteres), mensaje (máximo 500) e historial
+        # (máximo el tope por mensaje del recorte) con una sola pasada del detector de prompt injection
         destination_raw = chat_request.destination.strip()
-        is_valid, error_msg = sanitize_input(destination_raw, max_length=100)
+        message_raw = chat_request.message.strip()
+        history_indexes = [i for i, parts in enumerate(history_parts) if parts]
+        history_max_length = max(500, CHAT_HISTORY_MESSAGE_MAX_TOKENS * CHARS_PER_TOKEN)
+        with span("validate"):
+            results = sanitize_fields(
+                [(destination_raw, 100), (message_raw, 500)]
+                + [(str(history_parts[i]), history_max_length) for i in history_indexes]
+            )
+        
+        is_valid, error_msg = results[0]
         if not is_valid:
             logger.warning(f"⚠️  Intento de prompt injection o input inválido en destino: {error_msg}")
             raise HTTPException(
@@ -751,9 +1584,7 @@ async def chat_with_memory(request: Request, chat_request: ChatRequest, uid: str
             )
         destination = destination_raw
         
-        # Sanitizar y validar el mensaje (máximo 500 caracteres para chat)
-        message_raw = chat_request.message.strip()
-        is_valid, error_msg = sanitize_input(message_raw, max_length=500)
+        is_valid, error_msg = results[1]
         if not is_valid:
             logger.warning(f"⚠️  Intento de prompt injection o input inválido en mensaje: {error_msg}")
             raise HTTPException(
@@ -762,80 +1593,92 @@ async def chat_with_memory(request: Request, chat_request: ChatRequest, uid: str
             )
         message = message_raw
         
-        # Sanitizar historial de mensajes si existe
-        sanitized_history = []
-        for msg in chat_request.history:
-            if isinstance(msg, dict):
-                parts = msg.get('parts', '')
-            elif hasattr(msg, 'model_dump'):
-                parts = msg.model_dump().get('parts', '')
-            elif hasattr(msg, 'dict'):
-                parts = msg.dict().get('parts', '')
-            else:
-                parts = getattr(msg, 'parts', '')
-            
-            # Validar cada mensaje del historial
-            if parts:
-                is_valid, error_msg = sanitize_input(str(parts), max_length=500)
-                if not is_valid:
-                    logger.warning(f"⚠️  Mensaje del historial rechazado: {error_msg}")
-                    continue  # Omitir mensajes maliciosos del historial
-            
-            # Mantener el formato original del mensaje
-            if isinstance(msg, dict):
-                sanitized_history.append(msg)
-            elif hasattr(msg, 'model_dump'):
-                sanitized_history.append(msg.model_dump())
-            elif hasattr(msg, 'dict'):
-                sanitized_history.append(msg.dict())
-            else:
-                sanitized_history.append({
-                    "role": getattr(msg, 'role', 'user'),
-                    "parts": str(parts)
-                })
-        
-        # Limitar el historial a los últimos 6 mensajes para optimizar tokens
-        limited_history = sanitized_history[-6:] if len(sanitized_history) > 6 else sanitized_history
-        logger.info(f"📚 Historial limitado a {len(limited_history)} mensajes (de {len(sanitized_history)} totales)")
+        # Omitir mensajes maliciosos del historial
+        rejected = set()
+        for i, (is_valid, error_msg) in zip(history_indexes, results[2:]):
+            if not is_valid:
+                logger.warning(f"⚠️  Mensaje del historial rechazado: {error_msg}")
+                rejected.add(i)
         
-        # El historial ya está sanitizado y convertido a diccionarios
-        history_dicts = limited_history
+        # El historial enviado ya está recortado, sanitizado y convertido a diccionarios
+        seed_history = build_chat_history(limited_history, history_parts, rejected)
+        history_dicts = session.messages + seed_history
+        # Lo que el turno cambia en la sesión se guarda junto con sus mensajes y solo si Gemini
+        # respondió: la sesión en memoria es el mismo objeto y un turno fallido no debe tocarla
+        session_updates = {
+            "destination": destination,
+            "date": chat_request.date,
+            "budget": chat_request.budget,
+            "style": chat_request.style
+        }
         
         # Obtener servicios
         gemini_service = get_gemini_service()
         weather_service = get_weather_service()
         unsplash_service = get_unsplash_service()
         
-        # Ejecutar llamadas en paralelo
-        logger.info("🔄 Consultando Gemini (con memoria), Weather y Unsplash en paralelo...")
+        # Clima e imágenes: una vez por destino y sesión; los turnos siguientes reutilizan el
+        # resultado, y con skip_enrichment no se consultan
+        enrichment = None
+        if not chat_request.skip_enrichment:
+            enrichment = session.cached_enrichment(destination, CHAT_ENRICHMENT_TTL_SECONDS)
+        fetch_enrichment = not chat_request.skip_enrichment and enrichment is None
+        
+        if fetch_enrichment:
+            logger.info("🔄 Consultando Gemini (con memoria), Weather y Unsplash en paralelo...")
+        else:
+            logger.info(f"🔄 Consultando Gemini (con memoria); clima e imágenes {'omitidos' if enrichment is None else 'reutilizados de la sesión'}")
         
-        # Llamar a Gemini con historial
-        loop = asyncio.get_event_loop()
-        gemini_task = loop.run_in_executor(
-            None,
-            lambda: gemini_service.generate_chat_response(
+        # Pedido de cambio sobre el plan: se edita el último plan de la sesión o, en el primer
+        # turno, el plan en caché generado por /api/plan con los mismos campos
+        edit_sections: List[str] = []
+        plan = ""
+        if gemini_service.plan_edits_enabled:
+            edit_sections = detect_plan_edit(message)
+            if edit_sections:
+                plan = session.plan or gemini_service.cached_plan(
+                    destination, chat_request.date, chat_request.budget, chat_request.style,
+                    chat_request.user_currency or "USD"
+                ) or ""
+                if not plan or not set(edit_sections) <= set(split_plan_sections(plan)[1]):
+                    logger.info(f"✏️  Pedido de cambio en {edit_sections} sin plan guardado: respuesta de chat normal")
+                    edit_sections = []
+        
+        if edit_sections:
+            # Solo se regeneran las secciones pedidas (concurrencia acotada)
+            gemini_task = gemini_service.edit_plan_async(
+                destination, chat_request.date, chat_request.budget, chat_request.style,
+                plan, edit_sections, message
+            )
+        else:
+            # Llamar a Gemini con historial (concurrencia acotada)
+            gemini_task = gemini_service.generate_chat_response_async(
                 destination=destination,
                 date=chat_request.date,
                 budget=chat_request.budget,
                 style=chat_request.style,
                 message=message,
-                history=history_dicts
+                history=history_dicts,
+                summary=session.summary
             )
-        )
-        
-        # Llamadas asíncronas a Weather y Unsplash
-        weather_task = weather_service.get_weather(destination)
-        images_task = unsplash_service.get_destination_images(destination, count=8)
         
-        # Esperar todas las respuestas en paralelo
-        gemini_result, weather_data, images = await asyncio.gather(
-            gemini_task,
-            weather_task,
-            images_task,
-            return_exceptions=True
-        )
+        # Esperar todas las respuestas en paralelo (cada una medida como etapa de la traza)
+        tasks = [traced("gemini", gemini_task)]
+        if fetch_enrichment:
+            tasks.append(traced("weather", weather_service.get_weather(destination)))
+            tasks.append(traced("images", unsplash_service.get_destination_images(destination, count=8)))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        gemini_result = results[0]
+        if fetch_enrichment:
+            weather_data, images = results[1], results[2]
+        elif enrichment is not None:
+            weather_data, images = enrichment["weather"], enrichment["images"]
+        else:
+            weather_data, images = None, []
         
         # Manejar errores individuales
+        if isinstance(gemini_result, OverloadedError):
+            raise overloaded_http_exception(gemini_result)
         if isinstance(gemini_result, Exception):
             logger.error(f"❌ Error en Gemini: {gemini_result}")
             raise HTTPException(
@@ -843,8 +1686,18 @@ async def chat_with_memory(request: Request, chat_request: ChatRequest, uid: str
                 detail="Ocurrió un error consultando a la IA"
             )
         
-        # Desempaquetar la tupla (respuesta, finish_reason)
-        gemini_response, finish_reason = gemini_result
+        # Desempaquetar la tupla (respuesta, finish_reason); las ediciones traen además las
+        # secciones cambiadas
+        changed_sections = None
+        if edit_sections:
+            gemini_response, changed_sections, finish_reason = gemini_result
+        else:
+            gemini_response, finish_reason = gemini_result
+        record_finish_reason("chat", finish_reason)
+        
+        # El último plan completo de la conversación queda como base de las próximas ediciones
+        if changed_sections is not None or len(split_plan_sections(gemini_response)[1]) == len(PLAN_SECTIONS):
+            session_updates["plan"] = gemini_response
         
         if isinstance(weather_data, Exception):
             logger.warning(f"⚠️  Error al obtener clima: {weather_data}")
@@ -854,25 +1707,28 @@ async def chat_with_memory(request: Request, chat_request: ChatRequest, uid: str
             logger.warning(f"⚠️  Error al obtener imágenes: {images}")
             images = []
         
-        # Construir objeto info con datos adicionales
-        info = {}
-        if weather_data:
-            info["local_time"] = weather_data.get("local_time", "N/A")
+        # Solo se reutilizan resultados completos: si algo falló, el próximo turno reintenta
+        if fetch_enrichment and weather_data and images:
+            session_updates["enrichment"] = build_enrichment(destination, weather_data, images)
         
         logger.info(f"✅ Respuesta de chat generada con memoria conversacional (finish_reason={finish_reason})")
         
+        # Guardar el turno en la sesión (si falla, la respuesta se entrega igual)
+        try:
+            await session_store.append_async(session, seed_history + [
+                {"role": "user", "parts": message},
+                {"role": "model", "parts": gemini_response}
+            ], session_updates)
+            # Conversación larga: plegar los turnos antiguos en el resumen, fuera de esta solicitud
+            get_chat_summarizer().maybe_schedule(session_store, session)
+        except Exception as e:
+            logger.warning(f"⚠️  No se pudo guardar la sesión de chat: {e}")
+        
         # Devolver respuesta
-        return {
-            "gemini_response": gemini_response,
-            "finish_reason": finish_reason,  # Información sobre si la respuesta fue cortada
-            "weather": {
-                "temp": weather_data.get("temp") if weather_data else None,
-                "condition": weather_data.get("condition") if weather_data else None,
-                "feels_like": weather_data.get("feels_like") if weather_data else None
-            } if weather_data else None,
-            "images": images,
-            "info": info if info else None
-        }
+        response = build_travel_response(gemini_response, finish_reason, weather_data, images)
+        response["session_id"] = session.session_id
+        response["changed_sections"] = changed_sections
+        return response
         
     except HTTPException:
         raise
@@ -893,6 +1749,45 @@ async def chat_with_memory(request: Request, chat_request: ChatRequest, uid: str
         )
 
 
+@app.get("/api/chat/sessions/{session_id}")
+@limiter.limit("30/minute")
+async def get_chat_session(request: Request, session_id: str, uid: str = Depends(verify_token)):
+    """
+    Devuelve el historial guardado de una sesión de chat (para restaurar la conversación).
+    
+    Raises:
+        HTTPException: 404 si la sesión no existe, expiró o pertenece a otro usuario
+    """
+    session = await get_chat_session_store().get_async(session_id, uid)
+    if session is None:
+        raise HTTPException(status_code=404, detail="La sesión de chat no existe o expiró.")
+    return {
+        "session_id": session.session_id,
+        "destination": session.destination,
+        "date": session.date,
+        "budget": session.budget,
+        "style": session.style,
+        "summary": session.summary,
+        "plan": session.plan,
+        "history": session.messages,
+        "updated_at": session.updated_at
+    }
+
+
+@app.delete("/api/chat/sessions/{session_id}")
+@limiter.limit("30/minute")
+async def delete_chat_session(request: Request, session_id: str, uid: str = Depends(verify_token)):
+    """
+    Elimina una sesión de chat del usuario.
+    
+    Raises:
+        HTTPException: 404 si la sesión no existe, expiró o pertenece a otro usuario
+    """
+    if not await get_chat_session_store().delete_async(session_id, uid):
+        raise HTTPException(status_code=404, detail="La sesión de chat no existe o expiró.")
+    return {"deleted": True}
+
+
 if __name__ == "__main__":
     import uvicorn
     
@@ -0,0 +1,182 @@
+"""
+Verificación de Firebase ID Tokens sin bloquear el event loop.
+
+Los tokens verificados se cachean (por hash del token) hasta su expiración, de modo que cada
+token se verifica criptográficamente una sola vez aunque el usuario haga muchas solicitudes.
+"""
+import os
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Callable, Dict, Optional
+
+from firebase_admin import auth
+from dotenv import load_dotenv
+
+from services.cache import TTLCache, SingleFlight
+from services.concurrency import CountingExecutor
+from services.metrics import track_upstream
+
+# Cargar variables de entorno
+load_dotenv()
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+# URL de los certificados públicos con los que Google firma los ID tokens de Firebase
+ID_TOKEN_CERT_URI = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+
+# Margen de seguridad antes de la expiración del token para dejar de servirlo desde caché
+TOKEN_EXPIRY_MARGIN_SECONDS = 30
+
+
+def token_hash(token: str) -> str:
+    """Hash del token para usarlo como clave sin guardar el token en memoria."""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _verify_id_token(token: str) -> Dict:
+    """Verificación criptográfica real (bloqueante), medida como llamada externa."""
+    with track_upstream("firebase_verify"):
+        return auth.verify_id_token(token)
+
+
+def certificate_request(app) -> Optional[Callable]:
+    """
+    Transporte HTTP (con caché) con el que firebase_admin descarga los certificados.
+
+    No es API pública de firebase_admin: se comprueba que exista en la versión instalada. Si
+    una actualización lo cambia devuelve None y verify_id_token sigue descargando los
+    certificados por su cuenta (solo se pierde la precarga).
+    """
+    get_client = getattr(auth, "_get_client", None)
+    if not callable(get_client):
+        return None
+    try:
+        client = get_client(app)
+    except Exception:
+        return None
+    request = getattr(getattr(client, "_token_verifier", None), "request", None)
+    return request if callable(request) else None
+
+
+class TokenVerifier:
+    """Verifica ID tokens de Firebase en un executor dedicado, con caché y coalescencia."""
+
+    def __init__(self):
+        """Inicializa la caché de tokens y el executor de verificación."""
+        self.cache = TTLCache(
+            ttl_seconds=3600,  # Los ID tokens de Firebase duran como máximo 1 hora
+            max_entries=int(os.getenv("AUTH_TOKEN_CACHE_MAX_ENTRIES", "10000")),
+            name="token_cache"
+        )
+        # Executor propio: la verificación (y la descarga de certificados) no compite
+        # con las llamadas a Gemini por los hilos del executor por defecto
+        self._executor = CountingExecutor(
+            max_workers=int(os.getenv("AUTH_VERIFY_WORKERS", "4")),
+            thread_name_prefix="firebase-verify"
+        )
+        self.singleflight = SingleFlight(name="token_verify")
+        self.cert_refresh_seconds = float(os.getenv("AUTH_CERT_REFRESH_SECONDS", "600"))
+        self._cert_refresh_task: Optional[asyncio.Task] = None
+
+    def get_cached(self, token: str) -> Optional[Dict]:
+        """Devuelve el token decodificado si ya fue verificado y sigue vigente (no bloquea)."""
+        return self.cache.get(token_hash(token))
+
+    async def verify(self, token: str) -> Dict:
+        """
+        Verifica un ID token de Firebase.
+
+        Args:
+            token: ID token (sin el prefijo "Bearer ")
+
+        Returns:
+            Dict: Claims del token decodificado (incluye "uid" y "exp")
+
+        Raises:
+            Exception: Las mismas excepciones que auth.verify_id_token si el token es inválido
+        """
+        key = token_hash(token)
+        decoded = self.cache.get(key)
+        if decoded is not None:
+            return decoded
+
+        loop = asyncio.get_running_loop()
+        decoded = await self.singleflight.run(
+            key,
+            lambda: loop.run_in_executor(self._executor, _verify_id_token, token)
+        )
+
+        # Cachear solo hasta la expiración real del token
+        ttl = float(decoded.get("exp", 0)) - time.time() - TOKEN_EXPIRY_MARGIN_SECONDS
+        if ttl > 0:
+            self.cache.set(key, decoded, ttl=min(ttl, self.cache.ttl_seconds))
+        return decoded
+
+    async def _refresh_certificates_loop(self, app) -> None:
+        # Se descargan con el mismo transporte con caché HTTP que usa firebase_admin, para que
+        # verify_id_token no tenga que descargarlos en el camino crítico
+        request = certificate_request(app)
+        if request is None:
+            logger.warning(
+                "⚠️  Esta versión de firebase_admin no expone el transporte de certificados: "
+                "sin precarga (la verificación los descarga cuando los necesita)"
+            )
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(self._executor, lambda: request(ID_TOKEN_CERT_URI, method="GET"))
+                logger.debug("🔑 Certificados de Firebase precargados")
+            except Exception as e:
+                logger.warning(f"⚠️  No se pudieron precargar los certificados de Firebase: {type(e).__name__}: {e}")
+            await asyncio.sleep(self.cert_refresh_seconds)
+
+    def start_certificate_refresh(self, app) -> None:
+        """Inicia la precarga periódica de certificados (llamado desde el lifespan)."""
+        if self._cert_refresh_task is None and self.cert_refresh_seconds > 0:
+            self._cert_refresh_task = asyncio.create_task(self._refresh_certificates_loop(app))
+            logger.info(f"🔑 Precarga de certificados de Firebase cada {self.cert_refresh_seconds:.0f}s")
+
+    async def stop_certificate_refresh(self) -> None:
+        """Detiene la tarea de precarga de certificados."""
+        if self._cert_refresh_task is not None:
+            self._cert_refresh_task.cancel()
+            try:
+                await self._cert_refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._cert_refresh_task = None
+
+    def cache_stats(self) -> Dict:
+        """Contadores de la caché de tokens y de verificaciones reales."""
+        return {
+            **self.cache.stats(),
+            "verifications": self.singleflight.executed,
+            "coalesced": self.singleflight.coalesced
+        }
+
+    def executor_stats(self) -> Dict:
+        """Verificaciones (y descargas de certificados) esperando hilo y en curso."""
+        return self._executor.stats()
+
+
+# Instancia global del verificador
+_token_verifier: Optional[TokenVerifier] = None
+
+
+def get_token_verifier() -> TokenVerifier:
+    """
+    Obtiene la instancia singleton del verificador de tokens.
+
+    Returns:
+        TokenVerifier: Instancia del verificador
+    """
+    global _token_verifier
+
+    if _token_verifier is None:
+        _token_verifier = TokenVerifier()
+
+    return _token_verifier
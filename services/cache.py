@@ -0,0 +1,216 @@
+"""
+Utilidades de caché en memoria para los servicios de ViajeIA.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    Caché en memoria con expiración por TTL y desalojo LRU.
+
+    Limita tanto el número de entradas como el tamaño total aproximado en bytes.
+    Es segura para usarse desde varios hilos (los servicios síncronos corren en el executor).
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float,
+        max_entries: int,
+        max_bytes: Optional[int] = None,
+        name: str = "cache"
+    ):
+        """
+        Args:
+            ttl_seconds: Tiempo de vida por defecto de cada entrada (0 o menos desactiva la caché)
+            max_entries: Número máximo de entradas antes de desalojar la menos usada
+            max_bytes: Tamaño total máximo en bytes (None = sin límite)
+            name: Nombre de la caché para logs y métricas
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.name = name
+
+        # key -> (expira_en, tamaño, valor); el orden refleja el uso (último = más reciente)
+        self._entries: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        """La caché está activa solo si tiene TTL y capacidad positivos."""
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Devuelve el valor vigente para key (y lo marca como usado) o default."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, _, value = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, size: int = 0, ttl: Optional[float] = None) -> bool:
+        """
+        Guarda un valor en la caché.
+
+        Args:
+            key: Clave de la entrada
+            value: Valor a guardar
+            size: Tamaño aproximado en bytes (para el límite max_bytes)
+            ttl: TTL específico de esta entrada (por defecto ttl_seconds)
+
+        Returns:
+            bool: False si la caché está desactivada o el valor no cabe
+        """
+        ttl = self.ttl_seconds if ttl is None else ttl
+        if not self.enabled or ttl <= 0:
+            return False
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + ttl, size, value)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self._bytes > self.max_bytes
+            ):
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+        return True
+
+    def delete(self, key: Hashable) -> None:
+        """Elimina una entrada si existe."""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        """Vacía la caché (los contadores se conservan)."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        # Debe llamarse con el lock tomado
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores y ocupación actual de la caché."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "ttl_seconds": self.ttl_seconds,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes
+        }
+
+
+class SingleFlight:
+    """
+    Coalescencia de llamadas asíncronas concurrentes con la misma clave.
+
+    Mientras una llamada para una clave está en vuelo, las siguientes llamadas con esa
+    clave esperan el mismo resultado en lugar de iniciar otra petición al upstream.
+    La tarea compartida está protegida con asyncio.shield: si un solicitante se cancela
+    (p. ej. el cliente cerró la conexión) el resto sigue recibiendo el resultado.
+    """
+
+    def __init__(self, name: str = "singleflight"):
+        self.name = name
+        self._inflight: Dict[Hashable, "asyncio.Future"] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def in_flight(self, key: Hashable) -> bool:
+        """Indica si hay una llamada en curso para key."""
+        return key in self._inflight
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Ejecuta factory() una sola vez por clave mientras esté en vuelo.
+
+        Args:
+            key: Clave que identifica llamadas equivalentes
+            factory: Función que crea la corrutina a ejecutar (solo se invoca si no hay otra en curso)
+
+        Returns:
+            El resultado de la llamada compartida (o propaga su excepción)
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(factory())
+        self._register(key, task)
+        return await asyncio.shield(task)
+
+    def lead(self, key: Hashable) -> Optional["asyncio.Future"]:
+        """
+        Registra como llamada en vuelo un resultado que se entrega a mano (p. ej. un stream).
+
+        Returns:
+            Future a resolver con set_result/set_exception, o None si ya hay una llamada en
+            curso para key (en ese caso hay que esperarla con run)
+        """
+        if key in self._inflight:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self._register(key, future)
+        return future
+
+    def _register(self, key: Hashable, task: "asyncio.Future") -> None:
+        self._inflight[key] = task
+        self.executed += 1
+
+        def _on_done(finished: "asyncio.Future"):
+            if self._inflight.get(key) is finished:
+                del self._inflight[key]
+            # Marcar la excepción como recuperada aunque todos los solicitantes se hayan cancelado
+            if not finished.cancelled():
+                finished.exception()
+
+        task.add_done_callback(_on_done)
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores de llamadas ejecutadas y coalescidas."""
+        return {
+            "in_flight": len(self._inflight),
+            "executed": self.executed,
+            "coalesced": self.coalesced
+        }
@@ -0,0 +1,360 @@
+"""
+Sesiones de chat en el servidor: el historial de cada conversación vive aquí y no en el cliente.
+
+El cliente envía solo el mensaje nuevo y el session_id; los turnos guardados ya fueron
+sanitizados (o son respuestas de Gemini), así que no se vuelven a escanear en cada mensaje.
+El tamaño de cada solicitud y el trabajo de CPU por turno no crecen con la conversación.
+
+Dos backends:
+- memory (por defecto): TTLCache con expiración deslizante y desalojo LRU, por proceso.
+- sqlite: las sesiones se guardan en SQLite y se comparten entre workers y reinicios.
+"""
+import asyncio
+import os
+import logging
+import secrets
+import time
+from typing import Dict, List, Optional
+
+from services.cache import TTLCache
+from services.persistent_cache import SQLiteCache, get_cache_dir
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+# Tiempo durante el cual el clima y las imágenes de una sesión se reutilizan entre turnos
+CHAT_ENRICHMENT_TTL_SECONDS = float(os.getenv("CHAT_ENRICHMENT_TTL_SECONDS", "900"))
+
+
+# Campos que un turno puede cambiar junto con sus mensajes (ver ChatSessionStore.append)
+SESSION_TURN_FIELDS = frozenset({"destination", "date", "budget", "style", "plan", "enrichment"})
+
+
+class ChatSession:
+    """
+    Una conversación: dueño (uid de Firebase), contexto del viaje e historial.
+
+    Los turnos antiguos pueden estar plegados en summary (ver services/chat_summary.py);
+    messages guarda solo los turnos posteriores.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        uid: str,
+        destination: str = "",
+        date: str = "",
+        budget: str = "",
+        style: str = "",
+        messages: Optional[List[Dict]] = None,
+        created_at: Optional[float] = None,
+        updated_at: Optional[float] = None,
+        summary: str = "",
+        summarized_messages: int = 0,
+        enrichment: Optional[Dict] = None,
+        plan: str = ""
+    ):
+        self.session_id = session_id
+        self.uid = uid
+        self.destination = destination
+        self.date = date
+        self.budget = budget
+        self.style = style
+        self.messages: List[Dict] = messages or []
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+        self.summary = summary
+        self.summarized_messages = summarized_messages
+        # Clima e imágenes del destino, obtenidos una vez y reutilizados en los turnos siguientes
+        self.enrichment = enrichment
+        # Último plan completo de la conversación: base para editarlo por secciones
+        self.plan = plan
+
+    def size(self) -> int:
+        """Tamaño aproximado en bytes (para el límite de memoria del almacén)."""
+        return sum(len(str(msg.get("parts", ""))) for msg in self.messages) + len(self.summary) + len(self.plan) + 256
+
+    def to_dict(self) -> Dict:
+        return {
+            "session_id": self.session_id,
+            "uid": self.uid,
+            "destination": self.destination,
+            "date": self.date,
+            "budget": self.budget,
+            "style": self.style,
+            "messages": self.messages,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "summary": self.summary,
+            "summarized_messages": self.summarized_messages,
+            "enrichment": self.enrichment,
+            "plan": self.plan
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "ChatSession":
+        return cls(**data)
+
+    def cached_enrichment(self, destination: str, max_age: float) -> Optional[Dict]:
+        """Clima e imágenes guardados para destination si no tienen más de max_age segundos."""
+        enrichment = self.enrichment
+        if (
+            not enrichment
+            or enrichment.get("destination") != _destination_key(destination)
+            or time.time() - enrichment.get("fetched_at", 0) > max_age
+        ):
+            return None
+        return enrichment
+
+    def set_enrichment(self, destination: str, weather: Optional[Dict], images: List[str]) -> None:
+        """Guarda el clima y las imágenes del destino (se persisten con el siguiente append)."""
+        self.enrichment = build_enrichment(destination, weather, images)
+
+
+def build_enrichment(destination: str, weather: Optional[Dict], images: List[str]) -> Dict:
+    """Clima e imágenes de un destino tal como se guardan en ChatSession.enrichment."""
+    return {
+        "destination": _destination_key(destination),
+        "weather": weather,
+        "images": images,
+        "fetched_at": time.time()
+    }
+
+
+def _destination_key(destination: str) -> str:
+    return " ".join(destination.split()).lower()
+
+
+class ChatSessionStore:
+    """
+    Almacén de sesiones en memoria con TTL deslizante (cada turno renueva la sesión) y LRU.
+
+    Las sesiones solo se devuelven a su dueño: un session_id de otro usuario se trata igual
+    que uno inexistente.
+    """
+
+    backend = "memory"
+
+    def __init__(self, ttl_seconds: float, max_entries: int, max_bytes: Optional[int], max_messages: int):
+        """
+        Args:
+            ttl_seconds: Inactividad tras la cual una sesión expira
+            max_entries: Número máximo de sesiones en memoria
+            max_bytes: Tamaño total aproximado de las sesiones en memoria (None = sin límite)
+            max_messages: Mensajes guardados por sesión (los más antiguos se descartan)
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_messages = max_messages
+        self.cache = TTLCache(ttl_seconds=ttl_seconds, max_entries=max_entries, max_bytes=max_bytes, name="chat_sessions")
+        self.created = 0
+        self.not_found = 0
+
+    def new_session(self, uid: str, destination: str, date: str, budget: str, style: str) -> ChatSession:
+        """Crea una sesión vacía (se guarda con append al terminar el primer turno)."""
+        self.created += 1
+        return ChatSession(secrets.token_urlsafe(16), uid, destination, date, budget, style)
+
+    def _read(self, session_id: str) -> Optional[ChatSession]:
+        return self.cache.get(session_id)
+
+    def _write(self, session: ChatSession) -> None:
+        self.cache.set(session.session_id, session, size=session.size())
+
+    def _remove(self, session_id: str) -> None:
+        self.cache.delete(session_id)
+
+    def get(self, session_id: str, uid: str) -> Optional[ChatSession]:
+        """Devuelve la sesión si existe, no expiró y pertenece a uid."""
+        session = self._read(session_id)
+        if session is None or session.uid != uid:
+            self.not_found += 1
+            return None
+        return session
+
+    def append(self, session: ChatSession, messages: List[Dict], updates: Optional[Dict] = None) -> None:
+        """
+        Agrega turnos a la sesión y la guarda (renovando su TTL).
+
+        Args:
+            session: Sesión obtenida con get o new_session
+            messages: Turnos a agregar
+            updates: Campos que el turno cambia junto con sus mensajes (destination, date,
+                budget, style, plan, enrichment); se aplican solo aquí, con el turno ya exitoso
+        """
+        self._add_turns(session, messages, updates)
+        self._write(session)
+
+    def _add_turns(self, session: ChatSession, messages: List[Dict], updates: Optional[Dict]) -> None:
+        for field, value in (updates or {}).items():
+            if field not in SESSION_TURN_FIELDS:
+                raise ValueError(f"Campo de sesión no actualizable: {field}")
+            setattr(session, field, value)
+        combined = session.messages + messages
+        session.messages = combined[-self.max_messages:] if self.max_messages > 0 else combined
+        session.updated_at = time.time()
+
+    def fold(self, session_id: str, uid: str, summary: str, folded: List[Dict]) -> bool:
+        """
+        Reemplaza los primeros turnos de la sesión por el resumen que los incluye.
+
+        Si esos turnos ya no están al comienzo (la sesión cambió mientras se resumía), no
+        se modifica nada y devuelve False.
+        """
+        session = self.get(session_id, uid)
+        if session is None or session.messages[:len(folded)] != folded:
+            return False
+        session.summary = summary
+        session.messages = session.messages[len(folded):]
+        session.summarized_messages += len(folded)
+        self._write(session)
+        return True
+
+    def delete(self, session_id: str, uid: str) -> bool:
+        """Elimina la sesión de uid. Devuelve False si no existía."""
+        if self.get(session_id, uid) is None:
+            return False
+        self._remove(session_id)
+        return True
+
+    # Variantes async: el backend en memoria no bloquea; el de SQLite pasa por el executor
+    async def get_async(self, session_id: str, uid: str) -> Optional[ChatSession]:
+        return self.get(session_id, uid)
+
+    async def append_async(self, session: ChatSession, messages: List[Dict], updates: Optional[Dict] = None) -> None:
+        self.append(session, messages, updates)
+
+    async def fold_async(self, session_id: str, uid: str, summary: str, folded: List[Dict]) -> bool:
+        return self.fold(session_id, uid, summary, folded)
+
+    async def delete_async(self, session_id: str, uid: str) -> bool:
+        return self.delete(session_id, uid)
+
+    async def close(self) -> None:
+        """Libera los recursos del almacén al apagar la aplicación (en memoria no hay nada que cerrar)."""
+
+    def stats(self) -> Dict:
+        """Contadores del almacén de sesiones."""
+        return {
+            "backend": self.backend,
+            **self.cache.stats(),
+            "created": self.created,
+            "not_found": self.not_found
+        }
+
+
+class SQLiteChatSessionStore(ChatSessionStore):
+    """
+    Sesiones en SQLite: sobreviven reinicios y son consistentes entre varios workers.
+
+    SQLite es la fuente de verdad (otro worker puede haber agregado turnos), así que no hay
+    copia en memoria; cada turno lee y escribe una sola fila. append y fold releen la fila
+    dentro de la misma transacción que la escribe: dos turnos simultáneos de una sesión, o un
+    turno y un plegado del resumen, no se pisan.
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path: str, ttl_seconds: float, max_messages: int):
+        super().__init__(ttl_seconds=ttl_seconds, max_entries=0, max_bytes=None, max_messages=max_messages)
+        self.path = path
+        self.disk = SQLiteCache(path, table="chat_sessions")
+
+    def _read(self, session_id: str) -> Optional[ChatSession]:
+        stored = self.disk.get(session_id)
+        if stored is None:
+            return None
+        return ChatSession.from_dict(stored[0])
+
+    def _write(self, session: ChatSession) -> None:
+        self.disk.set(session.session_id, session.to_dict(), ttl=self.ttl_seconds)
+
+    def _remove(self, session_id: str) -> None:
+        self.disk.delete(session_id)
+
+    def append(self, session: ChatSession, messages: List[Dict], updates: Optional[Dict] = None) -> None:
+        def merge(stored: Optional[Dict]) -> Dict:
+            if stored is not None and stored["uid"] == session.uid:
+                # Otras solicitudes y el plegado del resumen pueden haber cambiado la fila desde
+                # que esta solicitud la leyó: se parte de ella y este turno aplica solo lo suyo
+                for field, value in stored.items():
+                    setattr(session, field, value)
+            self._add_turns(session, messages, updates)
+            return session.to_dict()
+
+        self.disk.update(session.session_id, merge, ttl=self.ttl_seconds)
+
+    def fold(self, session_id: str, uid: str, summary: str, folded: List[Dict]) -> bool:
+        def apply(stored: Optional[Dict]) -> Optional[Dict]:
+            if stored is None or stored["uid"] != uid or stored["messages"][:len(folded)] != folded:
+                return None
+            stored["summary"] = summary
+            stored["messages"] = stored["messages"][len(folded):]
+            stored["summarized_messages"] += len(folded)
+            return stored
+
+        return self.disk.update(session_id, apply, ttl=self.ttl_seconds) is not None
+
+    async def get_async(self, session_id: str, uid: str) -> Optional[ChatSession]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, session_id, uid)
+
+    async def append_async(self, session: ChatSession, messages: List[Dict], updates: Optional[Dict] = None) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.append, session, messages, updates)
+
+    async def fold_async(self, session_id: str, uid: str, summary: str, folded: List[Dict]) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(None, self.fold, session_id, uid, summary, folded)
+
+    async def delete_async(self, session_id: str, uid: str) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(None, self.delete, session_id, uid)
+
+    async def close(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.disk.close)
+
+    def stats(self) -> Dict:
+        return {
+            "backend": self.backend,
+            "path": self.path,
+            "created": self.created,
+            "not_found": self.not_found
+        }
+
+
+# Instancia global del almacén de sesiones
+_chat_session_store: Optional[ChatSessionStore] = None
+
+
+def get_chat_session_store() -> ChatSessionStore:
+    """
+    Obtiene la instancia singleton del almacén de sesiones de chat.
+
+    CHAT_SESSION_BACKEND=memory (por defecto) guarda las sesiones en el proceso;
+    CHAT_SESSION_BACKEND=sqlite las guarda en CHAT_SESSION_DB_PATH (varios workers).
+
+    Returns:
+        ChatSessionStore: Instancia configurada con las variables CHAT_SESSION_*
+    """
+    global _chat_session_store
+
+    if _chat_session_store is None:
+        backend = os.getenv("CHAT_SESSION_BACKEND", "memory").lower()
+        ttl_seconds = float(os.getenv("CHAT_SESSION_TTL_SECONDS", str(24 * 3600)))
+        max_messages = int(os.getenv("CHAT_SESSION_MAX_MESSAGES", "50"))
+
+        if backend == "sqlite":
+            path = os.getenv("CHAT_SESSION_DB_PATH", os.path.join(get_cache_dir(), "chat_sessions.sqlite3"))
+            try:
+                _chat_session_store = SQLiteChatSessionStore(path, ttl_seconds, max_messages)
+            except Exception as e:
+                logger.warning(f"⚠️  No se pudo abrir el almacén de sesiones en {path}: {e}. Usando memoria.")
+        elif backend != "memory":
+            logger.warning(f"⚠️  CHAT_SESSION_BACKEND desconocido '{backend}'. Usando 'memory'.")
+
+        if _chat_session_store is None:
+            _chat_session_store = ChatSessionStore(
+                ttl_seconds=ttl_seconds,
+                max_entries=int(os.getenv("CHAT_SESSION_MAX_ENTRIES", "10000")),
+                max_bytes=int(os.getenv("CHAT_SESSION_MAX_BYTES", str(64 * 1024 * 1024))),
+                max_messages=max_messages
+            )
+        logger.info(f"💬 Sesiones de chat: backend={_chat_session_store.backend}, ttl={ttl_seconds:.0f}s")
+
+    return _chat_session_store
@@ -0,0 +1,133 @@
+"""
+Resumen acumulado de conversaciones largas del chat.
+
+Cuando una sesión supera CHAT_SUMMARY_TRIGGER_MESSAGES mensajes, los más antiguos (todos menos
+los últimos CHAT_SUMMARY_KEEP_RECENT) se pliegan con Gemini en un resumen que se guarda en la
+sesión. El prompt de cada turno pasa a ser resumen + turnos recientes: los tokens de entrada
+se mantienen estables en sesiones largas sin olvidar las restricciones que dio el usuario.
+
+El resumen se genera en segundo plano, después de responder: nunca suma latencia a un turno.
+"""
+import asyncio
+import os
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from services.chat_sessions import ChatSession, ChatSessionStore
+from services.concurrency import OverloadedError
+from services.gemini_service import get_gemini_service
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+# Función que genera el resumen: (resumen_anterior, turnos_a_plegar, max_tokens) -> resumen
+SummarizeFunc = Callable[[str, List[Dict], int], Awaitable[str]]
+
+
+class ConversationSummarizer:
+    """Programa y aplica el plegado de turnos antiguos en el resumen de cada sesión."""
+
+    def __init__(self, summarize: SummarizeFunc, trigger_messages: int, keep_recent: int, max_tokens: int):
+        """
+        Args:
+            summarize: Genera el nuevo resumen (normalmente Gemini con concurrencia acotada)
+            trigger_messages: Mensajes en la sesión a partir de los cuales se resume (0 = desactivado)
+            keep_recent: Mensajes recientes que se conservan literales
+            max_tokens: Extensión máxima del resumen
+        """
+        self.summarize = summarize
+        self.trigger_messages = trigger_messages
+        self.keep_recent = max(2, keep_recent)
+        self.max_tokens = max_tokens
+        self._in_flight: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.runs = 0
+        self.folded_messages = 0
+        self.failures = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.trigger_messages > 0
+
+    def needs_summary(self, session: ChatSession) -> bool:
+        return self.enabled and len(session.messages) > max(self.trigger_messages, self.keep_recent)
+
+    def maybe_schedule(self, store: ChatSessionStore, session: ChatSession) -> bool:
+        """
+        Lanza el plegado en segundo plano si la sesión lo necesita y no hay otro en curso.
+
+        Returns:
+            bool: True si se programó una tarea
+        """
+        if not self.needs_summary(session) or session.session_id in self._in_flight:
+            return False
+        folded = list(session.messages[:-self.keep_recent])
+        self._in_flight.add(session.session_id)
+        task = asyncio.create_task(self._run(store, session.session_id, session.uid, session.summary, folded))
+        # Referencia fuerte hasta que termine (asyncio solo guarda referencias débiles)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _run(self, store: ChatSessionStore, session_id: str, uid: str, previous: str, folded: List[Dict]) -> None:
+        try:
+            summary = await self.summarize(previous, folded, self.max_tokens)
+            if await store.fold_async(session_id, uid, summary, folded):
+                self.runs += 1
+                self.folded_messages += len(folded)
+                logger.info(f"🧾 {len(folded)} mensajes plegados en el resumen de la sesión ({len(summary)} caracteres)")
+            else:
+                self.skipped += 1
+        except OverloadedError:
+            # Gemini saturado: los turnos se quedan literales y se reintenta en el próximo turno
+            self.skipped += 1
+            logger.info("🧾 Resumen de la conversación pospuesto: Gemini saturado")
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"⚠️  No se pudo resumir la conversación: {type(e).__name__}: {e}")
+        finally:
+            self._in_flight.discard(session_id)
+
+    async def drain(self) -> None:
+        """Espera los resúmenes en curso (para el apagado y las pruebas)."""
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stats(self) -> Dict:
+        """Contadores de los resúmenes generados."""
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._in_flight),
+            "runs": self.runs,
+            "folded_messages": self.folded_messages,
+            "failures": self.failures,
+            "skipped": self.skipped
+        }
+
+
+# Instancia global del resumidor
+_summarizer: Optional[ConversationSummarizer] = None
+
+
+def get_chat_summarizer() -> ConversationSummarizer:
+    """
+    Obtiene la instancia singleton del resumidor de conversaciones.
+
+    Returns:
+        ConversationSummarizer: Configurado con las variables CHAT_SUMMARY_* y Gemini
+    """
+    global _summarizer
+
+    if _summarizer is None:
+        async def summarize(previous: str, messages: List[Dict], max_tokens: int) -> str:
+            return await get_gemini_service().summarize_conversation_async(previous, messages, max_tokens)
+
+        _summarizer = ConversationSummarizer(
+            summarize,
+            trigger_messages=int(os.getenv("CHAT_SUMMARY_TRIGGER_MESSAGES", "16")),
+            keep_recent=int(os.getenv("CHAT_SUMMARY_KEEP_RECENT", "6")),
+            max_tokens=int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "300"))
+        )
+
+    return _summarizer
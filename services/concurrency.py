@@ -0,0 +1,331 @@
+"""
+Control de concurrencia hacia servicios externos lentos (Gemini).
+
+Limita cuántas llamadas están en curso a la vez y cuántas pueden esperar turno; cuando la
+cola está llena la solicitud se rechaza de inmediato (503 + Retry-After) en lugar de
+acumular hilos y timeouts. El límite puede ajustarse solo (AIMD) según la latencia y los
+errores de saturación del upstream.
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional
+
+
+class OverloadedError(Exception):
+    """El servicio está saturado: la solicitud no puede esperar turno."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ConcurrencyGate:
+    """
+    Semáforo asíncrono con cola FIFO acotada y espera máxima.
+
+    Debe usarse desde el event loop (acquire/release no son thread-safe; desde un hilo,
+    liberar con loop.call_soon_threadsafe(gate.release)).
+    """
+
+    def __init__(self, limit: int, max_queue: int, max_wait: float, name: str = "gate"):
+        """
+        Args:
+            limit: Llamadas simultáneas permitidas
+            max_queue: Solicitudes que pueden esperar turno (más allá se rechaza al instante)
+            max_wait: Segundos máximos de espera en cola antes de rechazar
+            name: Nombre del gate para logs y métricas
+        """
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.name = name
+
+        self.active = 0
+        self._waiters: Deque["asyncio.Future"] = deque()
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+        # Media móvil del tiempo que se ocupa un turno (para estimar Retry-After)
+        self._avg_service = 0.0
+
+    @property
+    def queued(self) -> int:
+        """Solicitudes esperando turno."""
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """Segundos sugeridos al cliente antes de reintentar."""
+        if not self._avg_service:
+            return 5
+        estimate = self._avg_service * (self.queued + 1) / max(self.limit, 1)
+        return min(60, max(1, math.ceil(estimate)))
+
+    def _wake_waiters(self) -> None:
+        # Cede turnos libres a los primeros de la cola (el turno pasa directamente al waiter)
+        while self.active < self.limit and self._waiters:
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            waiter.set_result(None)
+            self.active += 1
+
+    def _record_wait(self, waited: float) -> None:
+        self.admitted += 1
+        self._total_wait += waited
+        self._max_wait_seen = max(self._max_wait_seen, waited)
+
+    async def acquire(self) -> None:
+        """
+        Espera un turno libre.
+
+        Raises:
+            OverloadedError: Si la cola está llena o la espera supera max_wait
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self._record_wait(0.0)
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise OverloadedError(
+                f"{self.name}: cola llena ({self.max_queue} en espera)",
+                retry_after=self.retry_after()
+            )
+
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout=self.max_wait)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # El turno llegó justo al cancelarse: devolverlo
+                self.release()
+            else:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise OverloadedError(
+                    f"{self.name}: sin turno tras {self.max_wait:.0f}s en cola",
+                    retry_after=self.retry_after()
+                ) from e
+            raise
+        self._record_wait(time.monotonic() - start)
+
+    def release(self, service_time: Optional[float] = None) -> None:
+        """
+        Libera un turno y lo cede al siguiente en la cola.
+
+        Args:
+            service_time: Segundos que se ocupó el turno (alimenta la estimación de Retry-After)
+        """
+        if service_time is not None:
+            self._avg_service = (
+                service_time if not self._avg_service else 0.8 * self._avg_service + 0.2 * service_time
+            )
+        self.active -= 1
+        self._wake_waiters()
+
+    def set_limit(self, limit: int) -> None:
+        """Cambia el límite de concurrencia (al subirlo despierta a los que esperan)."""
+        self.limit = limit
+        self._wake_waiters()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Context manager: adquiere un turno y lo libera al salir."""
+        await self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    def stats(self) -> Dict[str, Any]:
+        """Ocupación, cola y tiempos de espera."""
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": round(self._total_wait / self.admitted * 1000, 1) if self.admitted else 0.0,
+            "max_wait_ms": round(self._max_wait_seen * 1000, 1),
+            "avg_service_ms": round(self._avg_service * 1000, 1)
+        }
+
+
+class AdaptiveLimiter:
+    """
+    Ajusta el límite de un ConcurrencyGate con AIMD (aumento aditivo, disminución multiplicativa).
+
+    Mientras las llamadas terminan dentro de la latencia objetivo, el límite crece ~1 por cada
+    "ventana" de llamadas exitosas; ante un 429, un timeout o un pico de latencia se multiplica
+    por backoff. Las disminuciones se espacian (cooldown) para que un mismo episodio de
+    saturación, que hace fallar a todas las llamadas en curso a la vez, cuente una sola vez.
+    """
+
+    def __init__(
+        self,
+        gate: ConcurrencyGate,
+        min_limit: int,
+        max_limit: int,
+        target_latency: float,
+        backoff: float = 0.5,
+        cooldown: float = 5.0
+    ):
+        """
+        Args:
+            gate: Gate cuyo límite se ajusta
+            min_limit: Límite mínimo (nunca se baja de aquí)
+            max_limit: Límite máximo (tamaño del executor)
+            target_latency: Latencia (s) por encima de la cual una llamada cuenta como pico
+            backoff: Factor multiplicativo de disminución (0 < backoff < 1)
+            cooldown: Segundos mínimos entre dos disminuciones
+        """
+        self.gate = gate
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.cooldown = cooldown
+
+        # Límite fraccional: el gate usa la parte entera
+        self._limit = float(gate.limit)
+        self._last_decrease = float("-inf")
+
+        self.increases = 0
+        self.decreases = 0
+        self.throttled = 0
+        self.timeouts = 0
+        self.unavailable = 0
+        self.latency_spikes = 0
+
+    def _apply(self) -> None:
+        limit = int(self._limit)
+        if limit != self.gate.limit:
+            self.gate.set_limit(limit)
+
+    def on_success(self, latency: float) -> None:
+        """Registra una llamada exitosa y su latencia en segundos."""
+        if latency > self.target_latency:
+            self.latency_spikes += 1
+            self._decrease()
+            return
+        if self._limit < self.max_limit:
+            previous = int(self._limit)
+            self._limit = min(self.max_limit, self._limit + 1 / max(self._limit, 1))
+            if int(self._limit) > previous:
+                self.increases += 1
+            self._apply()
+
+    def on_failure(self, kind: str) -> None:
+        """
+        Registra una señal de saturación del upstream.
+
+        Args:
+            kind: "throttled" (429 / cuota agotada), "timeout" o "unavailable" (503)
+        """
+        if kind == "throttled":
+            self.throttled += 1
+        elif kind == "timeout":
+            self.timeouts += 1
+        elif kind == "unavailable":
+            self.unavailable += 1
+        self._decrease()
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        new_limit = max(float(self.min_limit), self._limit * self.backoff)
+        if int(new_limit) < int(self._limit):
+            self.decreases += 1
+        self._limit = new_limit
+        self._apply()
+
+    def stats(self) -> Dict[str, Any]:
+        """Límite actual y contadores de ajustes y señales de saturación."""
+        return {
+            "current_limit": self.gate.limit,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "target_latency_s": self.target_latency,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "throttled": self.throttled,
+            "timeouts": self.timeouts,
+            "unavailable": self.unavailable,
+            "latency_spikes": self.latency_spikes
+        }
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor que lleva la cuenta de sus tareas en espera y en curso.
+
+    Los contadores se mantienen en submit (también lo usa loop.run_in_executor), así las
+    métricas no dependen de atributos internos del executor de la librería estándar.
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = ""):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.max_workers = max_workers
+        self._counts_lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        def run():
+            with self._counts_lock:
+                self.queued -= 1
+                self.in_flight += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._counts_lock:
+                    self.in_flight -= 1
+                    self.completed += 1
+
+        with self._counts_lock:
+            self.queued += 1
+        try:
+            future = super().submit(run)
+        except BaseException:
+            with self._counts_lock:
+                self.queued -= 1
+            raise
+        # Una tarea cancelada antes de tomar hilo nunca ejecuta run()
+        future.add_done_callback(self._discard_if_cancelled)
+        return future
+
+    def _discard_if_cancelled(self, future: Future) -> None:
+        if future.cancelled():
+            with self._counts_lock:
+                self.queued -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Tareas esperando hilo, en ejecución y terminadas."""
+        with self._counts_lock:
+            return {
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "max_workers": self.max_workers
+            }
@@ -5,10 +5,24 @@ import os
 import logging
 import traceback
 import re
-from typing import Optional, List, Dict, Tuple
+import time
+import bisect
+import asyncio
+import hashlib
+import inspect
+import threading
+import unicodedata
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Optional, List, Dict, Tuple, Iterator
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 
+from services.cache import TTLCache
+from services.concurrency import ConcurrencyGate, AdaptiveLimiter, CountingExecutor, OverloadedError
+from services.metrics import track_upstream, GEMINI_QUEUE_WAIT, GEMINI_INPUT_TOKENS, GEMINI_TOKENS
+from services.tracing import run_in_context, span
+
 # Cargar variables de entorno
 load_dotenv()
 
@@ -16,6 +30,86 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 
+# Patrones maliciosos comunes de prompt injection (inglés y español)
+# Se evalúan sin distinguir mayúsculas/minúsculas sobre el texto normalizado a minúsculas
+MALICIOUS_PATTERNS = [
+    # Intentos de ignorar instrucciones (inglés)
+    r"ignore\s+(your|all|previous|earlier|prior)\s+(instructions?|prompts?|rules?|directives?|guidelines?)",
+    r"forget\s+(everything|all|previous|earlier|prior)",
+    r"disregard\s+(your|all|previous|earlier)\s+(instructions?|prompts?|rules?)",
+    r"override\s+(your|system|previous)\s+(instructions?|prompts?|rules?)",
+    r"ignore\s+(your|all|previous|earlier|prior)",
+    # Intentos de ignorar instrucciones (español)
+    r"ignora\s+(tus|todas|las|tus\s+instrucciones|tus\s+reglas)",
+    r"olvida\s+(todo|todas|las|tus|instrucciones)",
+    r"desobedece\s+(tus|las|instrucciones|reglas)",
+    r"anula\s+(tus|las|instrucciones|reglas)",
+    
+    # Intentos de cambiar el rol o comportamiento (inglés)
+    r"you\s+are\s+now\s+(a|an|the)",
+    r"act\s+as\s+(if\s+)?(you\s+are\s+)?(a|an|the)",
+    r"pretend\s+(to\s+be|you\s+are|that\s+you)",
+    r"roleplay\s+(as|that)",
+    # Intentos de cambiar el rol o comportamiento (español)
+    r"eres\s+ahora\s+(un|una|el|la)",
+    r"actúa\s+(como|si\s+eres|si\s+fu eras)",
+    r"finge\s+(ser|que\s+eres|que)",
+    r"hazte\s+pasar\s+por",
+    
+    # Intentos de acceso a instrucciones del sistema (inglés)
+    r"system\s*:",
+    r"system\s+prompt",
+    r"system\s+instruction",
+    r"assistant\s*:",
+    r"ai\s+instruction",
+    # Intentos de acceso a instrucciones del sistema (español)
+    r"sistema\s*:",
+    r"prompt\s+del\s+sistema",
+    r"instrucciones\s+del\s+sistema",
+    r"asistente\s*:",
+    r"muéstrame\s+(tus|las|el)\s+(instrucciones|prompt|reglas)",
+    
+    # Intentos de extraer información del sistema
+    r"show\s+(me\s+)?(your|the)\s+(instructions|prompt|system|rules)",
+    r"what\s+(are\s+)?(your|the)\s+(instructions|prompt|system|rules)",
+    r"reveal\s+(your|the)\s+(instructions|prompt|system|rules)",
+    r"print\s+(your|the)\s+(instructions|prompt|system|rules)",
+    
+    # Intentos de ejecutar comandos
+    r"(execute|run|eval|exec)\s*[:(]",
+    r"<script",
+    r"javascript\s*:",
+    
+    # Intentos de inyección de código
+    r"(import|from)\s+\w+\s+import",
+    r"__import__",
+    r"subprocess",
+]
+
+# Todos los patrones compilados una sola vez en una única alternancia: una sola pasada del
+# motor de regex por texto en lugar de ~35 llamadas a re.search
+_INJECTION_REGEX = re.compile(
+    "|".join(f"(?:{pattern})" for pattern in MALICIOUS_PATTERNS),
+    re.IGNORECASE
+)
+
+# Separador para escanear varios campos en una pasada: ningún patrón puede consumir "\x00"
+# (no es espacio, ni carácter de palabra, ni aparece como literal), así que un match nunca
+# cruza de un campo a otro
+_FIELD_SEPARATOR = "\x00"
+
+_INJECTION_ERROR = "El contenido contiene patrones no permitidos. Por favor, reformula tu solicitud."
+
+
+def _check_length(text: str, max_length: int) -> Optional[str]:
+    """Valida que el texto no esté vacío ni exceda max_length. Devuelve el error o None."""
+    if not text or not isinstance(text, str):
+        return "El texto no puede estar vacío"
+    if len(text) > max_length:
+        return f"El texto excede la longitud máxima permitida de {max_length} caracteres"
+    return None
+
+
 def sanitize_input(text: str, max_length: int = 500) -> Tuple[bool, str]:
     """
     Sanitiza y valida el input del usuario para prevenir prompt injection.
@@ -32,80 +126,73 @@ def sanitize_input(text: str, max_length: int = 500) -> Tuple[bool, str]:
         - Si es_válido es True, el texto es seguro
         - Si es_válido es False, mensaje_error contiene la razón del rechazo
     """
-    if not text or not isinstance(text, str):
-        return False, "El texto no puede estar vacío"
+    error = _check_length(text, max_length)
+    if error:
+        return False, error
     
     # Normalizar el texto (minúsculas para comparación case-insensitive)
-    text_lower = text.lower().strip()
-    
-    # Verificar longitud máxima
-    if len(text) > max_length:
-        return False, f"El texto excede la longitud máxima permitida de {max_length} caracteres"
-    
-    # Patrones maliciosos comunes de prompt injection (inglés y español)
-    malicious_patterns = [
-        # Intentos de ignorar instrucciones (inglés)
-        r"(?i)ignore\s+(your|all|previous|earlier|prior)\s+(instructions?|prompts?|rules?|directives?|guidelines?)",
-        r"(?i)forget\s+(everything|all|previous|earlier|prior)",
-        r"(?i)disregard\s+(your|all|previous|earlier)\s+(instructions?|prompts?|rules?)",
-        r"(?i)override\s+(your|system|previous)\s+(instructions?|prompts?|rules?)",
-        r"(?i)ignore\s+(your|all|previous|earlier|prior)",
-        # Intentos de ignorar instrucciones (español)
-        r"(?i)ignora\s+(tus|todas|las|tus\s+instrucciones|tus\s+reglas)",
-        r"(?i)olvida\s+(todo|todas|las|tus|instrucciones)",
-        r"(?i)desobedece\s+(tus|las|instrucciones|reglas)",
-        r"(?i)anula\s+(tus|las|instrucciones|reglas)",
-        
-        # Intentos de cambiar el rol o comportamiento (inglés)
-        r"(?i)you\s+are\s+now\s+(a|an|the)",
-        r"(?i)act\s+as\s+(if\s+)?(you\s+are\s+)?(a|an|the)",
-        r"(?i)pretend\s+(to\s+be|you\s+are|that\s+you)",
-        r"(?i)roleplay\s+(as|that)",
-        # Intentos de cambiar el rol o comportamiento (español)
-        r"(?i)eres\s+ahora\s+(un|una|el|la)",
-        r"(?i)actúa\s+(como|si\s+eres|si\s+fu eras)",
-        r"(?i)finge\s+(ser|que\s+eres|que)",
-        r"(?i)hazte\s+pasar\s+por",
-        
-        # Intentos de acceso a instrucciones del sistema (inglés)
-        r"(?i)system\s*:",
-        r"(?i)system\s+prompt",
-        r"(?i)system\s+instruction",
-        r"(?i)assistant\s*:",
-        r"(?i)ai\s+instruction",
-        # Intentos de acceso a instrucciones del sistema (español)
-        r"(?i)sistema\s*:",
-        r"(?i)prompt\s+del\s+sistema",
-        r"(?i)instrucciones\s+del\s+sistema",
-        r"(?i)asistente\s*:",
-        r"(?i)muéstrame\s+(tus|las|el)\s+(instrucciones|prompt|reglas)",
-        
-        # Intentos de extraer información del sistema
-        r"(?i)show\s+(me\s+)?(your|the)\s+(instructions|prompt|system|rules)",
-        r"(?i)what\s+(are\s+)?(your|the)\s+(instructions|prompt|system|rules)",
-        r"(?i)reveal\s+(your|the)\s+(instructions|prompt|system|rules)",
-        r"(?i)print\s+(your|the)\s+(instructions|prompt|system|rules)",
-        
-        # Intentos de ejecutar comandos
-        r"(?i)(execute|run|eval|exec)\s*[:(]",
-        r"(?i)<script",
-        r"(?i)javascript\s*:",
-        
-        # Intentos de inyección de código
-        r"(?i)(import|from)\s+\w+\s+import",
-        r"(?i)__import__",
-        r"(?i)subprocess",
-    ]
-    
-    # Verificar cada patrón
-    for pattern in malicious_patterns:
-        if re.search(pattern, text_lower):
-            logger.warning(f"⚠️  Intento de prompt injection detectado: {text[:100]}...")
-            return False, "El contenido contiene patrones no permitidos. Por favor, reformula tu solicitud."
+    if _INJECTION_REGEX.search(text.lower().strip()):
+        logger.warning(f"⚠️  Intento de prompt injection detectado: {text[:100]}...")
+        return False, _INJECTION_ERROR
     
     # Si pasa todas las validaciones, el texto es seguro
     return True, ""
 
+
+def sanitize_fields(fields: List[Tuple[str, int]]) -> List[Tuple[bool, str]]:
+    """
+    Versión por lotes de sanitize_input: valida varios textos con una sola pasada del regex.
+    
+    El resultado de cada campo es idéntico al de llamar sanitize_input(texto, max_length).
+    
+    Args:
+        fields: Lista de (texto, max_length)
+        
+    Returns:
+        List[Tuple[bool, str]]: (es_válido, mensaje_error) por cada campo, en el mismo orden
+    """
+    results: List[Tuple[bool, str]] = [(True, "")] * len(fields)
+    
+    # Textos normalizados de los campos que pasan la validación de longitud, con su offset
+    # dentro del texto combinado
+    scanned: List[Tuple[int, int]] = []  # (offset_inicial, índice_del_campo)
+    parts: List[str] = []
+    offset = 0
+    for index, (text, max_length) in enumerate(fields):
+        error = _check_length(text, max_length)
+        if error:
+            results[index] = (False, error)
+            continue
+        normalized = text.lower().strip()
+        scanned.append((offset, index))
+        parts.append(normalized)
+        offset += len(normalized) + len(_FIELD_SEPARATOR)
+    
+    if not parts:
+        return results
+    
+    combined = _FIELD_SEPARATOR.join(parts)
+    starts = [start for start, _ in scanned]
+    position = 0
+    while True:
+        match = _INJECTION_REGEX.search(combined, position)
+        if match is None:
+            break
+        
+        scanned_index = bisect.bisect_right(starts, match.start()) - 1
+        index = scanned[scanned_index][1]
+        text = fields[index][0]
+        logger.warning(f"⚠️  Intento de prompt injection detectado: {text[:100]}...")
+        results[index] = (False, _INJECTION_ERROR)
+        
+        # Basta un match por campo: continuar desde el inicio del siguiente
+        if scanned_index + 1 == len(starts):
+            break
+        position = starts[scanned_index + 1]
+    
+    return results
+
+
 # System Prompt para Gemini - Plan Inicial de Viaje
 # Instrucción de sistema para cuando el usuario solicita un plan completo de viaje
 SYSTEM_INSTRUCTION_PLAN = """Eres Alex, un experto Travel Curator con el estilo de escritura de Lonely Planet y Condé Nast Traveler. Tu misión es crear planes de viaje evocativos, personalizados y visualmente atractivos.
@@ -220,6 +307,617 @@ REGLAS DE ORO:
 8. Si detectas que estás escribiendo en otro idioma, DETENTE INMEDIATAMENTE y continúa en español.
 9. Mantén el contexto del viaje que el usuario está planificando."""
 
+# Instrucción obligatoria sobre moneda: La aplicación está dirigida a usuarios colombianos
+# Todos los costos deben estar en COP como moneda principal
+CURRENCY_RULES = (
+    "\n\n--- REGLAS DE MONEDA (OBLIGATORIO) ---\n"
+    "⚠️ TODOS los costos DEBEN estar en PESOS COLOMBIANOS (COP) como moneda PRINCIPAL.\n"
+    "• Formato obligatorio: '$150.000 COP' o '$2.500.000 COP' (usa punto como separador de miles).\n"
+    "• Para destinos internacionales, opcionalmente muestra la moneda local en paréntesis: '$450.000 COP (~$100 EUR)'.\n"
+    "• El precio en COP debe ser el DESTACADO y principal; la moneda local es solo referencia.\n"
+    "• Esto aplica a TODOS los precios: hoteles, restaurantes, entradas, transporte, actividades.\n"
+    "• La sección '💰 COSTOS' DEBE seguir esta regla estrictamente.\n"
+)
+
+# Instrucciones de sistema estáticas por variante de modelo (plan, chat de seguimiento y
+# primer mensaje del chat). Si el SDK soporta system_instruction, cada variante tiene su
+# propio modelo y el prompt de cada llamada lleva solo la parte dinámica.
+SYSTEM_INSTRUCTIONS = {
+    "plan": SYSTEM_INSTRUCTION_PLAN + CURRENCY_RULES,
+    "chat": SYSTEM_INSTRUCTION_CHAT,
+    "chat_initial": SYSTEM_INSTRUCTION_PLAN
+}
+
+# Secciones del plan en el orden canónico, con el encabezado exacto que espera
+# parseTravelPlan en el frontend
+PLAN_SECTIONS = {
+    "alojamiento": "## 🏨 ALOJAMIENTO",
+    "gastronomia": "## 🥘 GASTRONOMÍA",
+    "lugares": "## 💎 LUGARES",
+    "consejos": "## 💡 CONSEJOS",
+    "costos": "## 💰 COSTOS"
+}
+# Tokens de salida de cada llamada cuando el plan se genera por secciones
+PLAN_SECTION_MAX_OUTPUT_TOKENS = int(os.getenv("PLAN_SECTION_MAX_OUTPUT_TOKENS", "1024"))
+# Un encabezado "## ..." se reconoce por su emoji o por el nombre de la sección (con o sin tilde)
+_PLAN_SECTION_MARKERS = {
+    "alojamiento": ("🏨", "alojamiento"),
+    "gastronomia": ("🥘", "gastronomía", "gastronomia"),
+    "lugares": ("💎", "lugares"),
+    "consejos": ("💡", "consejos"),
+    "costos": ("💰", "costos")
+}
+# Pedidos de cambio sobre el plan en el chat (ver detect_plan_edit). Solo cuentan formas de
+# pedido: un "cambio" sustantivo o en primera persona ("tipo de cambio", "si cambio de fecha")
+# no es una edición. Se comparan sin tildes salvo el imperativo de usted sin pronombre, que
+# sin tilde se confunde con el pretérito ("cambie" / "cambié")
+_PLAN_EDIT_CLITICS = r"(?:me|nos|te|se|le|les|lo|la|los|las)?(?:lo|la|los|las)?"
+_PLAN_EDIT_IMPERATIVES = "cambia|reemplaza|sustituye|modifica|actualiza|ajusta|quita|elimina|agrega|anade|rehaz|pon"
+_PLAN_EDIT_FORMAL = "cambie|reemplace|sustituya|modifique|actualice|quite|elimine|agregue|añada|rehaga|ponga"
+_PLAN_EDIT_INFINITIVES = "cambiar|reemplazar|sustituir|modificar|actualizar|ajustar|quitar|eliminar|agregar|anadir|rehacer|poner"
+_PLAN_EDIT_SUBJUNCTIVES = "cambies|reemplaces|sustituyas|modifiques|actualices|quites|elimines|agregues|anadas|rehagas|pongas"
+_PLAN_EDIT_INDICATIVES = "cambias|reemplazas|sustituyes|modificas|actualizas|ajustas|quitas|eliminas|agregas|anades|rehaces|pones"
+_PLAN_EDIT_MODALS = (
+    "puedes|podrias|podes|puede|podria|quiero|quisiera|queremos|necesito|necesitamos|"
+    "prefiero|preferiria|me gustaria|nos gustaria|hay que"
+)
+# Pedidos válidos también como pregunta: "¿puedes cambiar el hotel?", "¿me cambias el hotel?",
+# "quisiera que quites el museo", "prefiero hoteles más baratos"
+_PLAN_EDIT_REQUEST = re.compile(
+    rf"\b(?:{_PLAN_EDIT_MODALS})\s+(?:\w+\s+){{0,2}}?(?:{_PLAN_EDIT_INFINITIVES}){_PLAN_EDIT_CLITICS}\b"
+    rf"|\bque\s+(?:me\s+|nos\s+)?(?:{_PLAN_EDIT_SUBJUNCTIVES})\b"
+    rf"|\b(?:me|nos)\s+(?:{_PLAN_EDIT_INDICATIVES})\b"
+    r"|\b(?:prefiero|preferiria|quiero|quisiera|busca|buscame|dame|danos|necesito)\b.*\bmas (?:barat|economic|lujos|cercan?)\w*"
+)
+# Órdenes directas (no en una pregunta): "cambia", "cámbiame", "quítalos", "cambiar el hotel"
+_PLAN_EDIT_COMMAND = re.compile(
+    rf"\b(?:{_PLAN_EDIT_IMPERATIVES}){_PLAN_EDIT_CLITICS}\b"
+    rf"|\b(?:{_PLAN_EDIT_FORMAL.replace('ñ', 'n')})(?:me|nos|lo|la|los|las|le|les)\b"
+    rf"|^\W*(?:{_PLAN_EDIT_INFINITIVES}){_PLAN_EDIT_CLITICS}\b"
+)
+_PLAN_EDIT_FORMAL_REGEX = re.compile(rf"(?<!\w)(?:{_PLAN_EDIT_FORMAL})(?!\w)")
+# Palabras que identifican la sección que se quiere cambiar
+_PLAN_EDIT_TARGETS = {
+    "alojamiento": re.compile(r"\b(hotel\w*|hostal\w*|hostel\w*|alojamiento\w*|hospedaje\w*|airbnb)\b"),
+    "gastronomia": re.compile(r"\b(restaurant\w*|comida\w*|comer|gastronom\w*|plato\w*|cenas?|almuerzos?|desayunos?)\b"),
+    "lugares": re.compile(r"\b(lugar\w*|sitio\w*|atraccion\w*|visitar|actividad\w*|tour\w*|museo\w*|playa\w*)\b"),
+    "consejos": re.compile(r"\b(consejo\w*|tips?)\b"),
+    "costos": re.compile(r"\b(costo\w*|precio\w*|gasto\w*)\b")
+}
+
+# Instrucción para plegar turnos antiguos del chat en un resumen acumulado
+SUMMARY_INSTRUCTION = """Resume en español la conversación entre un usuario y Alex, su consultor de viajes.
+Integra el resumen anterior con los turnos nuevos en un único resumen de como máximo {max_words} palabras.
+Conserva SIEMPRE lo que el usuario dijo sobre sí mismo y su viaje: fechas, presupuesto, acompañantes,
+preferencias, restricciones (alimentarias, de movilidad, etc.) y decisiones ya tomadas.
+Menciona brevemente qué recomendó Alex (lugares, hoteles, restaurantes) sin copiar el texto completo.
+Responde solo con el resumen, en viñetas cortas y sin encabezados."""
+
+GEMINI_MODEL_NAME = "gemini-2.0-flash"
+
+# Estimación de tokens sin tokenizador: ~4 caracteres por token en español
+CHARS_PER_TOKEN = 4
+# Presupuesto de tokens de entrada para el historial del chat: se conservan los mensajes más
+# recientes que quepan, de modo que el tamaño del prompt quede acotado sin importar la
+# longitud de cada mensaje
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "1500"))
+# Tope por mensaje: los más largos (un plan completo, por ejemplo) se abrevian
+CHAT_HISTORY_MESSAGE_MAX_TOKENS = int(os.getenv("CHAT_HISTORY_MESSAGE_MAX_TOKENS", "400"))
+# Costo fijo de cada mensaje en el prompt ("Usuario: " / "Alex: " y saltos de línea)
+_HISTORY_MESSAGE_OVERHEAD_TOKENS = 4
+_SECTION_HEADER_REGEX = re.compile(r"^##\s+(.+?)\s*$", re.MULTILINE)
+
+
+def estimate_tokens(text: str) -> int:
+    """Tokens aproximados de un texto (redondeando hacia arriba)."""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def elide_message(text: str, max_tokens: int) -> str:
+    """
+    Abrevia un mensaje del historial para que no supere max_tokens.
+
+    Conserva el comienzo del mensaje y, si es un plan con secciones "## ...", agrega una nota
+    con los títulos de las secciones omitidas para que el modelo sepa qué se habló.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+
+    headers = list(dict.fromkeys(_SECTION_HEADER_REGEX.findall(text)))
+    note = f"\n[Mensaje anterior abreviado: {len(text)} caracteres"
+    if headers:
+        note += f"; secciones: {', '.join(headers)}"
+    note += "]"
+    if len(note) > max_chars // 2:
+        note = f"\n[Mensaje anterior abreviado: {len(text)} caracteres]"
+
+    head = text[:max(0, max_chars - len(note) - 1)]
+    # Cortar en el último espacio para no dejar palabras partidas
+    cut = head.rfind(" ")
+    if cut > len(head) // 2:
+        head = head[:cut]
+    return f"{head.rstrip()}…{note}"
+
+
+def trim_history(
+    history: Optional[List[Dict]],
+    budget_tokens: Optional[int] = None,
+    max_message_tokens: Optional[int] = None
+) -> List[Dict]:
+    """
+    Recorta el historial del chat a un presupuesto de tokens.
+
+    Recorre los mensajes del más reciente al más antiguo, abrevia los que superan el tope por
+    mensaje (ver elide_message) y se detiene en el primero que ya no cabe. El mensaje más
+    reciente siempre se conserva. Aplicarlo dos veces no cambia el resultado.
+
+    Args:
+        history: Mensajes en formato [{"role": "user", "parts": "..."}, ...]
+        budget_tokens: Presupuesto total (por defecto CHAT_HISTORY_TOKEN_BUDGET)
+        max_message_tokens: Tope por mensaje (por defecto CHAT_HISTORY_MESSAGE_MAX_TOKENS)
+
+    Returns:
+        List[Dict]: Los mensajes conservados, en orden cronológico
+    """
+    if not history:
+        return []
+    budget = CHAT_HISTORY_TOKEN_BUDGET if budget_tokens is None else budget_tokens
+    per_message = CHAT_HISTORY_MESSAGE_MAX_TOKENS if max_message_tokens is None else max_message_tokens
+    per_message = max(1, min(per_message, budget - _HISTORY_MESSAGE_OVERHEAD_TOKENS))
+
+    kept: List[Dict] = []
+    used = 0
+    for msg in reversed(history):
+        parts = str(msg.get("parts", ""))
+        text = elide_message(parts, per_message)
+        cost = estimate_tokens(text) + _HISTORY_MESSAGE_OVERHEAD_TOKENS
+        if kept and used + cost > budget:
+            break
+        kept.append(msg if text == parts else {**msg, "parts": text})
+        used += cost
+    kept.reverse()
+    return kept
+
+
+def build_plan_prompt(
+    destination: str,
+    date: str = "",
+    budget: str = "",
+    style: str = "",
+    inline_instructions: bool = True
+) -> Tuple[str, str]:
+    """
+    Construye el prompt completo para un plan de viaje a partir de los campos ya normalizados.
+
+    Args:
+        destination: El destino del viaje
+        date: La fecha del viaje (opcional)
+        budget: El presupuesto del viaje (opcional)
+        style: El estilo de viaje (opcional)
+        inline_instructions: Incluir la instrucción de sistema y las reglas de moneda en el
+            prompt (False si el modelo ya las tiene como system_instruction)
+
+    Returns:
+        Tuple[str, str]: (prompt_completo, solicitud_del_usuario)
+    """
+    # Construir el prompt combinando los 4 campos en una frase coherente
+    prompt_parts = [f"Planifica un viaje a {destination}"]
+
+    if date:
+        prompt_parts.append(f"para la fecha {date}")
+
+    if budget:
+        prompt_parts.append(f"con presupuesto {budget}")
+
+    if style:
+        prompt_parts.append(f"y estilo {style}")
+
+    # Combinar todas las partes en una frase coherente
+    user_request = " ".join(prompt_parts) + "."
+
+    # Construir contexto destacado de presupuesto y estilo para que Gemini los referencia explícitamente
+    context_highlight = ""
+    if budget or style:
+        context_highlight = "\n\n--- CONTEXTO DEL USUARIO (REFERENCIA ESTO EN CADA RECOMENDACIÓN) ---\n"
+        if budget:
+            context_highlight += f"• Presupuesto del usuario: {budget}\n"
+            context_highlight += "  → IMPORTANTE: En cada recomendación, explica POR QUÉ es perfecta para este presupuesto.\n"
+        if style:
+            context_highlight += f"• Estilo de viaje del usuario: {style}\n"
+            context_highlight += "  → IMPORTANTE: En cada recomendación, conecta la experiencia con este estilo de viaje.\n"
+        context_highlight += "\nEjemplo de cómo referenciar: 'Perfecto para tu presupuesto de mochilero porque...' o 'Ideal para tu estilo cultural ya que...'\n"
+
+    if not inline_instructions:
+        # La instrucción de sistema y las reglas de moneda ya están en el modelo
+        if context_highlight:
+            return f"{context_highlight.strip()}\n\n---\n\nSolicitud del usuario: {user_request}", user_request
+        return f"Solicitud del usuario: {user_request}", user_request
+
+    # Construir el prompt completo incluyendo el system instruction para PLAN
+    # La instrucción de sistema se inyecta antes de la pregunta del usuario
+    full_prompt = f"{SYSTEM_INSTRUCTION_PLAN}{context_highlight}{CURRENCY_RULES}\n\n---\n\nSolicitud del usuario: {user_request}"
+    return full_prompt, user_request
+
+
+def parse_plan_section_groups(spec: str) -> List[List[str]]:
+    """
+    Interpreta la agrupación de secciones para generar el plan en paralelo.
+
+    Formato: grupos separados por comas y secciones de un mismo grupo unidas con "+", p. ej.
+    "alojamiento+gastronomia,lugares,consejos+costos". Cada sección debe aparecer una vez.
+
+    Raises:
+        ValueError: Si falta una sección, se repite o no existe
+    """
+    groups = [[key.strip().lower() for key in group.split("+") if key.strip()] for group in spec.split(",")]
+    groups = [group for group in groups if group]
+    keys = [key for group in groups for key in group]
+    if sorted(keys) != sorted(PLAN_SECTIONS):
+        raise ValueError(f"Agrupación de secciones inválida: '{spec}'")
+    # Los grupos se ordenan por su primera sección para que el primero lleve la introducción
+    order = list(PLAN_SECTIONS)
+    return sorted(groups, key=lambda group: min(order.index(key) for key in group))
+
+
+def build_section_prompt(
+    destination: str,
+    date: str,
+    budget: str,
+    style: str,
+    sections: List[str],
+    include_intro: bool,
+    inline_instructions: bool = True,
+    current_sections: Optional[Dict[str, str]] = None,
+    instruction: str = ""
+) -> str:
+    """
+    Prompt del plan limitado a algunas secciones (generación por secciones en paralelo).
+
+    Usa el mismo prompt que build_plan_prompt (y la misma instrucción de sistema, así todas
+    las llamadas comparten el modelo "plan") más una indicación del alcance de la respuesta.
+    Con current_sections e instruction es una edición: se reescriben esas secciones del plan
+    existente aplicando el cambio que pidió el usuario.
+    """
+    base_prompt, _ = build_plan_prompt(destination, date, budget, style, inline_instructions=inline_instructions)
+    headers = ", ".join(f"'{PLAN_SECTIONS[key]}'" for key in sections)
+    if current_sections:
+        current = "\n\n".join(
+            f"{PLAN_SECTIONS[key]}\n\n{current_sections[key]}" for key in sections if key in current_sections
+        )
+        base_prompt += (
+            f"\n\n--- VERSIÓN ACTUAL DE ESTAS SECCIONES ---\n{current}"
+            f"\n\n--- CAMBIO PEDIDO POR EL USUARIO ---\n{instruction}"
+        )
+        scope = (
+            f"Reescribe ÚNICAMENTE estas secciones aplicando el cambio pedido, en este orden y con estos "
+            f"encabezados exactos: {headers}. Conserva el formato y lo que el usuario no pidió cambiar."
+        )
+    else:
+        scope = f"Escribe ÚNICAMENTE estas secciones, en este orden y con estos encabezados exactos: {headers}."
+    if include_intro:
+        scope += " Antes de la primera sección incluye el mensaje introductorio obligatorio."
+    else:
+        scope += f" No escribas introducción: empieza directamente con '{PLAN_SECTIONS[sections[0]]}'."
+    scope += " No escribas ninguna otra sección ni una conclusión (las demás secciones se generan aparte)."
+    return f"{base_prompt}\n\n--- ALCANCE DE ESTA RESPUESTA ---\n{scope}"
+
+
+def _plan_section_key(line: str) -> Optional[str]:
+    """Clave de la sección si line es uno de sus encabezados "## ..." (None si no lo es)."""
+    if not line.startswith("##"):
+        return None
+    lowered = line.lower()
+    for key, markers in _PLAN_SECTION_MARKERS.items():
+        if any(marker in lowered for marker in markers):
+            return key
+    return None
+
+
+def split_plan_sections(text: str) -> Tuple[str, Dict[str, str]]:
+    """
+    Separa un plan en introducción y contenido de cada sección (sin el encabezado).
+
+    Returns:
+        Tuple[str, Dict[str, str]]: (introducción, {clave_de_sección: contenido}) con solo las
+        secciones encontradas
+    """
+    intro_lines: List[str] = []
+    sections: Dict[str, List[str]] = {}
+    current: Optional[List[str]] = intro_lines
+    for line in text.splitlines():
+        key = _plan_section_key(line.strip())
+        if key is not None:
+            # Una sección repetida se ignora (se conserva la primera)
+            current = sections.setdefault(key, []) if key not in sections else None
+            continue
+        if current is not None:
+            current.append(line)
+    return "\n".join(intro_lines).strip(), {key: "\n".join(lines).strip() for key, lines in sections.items()}
+
+
+def assemble_plan(intro: str, sections: Dict[str, str]) -> str:
+    """Arma el plan en el orden canónico con los encabezados exactos de PLAN_SECTIONS."""
+    parts = [intro.strip()] if intro.strip() else []
+    for key, header in PLAN_SECTIONS.items():
+        if key in sections:
+            parts.append(f"{header}\n\n{sections[key].strip()}")
+    return "\n\n".join(parts)
+
+
+def _strip_accents(text: str) -> str:
+    """Minúsculas y sin tildes (la ñ queda como n) para comparar palabras clave."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def detect_plan_edit(message: str) -> List[str]:
+    """
+    Secciones del plan que un mensaje del chat pide cambiar ("cambia los hoteles por algo
+    más barato" -> ["alojamiento"]).
+
+    El mensaje tiene que ser un pedido (imperativo, "¿puedes cambiar...?", "quisiera que
+    quites...") y nombrar una sección. En una pregunta solo cuentan los pedidos explícitos:
+    "¿cuál es el tipo de cambio para los costos?" se responde normal.
+
+    Returns:
+        List[str]: Claves de PLAN_SECTIONS en orden canónico; vacía si el mensaje no es un
+        pedido de cambio, no nombra ninguna sección o las nombra todas (se responde normal)
+    """
+    text = _strip_accents(message)
+    requested = bool(_PLAN_EDIT_REQUEST.search(text))
+    if not requested and "?" not in message:
+        requested = bool(_PLAN_EDIT_COMMAND.search(text) or _PLAN_EDIT_FORMAL_REGEX.search(message.lower()))
+    if not requested:
+        return []
+    targets = [key for key, regex in _PLAN_EDIT_TARGETS.items() if regex.search(text)]
+    return targets if len(targets) < len(PLAN_SECTIONS) else []
+
+
+def build_chat_prompt(
+    destination: str,
+    date: str = "",
+    budget: str = "",
+    style: str = "",
+    message: str = "",
+    history: Optional[List[Dict]] = None,
+    inline_instructions: bool = True,
+    summary: str = ""
+) -> Tuple[str, int]:
+    """
+    Construye el prompt de chat con el contexto del viaje y el historial de conversación.
+
+    Con historial usa SYSTEM_INSTRUCTION_CHAT y los mensajes más recientes que quepan en el
+    presupuesto de tokens (ver trim_history); sin historial es una solicitud inicial y usa
+    SYSTEM_INSTRUCTION_PLAN. El resumen de los turnos anteriores, si existe, va antes del
+    historial y se descuenta del mismo presupuesto.
+
+    Args:
+        destination: El destino del viaje
+        date: La fecha del viaje (opcional)
+        budget: El presupuesto del viaje (opcional)
+        style: El estilo de viaje (opcional)
+        message: El nuevo mensaje del usuario
+        history: Mensajes anteriores en formato [{"role": "user", "parts": "..."}, ...]
+        inline_instructions: Incluir la instrucción de sistema en el prompt (False si el
+            modelo ya la tiene; ver chat_instruction_variant)
+        summary: Resumen acumulado de los turnos ya plegados (ver services/chat_summary.py)
+
+    Returns:
+        Tuple[str, int]: (prompt_completo, mensajes_del_historial_incluidos)
+    """
+    # Construir el contexto del viaje
+    context_info = f"Contexto del viaje: Destino: {destination}"
+    if date:
+        context_info += f", Fecha: {date}"
+    if budget:
+        context_info += f", Presupuesto: {budget}"
+    if style:
+        context_info += f", Estilo: {style}"
+
+    if history or summary:
+        # Gestión de Historial: solo los mensajes recientes que quepan en el presupuesto de tokens
+        # (descontando lo que ocupa el resumen)
+        limited_history = trim_history(
+            history, budget_tokens=CHAT_HISTORY_TOKEN_BUDGET - estimate_tokens(summary)
+        ) if summary else trim_history(history)
+
+        # Construir el historial como texto para el contexto
+        history_lines = ["\n\n--- Historial de Conversación ---\n\n"]
+        if summary:
+            history_lines.insert(0, f"\n\n--- Resumen de la Conversación Anterior ---\n\n{summary}")
+        for msg in limited_history:
+            role_label = "Usuario" if msg.get("role") == "user" else "Alex"
+            history_lines.append(f"{role_label}: {msg.get('parts', '')}\n\n")
+        history_text = "".join(history_lines)
+
+        # Para preguntas de seguimiento, usa la instrucción conversacional
+        full_prompt = f"{context_info}\n\n{history_text}---\n\nUsuario pregunta ahora: {message}"
+        if inline_instructions:
+            full_prompt = f"{SYSTEM_INSTRUCTION_CHAT}\n\n---\n\n{full_prompt}"
+        return full_prompt, len(limited_history)
+
+    # Si no hay historial, es el primer mensaje - usar SYSTEM_INSTRUCTION_PLAN
+    prompt_parts = [f"Planifica un viaje a {destination}"]
+    if date:
+        prompt_parts.append(f"para la fecha {date}")
+    if budget:
+        prompt_parts.append(f"con presupuesto {budget}")
+    if style:
+        prompt_parts.append(f"y estilo {style}")
+
+    user_request = " ".join(prompt_parts) + "."
+    full_prompt = f"{context_info}\n\nSolicitud del usuario: {user_request}"
+    if inline_instructions:
+        full_prompt = f"{SYSTEM_INSTRUCTION_PLAN}\n\n---\n\n{full_prompt}"
+    return full_prompt, 0
+
+
+def chat_instruction_variant(history: Optional[List[Dict]], summary: str = "") -> str:
+    """Variante de instrucción de sistema del chat: seguimiento con historial o mensaje inicial."""
+    return "chat" if history or summary else "chat_initial"
+
+
+def build_summary_prompt(previous_summary: str, messages: List[Dict], max_words: int) -> str:
+    """
+    Construye el prompt que pliega turnos antiguos del chat en el resumen acumulado.
+
+    Args:
+        previous_summary: Resumen anterior ("" si es el primero)
+        messages: Turnos a plegar, en orden cronológico
+        max_words: Extensión máxima del nuevo resumen
+
+    Returns:
+        str: Prompt completo (con su instrucción)
+    """
+    lines = []
+    for msg in messages:
+        role_label = "Usuario" if msg.get("role") == "user" else "Alex"
+        # Los planes completos se abrevian igual que en el historial del chat
+        lines.append(f"{role_label}: {elide_message(str(msg.get('parts', '')), CHAT_HISTORY_MESSAGE_MAX_TOKENS)}")
+    conversation = "\n\n".join(lines)
+    previous = previous_summary or "(sin resumen previo)"
+    return (
+        f"{SUMMARY_INSTRUCTION.format(max_words=max_words)}\n\n---\n\n"
+        f"Resumen anterior:\n{previous}\n\n---\n\nTurnos nuevos:\n\n{conversation}"
+    )
+
+
+def supports_system_instruction() -> bool:
+    """True si el SDK instalado acepta system_instruction (google-generativeai >= 0.5)."""
+    try:
+        return "system_instruction" in inspect.signature(genai.GenerativeModel.__init__).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def supports_context_cache() -> bool:
+    """True si el SDK instalado soporta caché de contexto (google-generativeai >= 0.7)."""
+    return hasattr(genai, "caching") and hasattr(genai.GenerativeModel, "from_cached_content")
+
+
+def extract_usage(response) -> Dict[str, int]:
+    """
+    Tokens reportados por Gemini en usage_metadata (vacío si el SDK no los expone).
+
+    Returns:
+        Dict[str, int]: Claves "input", "cached" y "output" presentes según lo reportado
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return {}
+    counts = {}
+    for key, attribute in (
+        ("input", "prompt_token_count"),
+        ("cached", "cached_content_token_count"),
+        ("output", "candidates_token_count")
+    ):
+        value = getattr(usage, attribute, None)
+        if isinstance(value, int):
+            counts[key] = value
+    return counts
+
+
+def extract_finish_reason(response) -> str:
+    """
+    Extrae y normaliza el finish_reason de una respuesta de Gemini.
+
+    Maneja los distintos tipos que puede devolver el SDK (enum, string, número) y los
+    normaliza a "STOP", "MAX_TOKENS", "SAFETY" o "RECITATION".
+
+    Args:
+        response: Respuesta de generate_content (normal o en streaming ya consumida)
+
+    Returns:
+        str: finish_reason normalizado ("STOP" por defecto)
+    """
+    finish_reason = "STOP"  # Valor por defecto
+    if hasattr(response, 'candidates') and response.candidates:
+        candidate = response.candidates[0]
+        if hasattr(candidate, 'finish_reason'):
+            finish_reason_raw = candidate.finish_reason
+            # Manejar diferentes tipos de finish_reason (enum, string, número)
+            if finish_reason_raw is None:
+                finish_reason = "STOP"
+            elif hasattr(finish_reason_raw, 'name'):  # Es un enum
+                finish_reason = finish_reason_raw.name
+            elif hasattr(finish_reason_raw, 'value'):  # Es un enum con value
+                finish_reason = str(finish_reason_raw.value)
+            else:
+                finish_reason = str(finish_reason_raw)
+
+            # Normalizar valores comunes
+            finish_reason_upper = finish_reason.upper()
+            if "STOP" in finish_reason_upper or finish_reason == "1" or finish_reason == 1:
+                finish_reason = "STOP"
+            elif "MAX_TOKENS" in finish_reason_upper or "LENGTH" in finish_reason_upper or finish_reason == "2" or finish_reason == 2:
+                finish_reason = "MAX_TOKENS"
+            elif "SAFETY" in finish_reason_upper or finish_reason == "3" or finish_reason == 3:
+                finish_reason = "SAFETY"
+            elif "RECITATION" in finish_reason_upper or finish_reason == "4" or finish_reason == 4:
+                finish_reason = "RECITATION"
+    return finish_reason
+
+
+# Huella del template del prompt de plan: si cambian las instrucciones o las reglas de moneda,
+# las entradas de la caché generadas con el template anterior dejan de coincidir
+PLAN_PROMPT_VERSION = hashlib.sha256(
+    build_plan_prompt("{destination}", "{date}", "{budget}", "{style}")[0].encode("utf-8")
+).hexdigest()[:16]
+
+
+def classify_gemini_error(exc: BaseException) -> Optional[str]:
+    """
+    Clasifica un error de Gemini como señal de saturación del upstream.
+    
+    Recorre la cadena de causas (los métodos del servicio re-lanzan con "from e").
+    
+    Returns:
+        Optional[str]: "throttled" (429), "timeout", "unavailable" (503) o None si el error
+        no indica saturación (validación, respuesta vacía, etc.)
+    """
+    current: Optional[BaseException] = exc
+    while current is not None:
+        if isinstance(current, google_exceptions.TooManyRequests):
+            return "throttled"
+        if isinstance(current, (google_exceptions.DeadlineExceeded, google_exceptions.GatewayTimeout, TimeoutError)):
+            return "timeout"
+        if isinstance(current, google_exceptions.ServiceUnavailable):
+            return "unavailable"
+        current = current.__cause__
+    return None
+
+
+def _normalize_cache_field(value: str) -> str:
+    """Normaliza un campo para la clave de caché (minúsculas y espacios colapsados)."""
+    return " ".join(value.split()).lower() if value else ""
+
+
+def plan_cache_key(
+    destination: str,
+    date: str,
+    budget: str,
+    style: str,
+    user_currency: str
+) -> Tuple[str, ...]:
+    """
+    Construye la clave de caché de un plan a partir de los campos de la solicitud.
+
+    Dos solicitudes con la misma clave producen exactamente el mismo prompt (salvo
+    mayúsculas/espacios), por lo que pueden compartir la respuesta de Gemini. Todos los campos
+    son obligatorios: un default distinto del de la API (user_currency="USD") haría que quien
+    lo omita busque bajo otra clave que la que guardó /api/plan. Una moneda vacía cuenta como
+    COP, igual que en el prompt.
+    """
+    return (
+        PLAN_PROMPT_VERSION,
+        _normalize_cache_field(destination),
+        _normalize_cache_field(date),
+        _normalize_cache_field(budget),
+        _normalize_cache_field(style),
+        _normalize_cache_field(user_currency) or "cop"
+    )
+
 
 class GeminiService:
     """Servicio para interactuar con Google Gemini API."""
@@ -257,15 +955,576 @@ class GeminiService:
                 "temperature": 0.7
             }
             
+            self.generation_config = generation_config
             self.model = genai.GenerativeModel(
-                model_name='gemini-2.0-flash',
+                model_name=GEMINI_MODEL_NAME,
                 generation_config=generation_config
             )
-            logger.info("✅ Servicio de Gemini inicializado correctamente con gemini-2.0-flash")
+            
+            # Un modelo por variante de instrucción de sistema, construidos una sola vez: las
+            # instrucciones estáticas (~5 KB) dejan de concatenarse en cada prompt
+            self.instruction_models: Dict[str, Any] = {}
+            if supports_system_instruction():
+                for variant, instruction in SYSTEM_INSTRUCTIONS.items():
+                    self.instruction_models[variant] = genai.GenerativeModel(
+                        model_name=GEMINI_MODEL_NAME,
+                        generation_config=generation_config,
+                        system_instruction=instruction
+                    )
+                logger.info(f"🧩 Instrucciones de sistema en el modelo ({', '.join(self.instruction_models)})")
+            else:
+                logger.info("ℹ️  El SDK de Gemini no soporta system_instruction: las instrucciones van en el prompt")
+            logger.info(f"✅ Servicio de Gemini inicializado correctamente con {GEMINI_MODEL_NAME}")
             logger.info("⚙️  Configuración: max_output_tokens=2048, temperature=0.7")
         except Exception as e:
             logger.error(f"❌ Error al inicializar el modelo de Gemini: {e}")
             raise
+        
+        # Caché de contexto de las instrucciones de sistema (se crea al primer uso de cada
+        # variante y se renueva antes de expirar). La API exige un tamaño mínimo de contenido
+        # cacheado: si rechaza una variante, esa variante sigue con system_instruction.
+        self.context_cache_enabled = (
+            os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() in ("1", "true", "yes")
+            and bool(self.instruction_models)
+        )
+        if self.context_cache_enabled and not supports_context_cache():
+            logger.warning("⚠️  GEMINI_CONTEXT_CACHE=true pero el SDK de Gemini no soporta caché de contexto")
+            self.context_cache_enabled = False
+        self.context_cache_ttl = float(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+        self._cached_models: Dict[str, Tuple[Any, float]] = {}
+        self._context_cache_failed: set = set()
+        self._context_cache_lock = threading.Lock()
+        
+        # Modo de generación de planes: "single" (una llamada) o "sections" (una llamada por
+        # grupo de secciones, en paralelo; la latencia es la del grupo más lento)
+        self.plan_mode = os.getenv("GEMINI_PLAN_MODE", "single").strip().lower()
+        if self.plan_mode not in ("single", "sections"):
+            logger.warning(f"⚠️  GEMINI_PLAN_MODE desconocido '{self.plan_mode}'. Usando 'single'.")
+            self.plan_mode = "single"
+        groups_spec = os.getenv("GEMINI_PLAN_SECTION_GROUPS", ",".join(PLAN_SECTIONS))
+        try:
+            self.plan_section_groups = parse_plan_section_groups(groups_spec)
+        except ValueError as e:
+            logger.warning(f"⚠️  {e}. Usando una llamada por sección.")
+            self.plan_section_groups = [[key] for key in PLAN_SECTIONS]
+        if self.plan_mode == "sections":
+            logger.info(f"🧩 Planes por secciones en paralelo: {' | '.join('+'.join(group) for group in self.plan_section_groups)}")
+        # Ediciones del plan desde el chat: solo se regenera la sección que el usuario pide cambiar
+        self.plan_edits_enabled = os.getenv("CHAT_PLAN_EDITS", "true").lower() == "true"
+        
+        # Caché de planes completos: solicitudes idénticas no vuelven a llamar a Gemini
+        # PLAN_CACHE_TTL_SECONDS=0 desactiva la caché
+        self.plan_cache = TTLCache(
+            ttl_seconds=float(os.getenv("PLAN_CACHE_TTL_SECONDS", "3600")),
+            max_entries=int(os.getenv("PLAN_CACHE_MAX_ENTRIES", "256")),
+            max_bytes=int(os.getenv("PLAN_CACHE_MAX_BYTES", str(8 * 1024 * 1024))),
+            name="plan_cache"
+        )
+        logger.info(
+            f"⚙️  Caché de planes: ttl={self.plan_cache.ttl_seconds}s, "
+            f"max_entries={self.plan_cache.max_entries}, max_bytes={self.plan_cache.max_bytes}"
+        )
+        
+        # Llamadas a Gemini en un executor propio (no compiten con el executor por defecto) y
+        # acotadas por un gate: como máximo GEMINI_MAX_CONCURRENCY en curso y GEMINI_MAX_QUEUE
+        # esperando; el resto se rechaza con 503 en lugar de acumular hilos y timeouts
+        max_concurrency = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+        adaptive = os.getenv("GEMINI_ADAPTIVE_CONCURRENCY", "true").lower() == "true"
+        min_concurrency = max(1, min(int(os.getenv("GEMINI_MIN_CONCURRENCY", "1")), max_concurrency))
+        # En modo por secciones cada turno del gate lanza una llamada por grupo en paralelo
+        calls_per_slot = len(self.plan_section_groups) if self.plan_mode == "sections" else 1
+        self.executor = CountingExecutor(max_workers=max_concurrency * calls_per_slot, thread_name_prefix="gemini")
+        self.gate = ConcurrencyGate(
+            # Con límite adaptativo se arranca a la mitad y se crece mientras Gemini responda bien
+            limit=max(min_concurrency, max_concurrency // 2) if adaptive else max_concurrency,
+            max_queue=int(os.getenv("GEMINI_MAX_QUEUE", "32")),
+            max_wait=float(os.getenv("GEMINI_QUEUE_TIMEOUT_SECONDS", "20")),
+            name="gemini"
+        )
+        self.limiter: Optional[AdaptiveLimiter] = None
+        if adaptive:
+            self.limiter = AdaptiveLimiter(
+                self.gate,
+                min_limit=min_concurrency,
+                max_limit=max_concurrency,
+                target_latency=float(os.getenv("GEMINI_TARGET_LATENCY_SECONDS", "30"))
+            )
+        logger.info(
+            f"⚙️  Concurrencia de Gemini: {self.gate.limit} en curso"
+            + (f" (adaptativa {min_concurrency}-{max_concurrency})" if adaptive else "")
+            + f", cola máxima {self.gate.max_queue} ({self.gate.max_wait:.0f}s de espera)"
+        )
+    
+    def _model_for(self, variant: str) -> Tuple[Any, bool]:
+        """
+        Modelo a usar para una variante de instrucción de sistema.
+        
+        Returns:
+            Tuple[Any, bool]: (modelo, instrucciones_en_el_modelo). Si es False, el prompt debe
+            incluir la instrucción de sistema.
+        """
+        model = self.instruction_models.get(variant)
+        if model is None:
+            return self.model, False
+        if self.context_cache_enabled and variant not in self._context_cache_failed:
+            cached_model = self._cached_model(variant)
+            if cached_model is not None:
+                return cached_model, True
+        return model, True
+    
+    def _cached_model(self, variant: str) -> Optional[Any]:
+        """Modelo sobre la caché de contexto de la variante, creándola o renovándola si hace falta."""
+        with self._context_cache_lock:
+            now = time.monotonic()
+            entry = self._cached_models.get(variant)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+            try:
+                cached_content = genai.caching.CachedContent.create(
+                    model=f"models/{GEMINI_MODEL_NAME}",
+                    display_name=f"viajeia-{variant}",
+                    system_instruction=SYSTEM_INSTRUCTIONS[variant],
+                    ttl=timedelta(seconds=self.context_cache_ttl)
+                )
+                model = genai.GenerativeModel.from_cached_content(
+                    cached_content=cached_content,
+                    generation_config=self.generation_config
+                )
+            except Exception as e:
+                logger.warning(f"⚠️  Caché de contexto no disponible para '{variant}' (se usa system_instruction): {type(e).__name__}: {e}")
+                self._context_cache_failed.add(variant)
+                return None
+            # Renovar antes de que el contenido expire en el servidor
+            self._cached_models[variant] = (model, now + self.context_cache_ttl * 0.9)
+            logger.info(f"🗄️  Caché de contexto creada para '{variant}' (ttl={self.context_cache_ttl:.0f}s)")
+            return model
+    
+    def _record_usage(self, endpoint: str, response, prompt: str, variant: str, in_model: bool) -> None:
+        """Registra los tokens de entrada de una llamada (reportados o estimados por longitud)."""
+        usage = extract_usage(response)
+        if "input" in usage:
+            GEMINI_INPUT_TOKENS.labels(endpoint=endpoint, source="reported").observe(usage["input"])
+            for kind, count in usage.items():
+                GEMINI_TOKENS.labels(endpoint=endpoint, kind=kind).inc(count)
+            logger.info(
+                f"🔢 Tokens ({endpoint}): entrada={usage['input']}"
+                f" (en caché={usage.get('cached', 0)}), salida={usage.get('output', 'N/A')}"
+            )
+            return
+        # Sin usage_metadata: ~4 caracteres por token en español. La instrucción de sistema
+        # también se factura como entrada aunque vaya en el modelo
+        chars = len(prompt) + (len(SYSTEM_INSTRUCTIONS[variant]) if in_model else 0)
+        estimated = chars // CHARS_PER_TOKEN
+        GEMINI_INPUT_TOKENS.labels(endpoint=endpoint, source="estimated").observe(estimated)
+        logger.info(f"🔢 Tokens ({endpoint}): entrada≈{estimated} estimados ({chars} caracteres)")
+    
+    async def run_bounded(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Ejecuta una llamada síncrona a Gemini en el executor dedicado, respetando el gate.
+        
+        La latencia y los errores de saturación (429, timeouts) alimentan el límite adaptativo.
+        
+        Raises:
+            OverloadedError: Si no hay turno (cola llena o espera excesiva)
+        """
+        return await self._in_slot(lambda submit: submit(func, *args, **kwargs))
+    
+    async def _in_slot(self, call: Callable[[Callable[..., "asyncio.Future"]], Awaitable[Any]]) -> Any:
+        """
+        Ejecuta call(submit) con un turno del gate e informa su resultado al límite adaptativo.
+        
+        submit(func, *args, **kwargs) corre func en el executor dedicado. El turno se conserva
+        hasta que terminan todos los hilos lanzados con submit, aunque quien espera se cancele
+        (cliente desconectado, timeout) o call falle antes: un hilo que sigue llamando a Gemini
+        ocupa su turno y las llamadas reales nunca superan el límite del gate.
+        
+        Raises:
+            OverloadedError: Si no hay turno (cola llena o espera excesiva)
+        """
+        loop = asyncio.get_running_loop()
+        queued_at = time.monotonic()
+        with span("gemini_queue"):
+            await self.gate.acquire()
+        start = time.monotonic()
+        GEMINI_QUEUE_WAIT.observe(start - queued_at)
+        state = {"threads": 0, "finished": False, "released": False}
+        
+        def release_if_idle():
+            if state["finished"] and not state["threads"] and not state["released"]:
+                state["released"] = True
+                self.gate.release(time.monotonic() - start)
+        
+        def thread_finished():
+            state["threads"] -= 1
+            release_if_idle()
+        
+        def on_thread_done(_):
+            # Corre en el hilo del executor (o en el loop si se canceló antes de empezar)
+            try:
+                loop.call_soon_threadsafe(thread_finished)
+            except RuntimeError:
+                pass  # Loop cerrado al apagar: ya no hay turnos que liberar
+        
+        def submit(func: Callable[..., Any], *args, **kwargs) -> "asyncio.Future":
+            future = self.executor.submit(run_in_context(func, *args, **kwargs))
+            state["threads"] += 1
+            future.add_done_callback(on_thread_done)
+            return asyncio.wrap_future(future)
+        
+        try:
+            with span("gemini_api"):
+                result = await call(submit)
+        except Exception as e:
+            self.report_outcome(time.monotonic() - start, e)
+            raise
+        else:
+            self.report_outcome(time.monotonic() - start)
+            return result
+        finally:
+            state["finished"] = True
+            release_if_idle()
+    
+    async def stream_bounded(self, produce: Callable[[], None], admitted: "asyncio.Future") -> None:
+        """
+        Ejecuta produce (que consume un stream síncrono de Gemini) en el executor con un turno del gate.
+        
+        admitted se resuelve al obtener el turno, para que el endpoint pueda responder 503 antes
+        de abrir el stream. El turno cuenta en la espera y el tiempo de servicio del gate igual
+        que run_bounded, y se conserva hasta que produce termina.
+        
+        Raises:
+            OverloadedError: Si no hay turno (cola llena o espera excesiva)
+        """
+        async def call(submit):
+            if not admitted.done():
+                admitted.set_result(None)
+            return await submit(produce)
+        
+        await self._in_slot(call)
+    
+    def report_outcome(self, latency: float, error: Optional[BaseException] = None) -> None:
+        """
+        Alimenta el límite adaptativo con el resultado de una llamada que ocupó un turno del gate.
+        
+        Debe llamarse desde el event loop.
+        
+        Args:
+            latency: Duración de la llamada en segundos
+            error: Excepción de la llamada (None si terminó bien); solo cuentan las de saturación
+        """
+        if not self.limiter:
+            return
+        if error is None:
+            self.limiter.on_success(latency)
+            return
+        kind = classify_gemini_error(error)
+        if kind:
+            self.limiter.on_failure(kind)
+            logger.warning(f"🚦 Señal de saturación de Gemini ({kind}): límite {self.gate.limit}")
+    
+    def concurrency_stats(self) -> Dict:
+        """Estado del gate de Gemini y, si está activo, del límite adaptativo."""
+        return {
+            **self.gate.stats(),
+            "adaptive": self.limiter.stats() if self.limiter else None
+        }
+    
+    def executor_stats(self) -> Dict:
+        """Llamadas a Gemini esperando hilo y en curso en el executor dedicado."""
+        return self.executor.stats()
+    
+    async def generate_travel_recommendation_async(
+        self,
+        destination: str,
+        date: str = "",
+        budget: str = "",
+        style: str = "",
+        user_currency: str = "COP",
+        check_cache: bool = True
+    ) -> Tuple[str, str]:
+        """
+        Versión async de generate_travel_recommendation con concurrencia acotada.
+        
+        Los planes en caché se devuelven sin ocupar un turno del gate (check_cache=False si el
+        llamador ya consultó la caché).
+        
+        Raises:
+            OverloadedError: Si Gemini está saturado
+            Exception: Si hay un error al comunicarse con Gemini
+        """
+        cached = self.plan_cache.get(plan_cache_key(destination, date, budget, style, user_currency)) if check_cache else None
+        if cached is not None:
+            logger.info(f"⚡ Plan servido desde caché para '{destination.strip()}'")
+            return cached
+        
+        if self.plan_mode == "sections":
+            return await self.generate_plan_by_sections_async(destination, date, budget, style, user_currency)
+        
+        return await self.run_bounded(
+            self.generate_travel_recommendation,
+            destination=destination,
+            date=date,
+            budget=budget,
+            style=style,
+            user_currency=user_currency,
+            check_cache=False
+        )
+    
+    async def generate_chat_response_async(
+        self,
+        destination: str,
+        date: str = "",
+        budget: str = "",
+        style: str = "",
+        message: str = "",
+        history: Optional[List[Dict]] = None,
+        summary: str = ""
+    ) -> Tuple[str, str]:
+        """
+        Versión async de generate_chat_response con concurrencia acotada.
+        
+        Raises:
+            OverloadedError: Si Gemini está saturado
+            Exception: Si hay un error al comunicarse con Gemini
+        """
+        return await self.run_bounded(
+            self.generate_chat_response,
+            destination=destination,
+            date=date,
+            budget=budget,
+            style=style,
+            message=message,
+            history=history or [],
+            summary=summary
+        )
+    
+    def summarize_conversation(self, previous_summary: str, messages: List[Dict], max_tokens: int) -> str:
+        """
+        Pliega turnos antiguos del chat en el resumen acumulado.
+        
+        Args:
+            previous_summary: Resumen anterior ("" si es el primero)
+            messages: Turnos a plegar, en orden cronológico
+            max_tokens: Tokens máximos del nuevo resumen
+            
+        Returns:
+            str: El nuevo resumen
+            
+        Raises:
+            Exception: Si Gemini falla o devuelve un resumen vacío
+        """
+        prompt = build_summary_prompt(previous_summary, messages, max_words=max_tokens * 3 // 5)
+        with track_upstream("gemini_summary"):
+            response = self.model.generate_content(
+                prompt,
+                generation_config={**self.generation_config, "max_output_tokens": max_tokens}
+            )
+        self._record_usage("chat_summary", response, prompt, "chat", False)
+        summary = (response.text or "").strip()
+        if not summary:
+            raise ValueError("Gemini devolvió un resumen vacío")
+        # Tope duro por si el modelo ignora el límite de palabras
+        return summary[:max_tokens * CHARS_PER_TOKEN]
+    
+    async def summarize_conversation_async(self, previous_summary: str, messages: List[Dict], max_tokens: int) -> str:
+        """
+        Versión async de summarize_conversation con concurrencia acotada.
+        
+        Raises:
+            OverloadedError: Si Gemini está saturado (el resumen se reintenta en otro turno)
+        """
+        return await self.run_bounded(self.summarize_conversation, previous_summary, messages, max_tokens)
+    
+    def generate_plan_sections(
+        self,
+        destination: str,
+        date: str,
+        budget: str,
+        style: str,
+        sections: List[str],
+        include_intro: bool,
+        current_sections: Optional[Dict[str, str]] = None,
+        instruction: str = ""
+    ) -> Tuple[str, Dict[str, str], str]:
+        """
+        Genera solo algunas secciones del plan con una llamada corta a Gemini.
+        
+        Args:
+            destination: El destino del viaje (ya normalizado)
+            date: La fecha del viaje
+            budget: El presupuesto del viaje
+            style: El estilo de viaje
+            sections: Claves de PLAN_SECTIONS a generar, en orden
+            include_intro: Pedir también el mensaje introductorio
+            current_sections: Contenido actual de las secciones (solo para ediciones)
+            instruction: Cambio pedido por el usuario (solo para ediciones)
+            
+        Returns:
+            Tuple[str, Dict[str, str], str]: (introducción, {sección: contenido}, finish_reason)
+            
+        Raises:
+            ValueError: Si la respuesta no contiene ninguna de las secciones pedidas
+        """
+        model, in_model = self._model_for("plan")
+        prompt = build_section_prompt(
+            destination, date, budget, style, sections, include_intro, inline_instructions=not in_model,
+            current_sections=current_sections, instruction=instruction
+        )
+        with track_upstream("gemini"):
+            response = model.generate_content(
+                prompt,
+                generation_config={**self.generation_config, "max_output_tokens": PLAN_SECTION_MAX_OUTPUT_TOKENS}
+            )
+        self._record_usage("plan_edit" if current_sections else "plan_section", response, prompt, "plan", in_model)
+        
+        text = response.text if response is not None else ""
+        intro, found = split_plan_sections(text or "")
+        if not found and len(sections) == 1 and not include_intro and intro:
+            # El modelo omitió el encabezado: todo el texto es la sección pedida
+            found, intro = {sections[0]: intro}, ""
+        found = {key: body for key, body in found.items() if key in sections}
+        if not found:
+            raise ValueError(f"La respuesta de Gemini no contiene las secciones {sections}")
+        missing = [key for key in sections if key not in found]
+        if missing:
+            logger.warning(f"⚠️  Faltan secciones en la respuesta de Gemini: {missing}")
+        return (intro if include_intro else ""), found, extract_finish_reason(response)
+    
+    async def generate_plan_by_sections_async(
+        self,
+        destination: str,
+        date: str = "",
+        budget: str = "",
+        style: str = "",
+        user_currency: str = "COP"
+    ) -> Tuple[str, str]:
+        """
+        Genera el plan con una llamada por grupo de secciones, en paralelo, y lo rearma en el
+        orden canónico con los encabezados exactos (ver PLAN_SECTIONS).
+        
+        Cada llamada es corta (PLAN_SECTION_MAX_OUTPUT_TOKENS), así que el plan completo ya no
+        queda cortado por MAX_TOKENS, y la latencia total es la del grupo más lento. El plan
+        ocupa un solo turno del gate (como en modo "single"); si un grupo falla, los que aún
+        no empezaron se cancelan y el resultado de los que ya están en curso se descarta.
+        
+        Returns:
+            Tuple[str, str]: (plan, finish_reason) con el primer finish_reason distinto de STOP
+            si alguna sección quedó cortada
+            
+        Raises:
+            OverloadedError: Si Gemini está saturado
+            Exception: Si alguna sección falla
+        """
+        destination = destination.strip()
+        date, budget, style = (date or "").strip(), (budget or "").strip(), (style or "").strip()
+        user_currency = user_currency.strip() if user_currency else "COP"
+        groups = self.plan_section_groups
+        logger.info(f"🧩 Generando plan por secciones para '{destination}' ({len(groups)} llamadas en paralelo)")
+        
+        async def generate_groups(submit):
+            calls = [
+                submit(self.generate_plan_sections, destination, date, budget, style, group, index == 0)
+                for index, group in enumerate(groups)
+            ]
+            try:
+                return await asyncio.gather(*calls)
+            except BaseException:
+                # Solo se cancelan los grupos que aún esperan hilo; los que ya están llamando a
+                # Gemini terminan en segundo plano y conservan el turno hasta entonces
+                for call in calls:
+                    call.cancel()
+                raise
+        
+        try:
+            results = await self._in_slot(generate_groups)
+        except OverloadedError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Error al generar una sección del plan: {type(e).__name__}: {e}")
+            raise Exception("Ocurrió un error consultando a la IA") from e
+        
+        intro = results[0][0]
+        sections: Dict[str, str] = {}
+        for _, found, _ in results:
+            sections.update(found)
+        finish_reasons = [finish_reason for _, _, finish_reason in results]
+        finish_reason = next((reason for reason in finish_reasons if reason != "STOP"), "STOP")
+        if len(sections) < len(PLAN_SECTIONS):
+            logger.warning(f"⚠️  Plan por secciones incompleto: {sorted(set(PLAN_SECTIONS) - set(sections))}")
+        
+        plan = assemble_plan(intro, sections)
+        logger.info(f"✅ Plan por secciones generado ({len(plan)} caracteres, finish_reason={finish_reason})")
+        
+        # Solo se cachean planes completos
+        if finish_reason == "STOP" and len(sections) == len(PLAN_SECTIONS):
+            self.plan_cache.set(
+                plan_cache_key(destination, date, budget, style, user_currency),
+                (plan, finish_reason),
+                size=len(plan.encode("utf-8"))
+            )
+        return plan, finish_reason
+    
+    def cached_plan(
+        self,
+        destination: str,
+        date: str,
+        budget: str,
+        style: str,
+        user_currency: str
+    ) -> Optional[str]:
+        """Plan completo en caché para esos campos (None si no está o quedó cortado; ver plan_cache_key)."""
+        cached = self.plan_cache.get(plan_cache_key(destination, date, budget, style, user_currency))
+        if cached is None or cached[1] != "STOP":
+            return None
+        return cached[0]
+    
+    async def edit_plan_async(
+        self,
+        destination: str,
+        date: str,
+        budget: str,
+        style: str,
+        plan: str,
+        sections: List[str],
+        instruction: str
+    ) -> Tuple[str, List[str], str]:
+        """
+        Aplica un cambio pedido en el chat regenerando solo las secciones afectadas del plan.
+        
+        Las demás secciones (y la introducción) se copian tal cual de plan, así que la salida
+        de Gemini es la de una sección y no la de un plan completo.
+        
+        Args:
+            destination: El destino del viaje
+            date: La fecha del viaje
+            budget: El presupuesto del viaje
+            style: El estilo de viaje
+            plan: Plan actual completo
+            sections: Claves de PLAN_SECTIONS a cambiar (ver detect_plan_edit)
+            instruction: Mensaje del usuario con el cambio (ya sanitizado)
+            
+        Returns:
+            Tuple[str, List[str], str]: (plan_actualizado, secciones_cambiadas, finish_reason)
+            
+        Raises:
+            OverloadedError: Si Gemini está saturado
+            ValueError: Si el plan no tiene esas secciones o la respuesta no las contiene
+        """
+        intro, current = split_plan_sections(plan)
+        missing = [key for key in sections if key not in current]
+        if missing:
+            raise ValueError(f"El plan no contiene las secciones {missing}")
+        
+        _, found, finish_reason = await self.run_bounded(
+            self.generate_plan_sections,
+            destination.strip(), (date or "").strip(), (budget or "").strip(), (style or "").strip(),
+            sections, False,
+            current_sections={key: current[key] for key in sections},
+            instruction=instruction
+        )
+        changed = [key for key in sections if key in found]
+        logger.info(f"✏️  Plan editado por secciones: {changed} (finish_reason={finish_reason})")
+        return assemble_plan(intro, {**current, **found}), changed, finish_reason
     
     def generate_travel_recommendation(
         self, 
@@ -273,7 +1532,8 @@ class GeminiService:
         date: str = "",
         budget: str = "",
         style: str = "",
-        user_currency: str = "COP"
+        user_currency: str = "COP",
+        check_cache: bool = True
     ) -> Tuple[str, str]:
         """
         Genera una recomendación de viaje usando Gemini con campos estructurados.
@@ -284,6 +1544,8 @@ class GeminiService:
             budget: El presupuesto del viaje (opcional)
             style: El estilo de viaje (opcional)
             user_currency: Moneda del usuario (opcional, default: COP para usuarios colombianos)
+            check_cache: Consultar la caché de planes antes de llamar a Gemini (False si el
+                llamador ya la consultó; el resultado se guarda en caché igualmente)
             
         Returns:
             Tuple[str, str]: (recomendación, finish_reason)
@@ -306,53 +1568,23 @@ class GeminiService:
             
             logger.info(f"📤 Generando recomendación de viaje - Destino: '{destination}', Fecha: '{date}', Presupuesto: '{budget}', Estilo: '{style}', Moneda: '{user_currency}'")
             
-            # Construir el prompt combinando los 4 campos en una frase coherente
-            prompt_parts = [f"Planifica un viaje a {destination}"]
-            
-            if date:
-                prompt_parts.append(f"para la fecha {date}")
-            
-            if budget:
-                prompt_parts.append(f"con presupuesto {budget}")
-            
-            if style:
-                prompt_parts.append(f"y estilo {style}")
-            
-            # Combinar todas las partes en una frase coherente
-            user_request = " ".join(prompt_parts) + "."
+            cache_key = plan_cache_key(destination, date, budget, style, user_currency)
+            cached = self.plan_cache.get(cache_key) if check_cache else None
+            if cached is not None:
+                logger.info(f"⚡ Plan servido desde caché para '{destination}'")
+                return cached
             
-            # Construir contexto destacado de presupuesto y estilo para que Gemini los referencia explícitamente
-            context_highlight = ""
-            if budget or style:
-                context_highlight = "\n\n--- CONTEXTO DEL USUARIO (REFERENCIA ESTO EN CADA RECOMENDACIÓN) ---\n"
-                if budget:
-                    context_highlight += f"• Presupuesto del usuario: {budget}\n"
-                    context_highlight += "  → IMPORTANTE: En cada recomendación, explica POR QUÉ es perfecta para este presupuesto.\n"
-                if style:
-                    context_highlight += f"• Estilo de viaje del usuario: {style}\n"
-                    context_highlight += "  → IMPORTANTE: En cada recomendación, conecta la experiencia con este estilo de viaje.\n"
-                context_highlight += "\nEjemplo de cómo referenciar: 'Perfecto para tu presupuesto de mochilero porque...' o 'Ideal para tu estilo cultural ya que...'\n"
-            
-            # Instrucción obligatoria sobre moneda: La aplicación está dirigida a usuarios colombianos
-            # Todos los costos deben estar en COP como moneda principal
-            currency_instruction = "\n\n--- REGLAS DE MONEDA (OBLIGATORIO) ---\n"
-            currency_instruction += "⚠️ TODOS los costos DEBEN estar en PESOS COLOMBIANOS (COP) como moneda PRINCIPAL.\n"
-            currency_instruction += "• Formato obligatorio: '$150.000 COP' o '$2.500.000 COP' (usa punto como separador de miles).\n"
-            currency_instruction += "• Para destinos internacionales, opcionalmente muestra la moneda local en paréntesis: '$450.000 COP (~$100 EUR)'.\n"
-            currency_instruction += "• El precio en COP debe ser el DESTACADO y principal; la moneda local es solo referencia.\n"
-            currency_instruction += "• Esto aplica a TODOS los precios: hoteles, restaurantes, entradas, transporte, actividades.\n"
-            currency_instruction += "• La sección '💰 COSTOS' DEBE seguir esta regla estrictamente.\n"
-            
-            # Construir el prompt completo incluyendo el system instruction para PLAN
-            # La instrucción de sistema se inyecta antes de la pregunta del usuario
-            full_prompt = f"{SYSTEM_INSTRUCTION_PLAN}{context_highlight}{currency_instruction}\n\n---\n\nSolicitud del usuario: {user_request}"
+            model, in_model = self._model_for("plan")
+            full_prompt, user_request = build_plan_prompt(destination, date, budget, style, inline_instructions=not in_model)
             
             # Generar respuesta usando Gemini
             # Esta es la llamada a la API de Google Gemini que envía la pregunta del usuario
             logger.info(f"🔄 Enviando solicitud a Gemini: {user_request[:100]}...")
             logger.debug(f"📝 Longitud del prompt completo: {len(full_prompt)} caracteres")
             
-            response = self.model.generate_content(full_prompt)
+            with track_upstream("gemini"):
+                response = model.generate_content(full_prompt)
+            self._record_usage("plan", response, full_prompt, "plan", in_model)
             
             # Extraer el texto de la respuesta
             if not response or not hasattr(response, 'text') or not response.text:
@@ -361,43 +1593,26 @@ class GeminiService:
             recommendation = response.text
             
             # Extraer finish_reason para detectar si la respuesta fue cortada
-            finish_reason = "STOP"  # Valor por defecto
-            if hasattr(response, 'candidates') and response.candidates:
-                candidate = response.candidates[0]
-                if hasattr(candidate, 'finish_reason'):
-                    finish_reason_raw = candidate.finish_reason
-                    # Manejar diferentes tipos de finish_reason (enum, string, número)
-                    if finish_reason_raw is None:
-                        finish_reason = "STOP"
-                    elif hasattr(finish_reason_raw, 'name'):  # Es un enum
-                        finish_reason = finish_reason_raw.name
-                    elif hasattr(finish_reason_raw, 'value'):  # Es un enum con value
-                        finish_reason = str(finish_reason_raw.value)
-                    else:
-                        finish_reason = str(finish_reason_raw)
-                    
-                    # Normalizar valores comunes
-                    finish_reason_upper = finish_reason.upper()
-                    if "STOP" in finish_reason_upper or finish_reason == "1" or finish_reason == 1:
-                        finish_reason = "STOP"
-                    elif "MAX_TOKENS" in finish_reason_upper or "LENGTH" in finish_reason_upper or finish_reason == "2" or finish_reason == 2:
-                        finish_reason = "MAX_TOKENS"
-                    elif "SAFETY" in finish_reason_upper or finish_reason == "3" or finish_reason == 3:
-                        finish_reason = "SAFETY"
-                    elif "RECITATION" in finish_reason_upper or finish_reason == "4" or finish_reason == 4:
-                        finish_reason = "RECITATION"
-                    
-                    if finish_reason != "STOP":
-                        logger.warning(f"⚠️  Respuesta cortada: finish_reason={finish_reason}")
+            finish_reason = extract_finish_reason(response)
+            if finish_reason != "STOP":
+                logger.warning(f"⚠️  Respuesta cortada: finish_reason={finish_reason}")
             
             logger.info(f"✅ Recomendación generada exitosamente por Alex ({len(recommendation)} caracteres, finish_reason={finish_reason})")
+            
+            # Solo se cachean respuestas completas; una respuesta cortada debe poder regenerarse
+            if finish_reason == "STOP":
+                self.plan_cache.set(
+                    cache_key,
+                    (recommendation, finish_reason),
+                    size=len(recommendation.encode("utf-8"))
+                )
             return recommendation, finish_reason
             
         except ValueError as e:
             # Errores de validación o configuración
             logger.error(f"❌ Error de validación en Gemini: {e}")
             logger.error(f"📋 Traceback completo:\n{traceback.format_exc()}")
-            raise Exception(f"Error de configuración: {e}")
+            raise Exception(f"Error de configuración: {e}") from e
             
         except Exception as e:
             # Bloque try/except con logging detallado
@@ -406,8 +1621,105 @@ class GeminiService:
             logger.error(f"❌ Error al consultar Gemini: {error_type}: {error_message}")
             logger.error(f"📋 Traceback completo:\n{traceback.format_exc()}")
             logger.error(f"🔍 Argumentos recibidos: destination='{destination}', date='{date}', budget='{budget}', style='{style}'")
-            raise Exception("Ocurrió un error consultando a la IA")
-    
+            raise Exception("Ocurrió un error consultando a la IA") from e
+
+    def stream_travel_recommendation(
+        self,
+        destination: str,
+        date: str = "",
+        budget: str = "",
+        style: str = "",
+        user_currency: str = "COP"
+    ) -> Iterator[Tuple[str, str]]:
+        """
+        Genera una recomendación de viaje en modo streaming.
+
+        Usa el mismo prompt que generate_travel_recommendation pero solicita la respuesta
+        a Gemini con stream=True, entregando cada fragmento de texto apenas llega.
+
+        Args:
+            destination: El destino del viaje (obligatorio)
+            date: La fecha del viaje (opcional)
+            budget: El presupuesto del viaje (opcional)
+            style: El estilo de viaje (opcional)
+            user_currency: Moneda del usuario (opcional, default: COP)
+
+        Yields:
+            Tuple[str, str]: ("chunk", texto) por cada fragmento y, al final, ("done", finish_reason)
+
+        Raises:
+            Exception: Si hay un error al comunicarse con Gemini
+        """
+        try:
+            if not destination or not destination.strip():
+                raise ValueError("El destino no puede estar vacío")
+
+            destination = destination.strip()
+            date = date.strip() if date else ""
+            budget = budget.strip() if budget else ""
+            style = style.strip() if style else ""
+            user_currency = user_currency.strip() if user_currency else "COP"
+
+            # Con la caché caliente el plan completo se envía como un único fragmento
+            cache_key = plan_cache_key(destination, date, budget, style, user_currency)
+            cached = self.plan_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"⚡ Plan servido desde caché (streaming) para '{destination}'")
+                recommendation, finish_reason = cached
+                yield "chunk", recommendation
+                yield "done", finish_reason
+                return
+
+            model, in_model = self._model_for("plan")
+            full_prompt, user_request = build_plan_prompt(destination, date, budget, style, inline_instructions=not in_model)
+            logger.info(f"🔄 Enviando solicitud a Gemini (streaming): {user_request[:100]}...")
+
+            chunks = []
+            # Se mide el stream completo, del envío del prompt al último fragmento
+            with track_upstream("gemini_stream"):
+                response = model.generate_content(full_prompt, stream=True)
+
+                for chunk in response:
+                    # Los fragmentos sin partes (ej. solo metadatos de cierre) lanzan ValueError en .text
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        text = ""
+                    if text:
+                        chunks.append(text)
+                        yield "chunk", text
+
+            # usage_metadata está completo solo después de consumir el stream
+            self._record_usage("plan_stream", response, full_prompt, "plan", in_model)
+            recommendation = "".join(chunks)
+            total_chars = len(recommendation)
+            if total_chars == 0:
+                raise ValueError("La respuesta de Gemini está vacía o no tiene texto")
+
+            finish_reason = extract_finish_reason(response)
+            if finish_reason != "STOP":
+                logger.warning(f"⚠️  Respuesta cortada (streaming): finish_reason={finish_reason}")
+
+            logger.info(f"✅ Recomendación en streaming completada ({total_chars} caracteres, finish_reason={finish_reason})")
+            if finish_reason == "STOP":
+                self.plan_cache.set(
+                    cache_key,
+                    (recommendation, finish_reason),
+                    size=len(recommendation.encode("utf-8"))
+                )
+            yield "done", finish_reason
+
+        except ValueError as e:
+            logger.error(f"❌ Error de validación en Gemini (streaming): {e}")
+            logger.error(f"📋 Traceback completo:\n{traceback.format_exc()}")
+            raise Exception(f"Error de configuración: {e}") from e
+
+        except Exception as e:
+            error_type = type(e).__name__
+            logger.error(f"❌ Error al consultar Gemini (streaming): {error_type}: {e}")
+            logger.error(f"📋 Traceback completo:\n{traceback.format_exc()}")
+            raise Exception("Ocurrió un error consultando a la IA") from e
+
     def generate_chat_response(
         self,
         destination: str,
@@ -415,7 +1727,8 @@ class GeminiService:
         budget: str = "",
         style: str = "",
         message: str = "",
-        history: List[Dict] = []
+        history: List[Dict] = [],
+        summary: str = ""
     ) -> Tuple[str, str]:
         """
         Genera una respuesta de chat usando Gemini con memoria conversacional.
@@ -424,9 +1737,9 @@ class GeminiService:
         la personalidad de Alex (consultor de viajes experto y entusiasta) mediante un
         system prompt especializado para conversaciones (SYSTEM_INSTRUCTION_CHAT).
         
-        El historial de conversación se limita a los últimos 10 mensajes para optimizar
-        el uso de tokens de entrada y mantener el contexto relevante. Esto reduce los costos
-        de API al enviar solo el contexto más reciente necesario para la conversación.
+        El historial de conversación se recorta a un presupuesto de tokens
+        (CHAT_HISTORY_TOKEN_BUDGET): se envían los mensajes más recientes que quepan y los
+        muy largos (planes completos) se abrevian, así el tamaño del prompt queda acotado.
         Si hay historial, se construye un prompt que incluye el contexto del viaje, el
         historial de conversación y el nuevo mensaje del usuario. Si no hay historial, se
         trata como una solicitud inicial y se usa SYSTEM_INSTRUCTION_PLAN.
@@ -438,6 +1751,7 @@ class GeminiService:
             style: El estilo de viaje (opcional)
             message: El nuevo mensaje del usuario
             history: Lista de mensajes anteriores en formato [{"role": "user", "parts": "..."}, ...]
+            summary: Resumen de los turnos anteriores ya plegados (opcional)
             
         Returns:
             Tuple[str, str]: (respuesta, finish_reason)
@@ -448,87 +1762,31 @@ class GeminiService:
             Exception: Si hay un error al comunicarse con Gemini
         """
         try:
-            # Construir el contexto del viaje
-            context_info = f"Contexto del viaje: Destino: {destination}"
-            if date:
-                context_info += f", Fecha: {date}"
-            if budget:
-                context_info += f", Presupuesto: {budget}"
-            if style:
-                context_info += f", Estilo: {style}"
-            
-            # Si hay historial, construir el prompt con el historial concatenado
-            # Gestión de Historial: Limitar a los últimos 10 mensajes para ahorrar tokens de entrada
-            # Esto reduce significativamente el costo de cada llamada a la API al enviar
-            # solo el contexto más reciente necesario para mantener la coherencia conversacional.
-            if history:
-                # Limitar el historial a los últimos 10 mensajes
-                limited_history = history[-10:] if len(history) > 10 else history
-                if len(history) > 10:
-                    logger.info(f"📚 Historial limitado a {len(limited_history)} mensajes (de {len(history)} totales) para optimizar tokens")
-                
-                # Construir el historial como texto para el contexto
-                history_text = "\n\n--- Historial de Conversación ---\n\n"
-                for msg in limited_history:
-                    role_label = "Usuario" if msg.get("role") == "user" else "Alex"
-                    history_text += f"{role_label}: {msg.get('parts', '')}\n\n"
-                
-                # Construir el prompt completo con historial usando SYSTEM_INSTRUCTION_CHAT
-                # Para preguntas de seguimiento, usa la instrucción conversacional
-                full_prompt = f"{SYSTEM_INSTRUCTION_CHAT}\n\n---\n\n{context_info}\n\n{history_text}---\n\nUsuario pregunta ahora: {message}"
-                
-                logger.info(f"Enviando mensaje de chat a Gemini con historial de {len(limited_history)} mensajes")
+            variant = chat_instruction_variant(history, summary)
+            model, in_model = self._model_for(variant)
+            full_prompt, history_used = build_chat_prompt(
+                destination, date, budget, style, message, history,
+                inline_instructions=not in_model, summary=summary
+            )
+            if len(history) > history_used:
+                logger.info(f"📚 Historial limitado a {history_used} mensajes (de {len(history)} totales) por presupuesto de tokens")
+            if summary:
+                logger.info(f"Enviando mensaje de chat a Gemini con resumen y {history_used} mensajes recientes")
+            elif history_used:
+                logger.info(f"Enviando mensaje de chat a Gemini con historial de {history_used} mensajes")
             else:
-                # Si no hay historial, es el primer mensaje - usar SYSTEM_INSTRUCTION_PLAN
-                prompt_parts = [f"Planifica un viaje a {destination}"]
-                
-                if date:
-                    prompt_parts.append(f"para la fecha {date}")
-                
-                if budget:
-                    prompt_parts.append(f"con presupuesto {budget}")
-                
-                if style:
-                    prompt_parts.append(f"y estilo {style}")
-                
-                user_request = " ".join(prompt_parts) + "."
-                full_prompt = f"{SYSTEM_INSTRUCTION_PLAN}\n\n---\n\n{context_info}\n\nSolicitud del usuario: {user_request}"
-                
                 logger.info(f"Enviando solicitud inicial a Gemini: {destination}")
             
             # Generar respuesta usando Gemini
-            response = self.model.generate_content(full_prompt)
+            with track_upstream("gemini"):
+                response = model.generate_content(full_prompt)
+            self._record_usage("chat", response, full_prompt, variant, in_model)
             recommendation = response.text
             
             # Extraer finish_reason para detectar si la respuesta fue cortada
-            finish_reason = "STOP"  # Valor por defecto
-            if hasattr(response, 'candidates') and response.candidates:
-                candidate = response.candidates[0]
-                if hasattr(candidate, 'finish_reason'):
-                    finish_reason_raw = candidate.finish_reason
-                    # Manejar diferentes tipos de finish_reason (enum, string, número)
-                    if finish_reason_raw is None:
-                        finish_reason = "STOP"
-                    elif hasattr(finish_reason_raw, 'name'):  # Es un enum
-                        finish_reason = finish_reason_raw.name
-                    elif hasattr(finish_reason_raw, 'value'):  # Es un enum con value
-                        finish_reason = str(finish_reason_raw.value)
-                    else:
-                        finish_reason = str(finish_reason_raw)
-                    
-                    # Normalizar valores comunes
-                    finish_reason_upper = finish_reason.upper()
-                    if "STOP" in finish_reason_upper or finish_reason == "1" or finish_reason == 1:
-                        finish_reason = "STOP"
-                    elif "MAX_TOKENS" in finish_reason_upper or "LENGTH" in finish_reason_upper or finish_reason == "2" or finish_reason == 2:
-                        finish_reason = "MAX_TOKENS"
-                    elif "SAFETY" in finish_reason_upper or finish_reason == "3" or finish_reason == 3:
-                        finish_reason = "SAFETY"
-                    elif "RECITATION" in finish_reason_upper or finish_reason == "4" or finish_reason == 4:
-                        finish_reason = "RECITATION"
-                    
-                    if finish_reason != "STOP":
-                        logger.warning(f"⚠️  Respuesta cortada en chat: finish_reason={finish_reason}")
+            finish_reason = extract_finish_reason(response)
+            if finish_reason != "STOP":
+                logger.warning(f"⚠️  Respuesta cortada en chat: finish_reason={finish_reason}")
             
             logger.info(f"✅ Respuesta generada exitosamente por Alex (finish_reason={finish_reason})")
             return recommendation, finish_reason
@@ -537,7 +1795,7 @@ class GeminiService:
             # Errores de validación o configuración
             logger.error(f"❌ Error de validación en Gemini (chat): {e}")
             logger.error(f"📋 Traceback completo:\n{traceback.format_exc()}")
-            raise Exception(f"Error de configuración: {e}")
+            raise Exception(f"Error de configuración: {e}") from e
             
         except Exception as e:
             # Bloque try/except con logging detallado
@@ -546,7 +1804,7 @@ class GeminiService:
             logger.error(f"❌ Error al consultar Gemini (chat): {error_type}: {error_message}")
             logger.error(f"📋 Traceback completo:\n{traceback.format_exc()}")
             logger.error(f"🔍 Argumentos recibidos: destination='{destination}', message='{message[:50]}...', history_length={len(history)}")
-            raise Exception("Ocurrió un error consultando a la IA")
+            raise Exception("Ocurrió un error consultando a la IA") from e
 
 
 # Instancia global del servicio (se inicializa al importar)
@@ -0,0 +1,57 @@
+"""
+Fábrica de clientes HTTP compartidos para los servicios externos (WeatherAPI, Unsplash).
+"""
+import os
+import logging
+import httpx
+from dotenv import load_dotenv
+
+# Cargar variables de entorno
+load_dotenv()
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+
+def _http2_available() -> bool:
+    """HTTP/2 en httpx requiere el paquete opcional 'h2' (pip install httpx[http2])."""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def create_async_client(timeout: float = 10.0) -> httpx.AsyncClient:
+    """
+    Crea un httpx.AsyncClient de larga vida con pool de conexiones y keep-alive.
+
+    Reutilizar el cliente evita repetir DNS, TCP y TLS en cada llamada a la API externa.
+    Los límites del pool se configuran con variables de entorno:
+    - HTTP_MAX_CONNECTIONS (default: 20)
+    - HTTP_MAX_KEEPALIVE_CONNECTIONS (default: 10)
+    - HTTP_KEEPALIVE_EXPIRY (default: 30 segundos)
+    - HTTP2_ENABLED (default: false; requiere el paquete 'h2')
+
+    Args:
+        timeout: Timeout total por request en segundos
+
+    Returns:
+        httpx.AsyncClient: Cliente listo para usarse (debe cerrarse con aclose())
+    """
+    limits = httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "20")),
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10")),
+        keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+    )
+
+    http2 = os.getenv("HTTP2_ENABLED", "false").lower() in ("1", "true", "yes")
+    if http2 and not _http2_available():
+        logger.warning("⚠️  HTTP2_ENABLED=true pero el paquete 'h2' no está instalado. Usando HTTP/1.1.")
+        http2 = False
+
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(timeout, connect=5.0),
+        limits=limits,
+        http2=http2
+    )
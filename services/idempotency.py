@@ -0,0 +1,224 @@
+"""
+Soporte de Idempotency-Key para /api/plan y /api/chat.
+
+Un cliente que reintenta una solicitud (p. ej. tras un corte de red en el móvil) envía la
+misma Idempotency-Key. La respuesta completada se guarda por (uid, endpoint, clave) durante
+IDEMPOTENCY_TTL_SECONDS y se devuelve tal cual; un duplicado que llega mientras la original
+sigue en curso espera su resultado. Un reintento no vuelve a llamar a Gemini ni a contar el
+plan en las estadísticas.
+
+Solo se guardan respuestas exitosas: si la original falla, el reintento se procesa de nuevo.
+"""
+import asyncio
+import os
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from services.cache import TTLCache, SingleFlight
+from services.persistent_cache import SQLiteCache, get_cache_dir
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+# Longitud máxima de una Idempotency-Key
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+
+class IdempotencyConflictError(Exception):
+    """La clave ya se usó con una solicitud distinta."""
+
+
+class IdempotencyStore:
+    """
+    Respuestas completadas por clave de idempotencia (en memoria, con TTL y LRU) más las
+    solicitudes en curso, que los duplicados comparten con SingleFlight.
+    """
+
+    backend = "memory"
+
+    def __init__(self, ttl_seconds: float, max_entries: int, max_bytes: Optional[int]):
+        """
+        Args:
+            ttl_seconds: Tiempo durante el cual se repite una respuesta completada
+            max_entries: Número máximo de respuestas guardadas en memoria
+            max_bytes: Tamaño total aproximado de las respuestas en memoria (None = sin límite)
+        """
+        self.ttl_seconds = ttl_seconds
+        self.cache = TTLCache(ttl_seconds=ttl_seconds, max_entries=max_entries, max_bytes=max_bytes, name="idempotency")
+        self.inflight = SingleFlight(name="idempotency")
+        self._inflight_fingerprints: Dict[str, str] = {}
+        self.stored = 0
+        self.replayed = 0
+        self.attached = 0
+        self.conflicts = 0
+
+    async def _read(self, key: str) -> Optional[Dict]:
+        return self.cache.get(key)
+
+    async def _write(self, key: str, entry: Dict) -> None:
+        self.cache.set(key, entry, size=len(str(entry["response"])) + 128)
+
+    async def replay(self, uid: str, scope: str, key: str, fingerprint: str) -> Optional[Any]:
+        """
+        Respuesta ya generada para (uid, scope, key): la guardada o, si la original sigue en
+        curso, su resultado. No ejecuta nada nuevo.
+
+        Returns:
+            La respuesta repetida, o None si la clave no se ha usado
+
+        Raises:
+            IdempotencyConflictError: Si la clave ya se usó con otro cuerpo
+        """
+        store_key = f"{scope}:{uid}:{key}"
+        stored = await self._read(store_key)
+        if stored is not None:
+            if stored["fingerprint"] != fingerprint:
+                self.conflicts += 1
+                raise IdempotencyConflictError(store_key)
+            self.replayed += 1
+            logger.info(f"🔁 Respuesta repetida para Idempotency-Key ({scope})")
+            return stored["response"]
+
+        if not self.inflight.in_flight(store_key):
+            return None
+        if self._inflight_fingerprints.get(store_key) != fingerprint:
+            self.conflicts += 1
+            raise IdempotencyConflictError(store_key)
+        self.attached += 1
+        logger.info(f"🔗 Reintento con Idempotency-Key en curso ({scope}): esperando la solicitud original")
+        # La llamada está en vuelo: run solo espera su resultado (la fábrica no se invoca)
+        return await self.inflight.run(store_key, lambda: None)
+
+    async def run(
+        self,
+        uid: str,
+        scope: str,
+        key: str,
+        fingerprint: str,
+        handler: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """
+        Ejecuta handler una sola vez por (uid, scope, key) dentro de la ventana de retención.
+
+        Args:
+            uid: Usuario dueño de la clave
+            scope: Endpoint ("plan", "chat"): la misma clave en otro endpoint es otra solicitud
+            key: Idempotency-Key enviada por el cliente
+            fingerprint: Huella del cuerpo de la solicitud
+            handler: Genera la respuesta (solo se invoca si no hay una guardada ni en curso)
+
+        Returns:
+            Tuple[Any, bool]: (respuesta, repetida). repetida es True si no se generó ahora
+
+        Raises:
+            IdempotencyConflictError: Si la clave ya se usó con otro cuerpo
+        """
+        response = await self.replay(uid, scope, key, fingerprint)
+        if response is not None:
+            return response, True
+
+        store_key = f"{scope}:{uid}:{key}"
+        self._inflight_fingerprints[store_key] = fingerprint
+
+        async def execute():
+            try:
+                response = await handler()
+                try:
+                    await self._write(store_key, {"fingerprint": fingerprint, "response": response})
+                    self.stored += 1
+                except Exception as e:
+                    logger.warning(f"⚠️  No se pudo guardar la respuesta idempotente: {e}")
+                return response
+            finally:
+                self._inflight_fingerprints.pop(store_key, None)
+
+        return await self.inflight.run(store_key, execute), False
+
+    async def close(self) -> None:
+        """Libera los recursos del almacén al apagar la aplicación (en memoria no hay nada que cerrar)."""
+
+    def stats(self) -> Dict:
+        """Contadores de respuestas guardadas, repetidas y reintentos en curso."""
+        return {
+            "backend": self.backend,
+            **self.cache.stats(),
+            "in_flight": len(self._inflight_fingerprints),
+            "stored": self.stored,
+            "replayed": self.replayed,
+            "attached": self.attached,
+            "conflicts": self.conflicts
+        }
+
+
+class SQLiteIdempotencyStore(IdempotencyStore):
+    """
+    Respuestas guardadas en SQLite: un reintento que llega a otro worker (o tras un reinicio)
+    también se repite. La espera de duplicados en curso sigue siendo por proceso.
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path: str, ttl_seconds: float):
+        super().__init__(ttl_seconds=ttl_seconds, max_entries=0, max_bytes=None)
+        self.path = path
+        self.disk = SQLiteCache(path, table="idempotency")
+
+    async def _read(self, key: str) -> Optional[Dict]:
+        stored = await asyncio.get_running_loop().run_in_executor(None, self.disk.get, key)
+        return stored[0] if stored is not None else None
+
+    async def _write(self, key: str, entry: Dict) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.disk.set, key, entry, self.ttl_seconds)
+
+    async def close(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.disk.close)
+
+    def stats(self) -> Dict:
+        return {
+            "backend": self.backend,
+            "path": self.path,
+            "in_flight": len(self._inflight_fingerprints),
+            "stored": self.stored,
+            "replayed": self.replayed,
+            "attached": self.attached,
+            "conflicts": self.conflicts
+        }
+
+
+# Instancia global del almacén de idempotencia
+_idempotency_store: Optional[IdempotencyStore] = None
+
+
+def get_idempotency_store() -> IdempotencyStore:
+    """
+    Obtiene la instancia singleton del almacén de respuestas idempotentes.
+
+    IDEMPOTENCY_BACKEND=memory (por defecto) guarda las respuestas en el proceso;
+    IDEMPOTENCY_BACKEND=sqlite las guarda en IDEMPOTENCY_DB_PATH (varios workers).
+
+    Returns:
+        IdempotencyStore: Instancia configurada con las variables IDEMPOTENCY_*
+    """
+    global _idempotency_store
+
+    if _idempotency_store is None:
+        backend = os.getenv("IDEMPOTENCY_BACKEND", "memory").lower()
+        ttl_seconds = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+
+        if backend == "sqlite":
+            path = os.getenv("IDEMPOTENCY_DB_PATH", os.path.join(get_cache_dir(), "idempotency.sqlite3"))
+            try:
+                _idempotency_store = SQLiteIdempotencyStore(path, ttl_seconds)
+            except Exception as e:
+                logger.warning(f"⚠️  No se pudo abrir el almacén de idempotencia en {path}: {e}. Usando memoria.")
+        elif backend != "memory":
+            logger.warning(f"⚠️  IDEMPOTENCY_BACKEND desconocido '{backend}'. Usando 'memory'.")
+
+        if _idempotency_store is None:
+            _idempotency_store = IdempotencyStore(
+                ttl_seconds=ttl_seconds,
+                max_entries=int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "5000")),
+                max_bytes=int(os.getenv("IDEMPOTENCY_MAX_BYTES", str(32 * 1024 * 1024)))
+            )
+
+    return _idempotency_store
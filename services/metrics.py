@@ -0,0 +1,214 @@
+"""
+Métricas Prometheus de ViajeIA (expuestas en GET /metrics).
+
+- Solicitudes HTTP por ruta: conteo, latencia (histograma) y solicitudes en curso.
+- Llamadas a servicios externos (Gemini, WeatherAPI, Unsplash, Firebase): latencia y resultado.
+- Distribución de finish_reason de Gemini, tokens por llamada, rechazos por rate limit y espera
+  en la cola de Gemini.
+- Contadores de cachés, gates y executors, leídos de los stats() de cada servicio al momento
+  del scrape (sin costo en el camino de las solicitudes).
+
+Con varios workers de gunicorn, definir PROMETHEUS_MULTIPROC_DIR (un directorio vacío en cada
+arranque) para que las métricas de solicitudes se sumen entre procesos; las métricas leídas
+de los servicios siguen siendo las del worker que atiende el scrape.
+"""
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Buckets pensados para este backend: respuestas de caché en milisegundos y planes de
+# Gemini que tardan decenas de segundos
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+HTTP_REQUESTS = Counter(
+    "viajeia_http_requests_total",
+    "Solicitudes HTTP atendidas",
+    ["route", "method", "status"]
+)
+HTTP_LATENCY = Histogram(
+    "viajeia_http_request_duration_seconds",
+    "Duración de las solicitudes HTTP (hasta el último byte de la respuesta)",
+    ["route"],
+    buckets=LATENCY_BUCKETS
+)
+HTTP_IN_FLIGHT = Gauge(
+    "viajeia_http_requests_in_flight",
+    "Solicitudes HTTP en curso",
+    ["route"],
+    multiprocess_mode="livesum"
+)
+UPSTREAM_LATENCY = Histogram(
+    "viajeia_upstream_request_duration_seconds",
+    "Duración de las llamadas a servicios externos",
+    ["upstream", "outcome"],
+    buckets=LATENCY_BUCKETS
+)
+GEMINI_FINISH_REASONS = Counter(
+    "viajeia_gemini_finish_reason_total",
+    "Respuestas de Gemini por finish_reason",
+    ["endpoint", "reason"]
+)
+GEMINI_QUEUE_WAIT = Histogram(
+    "viajeia_gemini_queue_wait_seconds",
+    "Espera por un turno de Gemini antes de la llamada",
+    buckets=LATENCY_BUCKETS
+)
+GEMINI_INPUT_TOKENS = Histogram(
+    "viajeia_gemini_input_tokens",
+    "Tokens de entrada por llamada a Gemini (source=estimated si el SDK no reporta usage_metadata)",
+    ["endpoint", "source"],
+    buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 12000, 16000)
+)
+GEMINI_TOKENS = Counter(
+    "viajeia_gemini_tokens_total",
+    "Tokens reportados por Gemini (input, cached, output)",
+    ["endpoint", "kind"]
+)
+RATE_LIMIT_REJECTIONS = Counter(
+    "viajeia_rate_limit_rejections_total",
+    "Solicitudes rechazadas por rate limiting (429)",
+    ["route"]
+)
+
+
+class UpstreamCall:
+    """Resultado de una llamada medida con track_upstream (modificable dentro del bloque)."""
+
+    def __init__(self):
+        self.outcome = "ok"
+
+
+@contextmanager
+def track_upstream(upstream: str) -> Iterator[UpstreamCall]:
+    """
+    Mide la duración de una llamada a un servicio externo.
+
+    El resultado es "error" si el bloque lanza una excepción; el llamador puede marcarlo
+    explícitamente (p. ej. call.outcome = "error" ante un status HTTP inesperado).
+    """
+    call = UpstreamCall()
+    start = time.perf_counter()
+    try:
+        yield call
+    except BaseException:
+        call.outcome = "error"
+        raise
+    finally:
+        UPSTREAM_LATENCY.labels(upstream=upstream, outcome=call.outcome).observe(time.perf_counter() - start)
+
+
+def record_finish_reason(endpoint: str, reason: Optional[str]) -> None:
+    """Cuenta un finish_reason de Gemini devuelto por un endpoint."""
+    GEMINI_FINISH_REASONS.labels(endpoint=endpoint, reason=reason or "UNKNOWN").inc()
+
+
+class ServiceStatsCollector:
+    """
+    Collector que traduce los dicts de stats() de los servicios a métricas Prometheus.
+
+    Cada proveedor registrado produce viajeia_<nombre>_<clave> para sus valores numéricos;
+    las claves listadas como contadores se exponen como counters (_total).
+    """
+
+    def __init__(self):
+        self._providers: List[tuple] = []
+
+    def register(self, name: str, provider: Callable[[], Dict[str, Any]], counters: Iterable[str] = ()) -> None:
+        self._providers.append((name, provider, frozenset(counters)))
+
+    def collect(self):
+        for name, provider, counters in self._providers:
+            try:
+                stats = provider()
+            except Exception:
+                continue
+            for key, value in _flatten(stats):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                metric_name = f"viajeia_{name}_{key}"
+                if key in counters:
+                    yield CounterMetricFamily(metric_name, f"{name}: {key}", value=value)
+                else:
+                    yield GaugeMetricFamily(metric_name, f"{name}: {key}", value=value)
+
+
+def _flatten(stats: Dict[str, Any], prefix: str = "") -> Iterator[tuple]:
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}_")
+        else:
+            yield f"{prefix}{key}", value
+
+
+service_stats = ServiceStatsCollector()
+REGISTRY.register(service_stats)
+
+
+def render() -> bytes:
+    """Genera el texto de exposición de Prometheus."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(service_stats)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI que mide cada solicitud HTTP por ruta.
+
+    Es ASGI puro (no BaseHTTPMiddleware) para medir hasta el último byte también en las
+    respuestas en streaming (SSE). Las rutas que no existen se agrupan como "other" para
+    no crear una serie por cada URL arbitraria.
+    """
+
+    def __init__(self, app, known_routes: Iterable[str] = ()):
+        self.app = app
+        self.known_routes = set(known_routes)
+
+    def _route(self, scope) -> str:
+        if not self.known_routes:
+            # Rutas de la aplicación (resueltas en la primera solicitud, ya registradas todas)
+            router = scope.get("app")
+            routes = getattr(router, "routes", [])
+            self.known_routes = {getattr(route, "path", "") for route in routes}
+        path = scope.get("path", "")
+        return path if path in self.known_routes else "other"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = self._route(scope)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        in_flight = HTTP_IN_FLIGHT.labels(route=route)
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_flight.dec()
+            HTTP_LATENCY.labels(route=route).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(route=route, method=scope.get("method", ""), status=str(status["code"])).inc()
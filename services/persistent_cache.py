@@ -0,0 +1,151 @@
+"""
+Caché persistente en SQLite para resultados que deben sobrevivir a reinicios y redeploys.
+"""
+import os
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Optional, Tuple
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+# Directorio por defecto para las cachés en disco (junto a backend/logs)
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'backend', 'cache')
+
+
+def get_cache_dir() -> str:
+    """Devuelve (y crea si no existe) el directorio configurado en CACHE_DIR."""
+    cache_dir = os.getenv("CACHE_DIR", DEFAULT_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+class SQLiteCache:
+    """
+    Caché clave/valor en SQLite con expiración por entrada.
+
+    Los valores se guardan como JSON. Las operaciones son síncronas (rápidas, una fila),
+    por lo que desde código async deben ejecutarse en el executor.
+    """
+
+    def __init__(self, path: str, table: str = "cache"):
+        """
+        Args:
+            path: Ruta del archivo SQLite
+            table: Nombre de la tabla (permite varias cachés en el mismo archivo)
+        """
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        removed = self.purge_expired()
+        logger.info(f"💾 Caché persistente '{table}' abierta en {path} ({removed} entradas expiradas eliminadas)")
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """
+        Conexión abierta a SQLite. Se reabre si close() la cerró: el singleton que usa la caché
+        sobrevive a un apagado del lifespan (recarga, TestClient) y vuelve a usarse después.
+        """
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        return self._conn
+
+    def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        """
+        Devuelve (valor, segundos_restantes) para key o None si no existe o expiró.
+
+        Los segundos restantes permiten poblar una caché en memoria sin extender el TTL.
+        """
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            return None
+        return json.loads(value), remaining
+
+    def set(self, key: str, value: Any, ttl: float):
+        """Guarda (o reemplaza) un valor con tiempo de vida ttl en segundos."""
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), time.time() + ttl)
+            )
+
+    def update(self, key: str, func: Callable[[Optional[Any]], Optional[Any]], ttl: float) -> Optional[Any]:
+        """
+        Lee y reescribe key en una sola transacción (BEGIN IMMEDIATE): ningún otro proceso
+        puede escribir en la tabla entre la lectura y la escritura.
+
+        Args:
+            key: Clave a actualizar
+            func: Recibe el valor actual (None si no existe o expiró) y devuelve el nuevo
+                valor, o None para no modificar nada
+            ttl: Tiempo de vida en segundos del valor guardado
+
+        Returns:
+            El valor guardado, o None si func no devolvió nada
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                current = json.loads(row[0]) if row is not None and row[1] > time.time() else None
+                value = func(current)
+                if value is not None:
+                    self._db.execute(
+                        f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                        (key, json.dumps(value, ensure_ascii=False), time.time() + ttl)
+                    )
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        return value
+
+    def delete(self, key: str):
+        """Elimina una entrada si existe."""
+        with self._lock:
+            self._db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def purge_expired(self) -> int:
+        """Elimina las entradas expiradas y devuelve cuántas se borraron."""
+        with self._lock:
+            cursor = self._db.execute(
+                f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),)
+            )
+        return cursor.rowcount
+
+    def close(self):
+        """
+        Vuelca el WAL al archivo principal (checkpoint TRUNCATE) y cierra la conexión.
+
+        Se llama al apagar la aplicación; si la caché se vuelve a usar, la conexión se reabre.
+        """
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as e:
+                # Otro proceso con lecturas abiertas puede impedir el checkpoint; se cierra igual
+                logger.warning(f"⚠️  No se pudo hacer checkpoint del WAL de '{self.table}': {e}")
+            self._conn.close()
+            self._conn = None
+            logger.info(f"💾 Caché persistente '{self.table}' cerrada ({self.path})")
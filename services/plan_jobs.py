@@ -0,0 +1,408 @@
+"""
+Cola persistente para generar planes en segundo plano.
+
+POST /api/plan/jobs encola la solicitud y responde de inmediato con un job_id; un pool de
+workers del mismo proceso consume la cola y el cliente consulta el resultado (polling o SSE).
+Ninguna conexión HTTP queda abierta mientras Gemini genera, y un reintento del cliente se
+une al trabajo pendiente en lugar de empezar de cero.
+
+La cola vive en SQLite (modo WAL): sobrevive reinicios y la comparten varios workers de
+gunicorn. Cada trabajo tomado tiene un lease; si el proceso muere, el trabajo vuelve a la
+cola cuando el lease vence.
+"""
+import asyncio
+import os
+import json
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from services.concurrency import OverloadedError
+from services.persistent_cache import get_cache_dir
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+# Función que genera el resultado de un trabajo: solicitud -> respuesta de /api/plan
+JobRunner = Callable[[Dict], Awaitable[Dict]]
+
+# Mensaje que ve el cliente cuando un trabajo falla (el detalle queda en los logs)
+JOB_ERROR_DETAIL = "Ocurrió un error consultando a la IA"
+
+
+class JobLimitError(Exception):
+    """El usuario ya tiene el máximo de trabajos pendientes."""
+
+
+class PlanJobQueue:
+    """
+    Cola de trabajos en SQLite con workers asyncio.
+
+    Estados: queued -> running -> done | failed. Un trabajo saturado (OverloadedError) vuelve
+    a queued con una espera de retry_after segundos. Los resultados se conservan
+    result_ttl_seconds y después se eliminan.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        workers: int = 2,
+        max_per_uid: int = 3,
+        max_queued: int = 200,
+        result_ttl_seconds: float = 3600,
+        lease_seconds: float = 300,
+        max_attempts: int = 3,
+        poll_interval: float = 1.0
+    ):
+        """
+        Args:
+            path: Ruta del archivo SQLite (":memory:" para una cola por proceso)
+            workers: Trabajos que este proceso ejecuta a la vez
+            max_per_uid: Trabajos pendientes (en cola o en curso) por usuario
+            max_queued: Trabajos en cola en total; más allá se responde 503
+            result_ttl_seconds: Tiempo durante el cual se puede consultar un trabajo terminado
+            lease_seconds: Tiempo tras el cual un trabajo en curso sin terminar vuelve a la cola
+            max_attempts: Veces que un trabajo se toma antes de darlo por fallido
+            poll_interval: Segundos entre consultas a la cola (trabajos encolados por otros procesos)
+        """
+        self.path = path
+        self.workers = max(1, workers)
+        self.max_per_uid = max_per_uid
+        self.max_queued = max_queued
+        self.result_ttl_seconds = result_ttl_seconds
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS plan_jobs ("
+            "job_id TEXT PRIMARY KEY, uid TEXT NOT NULL, dedup_key TEXT NOT NULL, "
+            "status TEXT NOT NULL, request TEXT NOT NULL, result TEXT, error TEXT, "
+            "attempts INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, available_at REAL NOT NULL, "
+            "started_at REAL, finished_at REAL, lease_until REAL, expires_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_plan_jobs_status ON plan_jobs (status, available_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_plan_jobs_uid ON plan_jobs (uid, status)")
+
+        self._runner: Optional[JobRunner] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: Set[str] = set()
+        self._wakeup = asyncio.Event()
+        self._changed = asyncio.Event()
+
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.requeued = 0
+        self.purged = self.purge_expired()
+        logger.info(f"📥 Cola de planes en {path} ({self.purged} trabajos expirados eliminados)")
+
+    # --- Operaciones sobre SQLite (síncronas: desde async van por el executor) ---
+
+    def _transaction(self, func: Callable[[], Any]) -> Any:
+        # BEGIN IMMEDIATE: dos procesos no pueden tomar el mismo trabajo
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func()
+                self._conn.execute("COMMIT")
+                return result
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def submit(self, uid: str, request: Dict, dedup_key: str) -> Tuple[Dict, bool]:
+        """
+        Encola una solicitud, o devuelve el trabajo pendiente idéntico del mismo usuario.
+
+        Returns:
+            Tuple[Dict, bool]: (trabajo, deduplicado)
+
+        Raises:
+            JobLimitError: Si el usuario ya tiene max_per_uid trabajos pendientes
+            OverloadedError: Si la cola está llena
+        """
+        def insert():
+            existing = self._conn.execute(
+                "SELECT * FROM plan_jobs WHERE uid = ? AND dedup_key = ? AND status IN ('queued', 'running') "
+                "ORDER BY created_at LIMIT 1",
+                (uid, dedup_key)
+            ).fetchone()
+            if existing is not None:
+                return existing, True
+            active = self._conn.execute(
+                "SELECT COUNT(*) FROM plan_jobs WHERE uid = ? AND status IN ('queued', 'running')", (uid,)
+            ).fetchone()[0]
+            if active >= self.max_per_uid:
+                raise JobLimitError(
+                    f"Ya tienes {active} planes en preparación. Espera a que terminen para pedir otro."
+                )
+            queued = self._conn.execute("SELECT COUNT(*) FROM plan_jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise OverloadedError(f"Cola de planes llena ({queued} trabajos)", retry_after=30)
+            now = time.time()
+            job_id = secrets.token_urlsafe(12)
+            self._conn.execute(
+                "INSERT INTO plan_jobs (job_id, uid, dedup_key, status, request, created_at, available_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, uid, dedup_key, json.dumps(request, ensure_ascii=False), now, now)
+            )
+            return self._conn.execute("SELECT * FROM plan_jobs WHERE job_id = ?", (job_id,)).fetchone(), False
+
+        try:
+            row, deduplicated = self._transaction(insert)
+        except (JobLimitError, OverloadedError):
+            self.rejected += 1
+            raise
+        if deduplicated:
+            self.deduplicated += 1
+        else:
+            self.submitted += 1
+        return self._to_dict(row), deduplicated
+
+    def claim(self) -> Optional[Tuple[str, Dict]]:
+        """Toma el trabajo disponible más antiguo (o uno cuyo lease venció). None si no hay."""
+        def take():
+            now = time.time()
+            row = self._conn.execute(
+                "SELECT job_id, request FROM plan_jobs WHERE attempts < ? AND ("
+                "(status = 'queued' AND available_at <= ?) OR (status = 'running' AND lease_until < ?)) "
+                "ORDER BY created_at LIMIT 1",
+                (self.max_attempts, now, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE plan_jobs SET status = 'running', started_at = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE job_id = ?",
+                (now, now + self.lease_seconds, row[0])
+            )
+            return row[0], json.loads(row[1])
+
+        return self._transaction(take)
+
+    def complete(self, job_id: str, result: Dict) -> None:
+        """Guarda el resultado de un trabajo terminado."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE plan_jobs SET status = 'done', result = ?, finished_at = ?, expires_at = ?, lease_until = NULL "
+                "WHERE job_id = ?",
+                (json.dumps(result, ensure_ascii=False), now, now + self.result_ttl_seconds, job_id)
+            )
+
+    def fail(self, job_id: str, error: str) -> None:
+        """Marca un trabajo como fallido."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE plan_jobs SET status = 'failed', error = ?, finished_at = ?, expires_at = ?, lease_until = NULL "
+                "WHERE job_id = ?",
+                (error, now, now + self.result_ttl_seconds, job_id)
+            )
+
+    def requeue(self, job_id: str, delay: float = 0) -> None:
+        """Devuelve un trabajo a la cola sin contarlo como intento (Gemini saturado o apagado)."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE plan_jobs SET status = 'queued', available_at = ?, started_at = NULL, lease_until = NULL, "
+                "attempts = MAX(attempts - 1, 0) WHERE job_id = ? AND status = 'running'",
+                (time.time() + delay, job_id)
+            )
+
+    def get(self, job_id: str, uid: str) -> Optional[Dict]:
+        """Devuelve el trabajo si existe, no expiró y pertenece a uid."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM plan_jobs WHERE job_id = ? AND uid = ?", (job_id, uid)
+            ).fetchone()
+            if row is None or (row["expires_at"] is not None and row["expires_at"] <= time.time()):
+                return None
+            position = None
+            if row["status"] == "queued":
+                position = self._conn.execute(
+                    "SELECT COUNT(*) FROM plan_jobs WHERE status = 'queued' AND created_at < ?", (row["created_at"],)
+                ).fetchone()[0]
+        job = self._to_dict(row)
+        job["queue_position"] = position
+        return job
+
+    def purge_expired(self) -> int:
+        """
+        Elimina los trabajos terminados cuya retención venció y da por fallidos los que
+        agotaron sus intentos. Devuelve cuántos se eliminaron.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE plan_jobs SET status = 'failed', error = ?, finished_at = ?, expires_at = ? "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (JOB_ERROR_DETAIL, now, now + self.result_ttl_seconds, now, self.max_attempts)
+            )
+            cursor = self._conn.execute(
+                "DELETE FROM plan_jobs WHERE status IN ('done', 'failed') AND expires_at <= ?", (now,)
+            )
+        return cursor.rowcount
+
+    def _to_dict(self, row: sqlite3.Row) -> Dict:
+        return {
+            "job_id": row["job_id"],
+            "status": row["status"],
+            "created_at": row["created_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"],
+            "attempts": row["attempts"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"]
+        }
+
+    # --- Workers y variantes async ---
+
+    def start(self, runner: JobRunner) -> None:
+        """Lanza los workers en el event loop actual (no hace nada si ya están corriendo)."""
+        self._runner = runner
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self) -> None:
+        """Detiene los workers; los trabajos en curso vuelven a la cola para otro proceso."""
+        # Los workers cancelados retiran su trabajo de _running: se toma la lista antes
+        running = list(self._running)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job_id in running:
+            self.requeue(job_id)
+        self._running.clear()
+        if running:
+            logger.info(f"📦 {len(running)} trabajo(s) de plan devueltos a la cola al detener los workers")
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                claimed = await loop.run_in_executor(None, self.claim)
+            except Exception as e:
+                logger.warning(f"⚠️  No se pudo leer la cola de planes: {e}")
+                claimed = None
+            if claimed is None:
+                await self._wait(self._wakeup, self.poll_interval)
+                continue
+
+            job_id, request = claimed
+            self._running.add(job_id)
+            self._notify()
+            try:
+                result = await self._runner(request)
+                await loop.run_in_executor(None, self.complete, job_id, result)
+                self.completed += 1
+                logger.info(f"📦 Trabajo de plan {job_id} terminado")
+            except OverloadedError as e:
+                # Gemini saturado: el trabajo espera en la cola en lugar de fallar
+                await loop.run_in_executor(None, self.requeue, job_id, e.retry_after)
+                self.requeued += 1
+                logger.info(f"🚦 Trabajo de plan {job_id} reencolado por {e.retry_after}s: Gemini saturado")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Trabajo de plan {job_id} fallido: {type(e).__name__}: {e}")
+                await loop.run_in_executor(None, self.fail, job_id, JOB_ERROR_DETAIL)
+                self.failed += 1
+            finally:
+                self._running.discard(job_id)
+            self._notify()
+            self.purged += await loop.run_in_executor(None, self.purge_expired)
+
+    @staticmethod
+    async def _wait(event: asyncio.Event, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _notify(self) -> None:
+        # Despierta a quienes esperan un cambio de estado (SSE) con un evento nuevo por cambio
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait_for_change(self, timeout: float) -> None:
+        """Espera hasta que algún trabajo de este proceso cambie de estado (o timeout)."""
+        await self._wait(self._changed, timeout)
+
+    async def submit_async(self, uid: str, request: Dict, dedup_key: str) -> Tuple[Dict, bool]:
+        job, deduplicated = await asyncio.get_running_loop().run_in_executor(
+            None, self.submit, uid, request, dedup_key
+        )
+        if not deduplicated:
+            self._wakeup.set()
+            self._wakeup = asyncio.Event()
+        return job, deduplicated
+
+    async def get_async(self, job_id: str, uid: str) -> Optional[Dict]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, job_id, uid)
+
+    def stats(self) -> Dict:
+        """Contadores de la cola de este proceso."""
+        return {
+            "workers": len([task for task in self._tasks if not task.done()]),
+            "running": len(self._running),
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "requeued": self.requeued,
+            "purged": self.purged
+        }
+
+    def close(self) -> None:
+        """Cierra la conexión a SQLite."""
+        with self._lock:
+            self._conn.close()
+
+
+# Instancia global de la cola de planes
+_plan_job_queue: Optional[PlanJobQueue] = None
+
+
+def get_plan_job_queue() -> PlanJobQueue:
+    """
+    Obtiene la instancia singleton de la cola de planes.
+
+    La cola se guarda en PLAN_JOBS_DB_PATH (compartida entre workers); si no se puede abrir,
+    se usa una cola en memoria por proceso.
+
+    Returns:
+        PlanJobQueue: Instancia configurada con las variables PLAN_JOB*
+    """
+    global _plan_job_queue
+
+    if _plan_job_queue is None:
+        options = dict(
+            workers=int(os.getenv("PLAN_JOB_WORKERS", "2")),
+            max_per_uid=int(os.getenv("PLAN_JOB_MAX_PER_UID", "3")),
+            max_queued=int(os.getenv("PLAN_JOB_MAX_QUEUED", "200")),
+            result_ttl_seconds=float(os.getenv("PLAN_JOB_RESULT_TTL_SECONDS", "3600")),
+            lease_seconds=float(os.getenv("PLAN_JOB_LEASE_SECONDS", "300")),
+            poll_interval=float(os.getenv("PLAN_JOB_POLL_SECONDS", "1.0"))
+        )
+        path = os.getenv("PLAN_JOBS_DB_PATH", os.path.join(get_cache_dir(), "plan_jobs.sqlite3"))
+        try:
+            _plan_job_queue = PlanJobQueue(path, **options)
+        except Exception as e:
+            logger.warning(f"⚠️  No se pudo abrir la cola de planes en {path}: {e}. Usando memoria.")
+            _plan_job_queue = PlanJobQueue(":memory:", **options)
+
+    return _plan_job_queue
@@ -0,0 +1,495 @@
+"""
+Estadísticas de uso (planes generados y ranking de destinos) con persistencia en lote.
+
+Los contadores se acumulan en memoria y una tarea en segundo plano los guarda cada cierto
+intervalo o tras N eventos, fuera del event loop. Hay dos backends:
+- JSON (un solo proceso): escritura atómica (archivo temporal + os.replace), para que un
+  crash nunca deje stats.json truncado.
+- SQLite en modo WAL (varios workers de gunicorn): upserts de contadores, sin pérdidas.
+"""
+import os
+import json
+import asyncio
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+# Cargar variables de entorno
+load_dotenv()
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+
+def normalize_destination(destination: str) -> str:
+    """Clave del ranking de destinos (misma normalización que el contador original)."""
+    return destination.strip().lower() if destination else ""
+
+
+def atomic_write_json(path: str, data: Dict) -> None:
+    """Escribe data como JSON en path sin dejar nunca un archivo a medio escribir."""
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class BatchedStatsStore(ABC):
+    """
+    Base de los almacenes de estadísticas: acumula en memoria y guarda en lote.
+
+    Las subclases implementan record_plan, flush, summary y store_stats; esta clase se encarga
+    de la tarea en segundo plano que llama a flush (en el executor) cada flush_interval
+    segundos o en cuanto hay flush_every eventos pendientes.
+    """
+
+    def __init__(self, flush_interval: float = 5.0, flush_every: int = 50):
+        """
+        Args:
+            flush_interval: Segundos máximos entre flushes si hay cambios pendientes
+            flush_every: Número de eventos pendientes que fuerza un flush inmediato
+        """
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+
+        self._lock = threading.Lock()
+        # Serializa los flushes (el periódico en el executor y el final al apagar)
+        self._flush_lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.flushes = 0
+
+    @abstractmethod
+    def record_plan(self, destination: str) -> None:
+        """Registra un plan generado (solo memoria; el guardado ocurre en segundo plano)."""
+
+    @abstractmethod
+    def flush(self) -> None:
+        """Guarda los cambios pendientes (bloqueante: llamar desde el executor)."""
+
+    @abstractmethod
+    def summary(self, top_n: int = 5) -> Dict:
+        """Totales y los top_n destinos más solicitados."""
+
+    @abstractmethod
+    def store_stats(self) -> Dict:
+        """Contadores del propio almacenamiento para /api/stats."""
+
+    def _describe(self) -> str:
+        return ""
+
+    def _notify_pending(self, pending: int) -> None:
+        """Despierta la tarea de guardado si ya hay suficientes eventos pendientes."""
+        if pending >= self.flush_every and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _flush_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await loop.run_in_executor(None, self.flush)
+
+    async def start(self) -> None:
+        """Inicia la tarea de guardado periódico (llamado desde el lifespan)."""
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._flush_loop())
+            logger.info(
+                f"📊 Guardado de estadísticas cada {self.flush_interval:.0f}s o {self.flush_every} eventos"
+                + self._describe()
+            )
+
+    async def stop(self) -> None:
+        """Detiene la tarea periódica y hace un último flush para no perder eventos."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._loop = None
+        await asyncio.get_running_loop().run_in_executor(None, self.flush)
+
+
+class JSONStatsStore(BatchedStatsStore):
+    """
+    Acumulador de estadísticas persistido en un archivo JSON (un solo proceso).
+
+    Modo snapshot (por defecto): cada flush reescribe el archivo completo de forma atómica.
+    Modo event log (STATS_EVENT_LOG=true): cada flush solo agrega los eventos nuevos a un
+    log append-only y el snapshot se compacta cada cierto número de flushes; al arrancar se
+    carga el snapshot y se reproducen los eventos posteriores a él.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval: float = 5.0,
+        flush_every: int = 50,
+        event_log: bool = False,
+        compact_every: int = 100
+    ):
+        """
+        Args:
+            path: Ruta del snapshot JSON
+            flush_interval: Segundos máximos entre flushes si hay cambios pendientes
+            flush_every: Número de eventos pendientes que fuerza un flush inmediato
+            event_log: Activa el log de eventos append-only ({path}.events.jsonl)
+            compact_every: Flushes del log entre compactaciones del snapshot
+        """
+        super().__init__(flush_interval=flush_interval, flush_every=flush_every)
+        self.path = path
+        self.log_path = f"{path}.events.jsonl"
+        self.event_log = event_log
+        self.compact_every = compact_every
+
+        self.total_plans_generated = 0
+        self.destinations_counter: Counter = Counter()
+        self.last_reset = datetime.now().isoformat()
+
+        # Secuencia del último evento registrado y del último incluido en el snapshot:
+        # al reproducir el log se ignoran los eventos ya compactados
+        self._seq = 0
+        self._snapshot_seq = 0
+        self._pending_events: List[Dict] = []
+        self._dirty = False
+        self._log_flushes = 0
+        self.load()
+
+    def load(self) -> None:
+        """Carga el snapshot y, en modo event log, reproduce los eventos posteriores."""
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    loaded = json.load(f)
+                self.total_plans_generated = loaded.get("total_plans_generated", 0)
+                self.destinations_counter = Counter(loaded.get("destinations_counter", {}))
+                self.last_reset = loaded.get("last_reset", self.last_reset)
+                self._snapshot_seq = self._seq = loaded.get("seq", 0)
+        except Exception as e:
+            logger.warning(f"⚠️  No se pudo cargar {self.path}: {e}. Iniciando con valores por defecto.")
+
+        replayed = 0
+        if self.event_log and os.path.exists(self.log_path):
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Última línea incompleta por un crash a mitad de escritura
+                        continue
+                    # Ya incluido en el snapshot (o duplicado por un flush reintentado)
+                    if event["seq"] <= self._seq:
+                        continue
+                    self._apply(event.get("destination", ""))
+                    self._seq = event["seq"]
+                    replayed += 1
+            # Compactar al arrancar: el log queda vacío y sin posibles líneas truncadas
+            try:
+                atomic_write_json(self.path, self._snapshot())
+                self._snapshot_seq = self._seq
+                open(self.log_path, 'w').close()
+            except Exception as e:
+                logger.warning(f"⚠️  No se pudo compactar el log de estadísticas: {e}")
+
+        logger.info(
+            f"📊 Estadísticas cargadas: {self.total_plans_generated} planes generados"
+            + (f" ({replayed} eventos reproducidos del log)" if replayed else "")
+        )
+
+    def _apply(self, destination: str) -> None:
+        self.total_plans_generated += 1
+        if destination:
+            self.destinations_counter[destination] += 1
+
+    def record_plan(self, destination: str) -> None:
+        destination_lower = normalize_destination(destination)
+        with self._lock:
+            self._apply(destination_lower)
+            self._seq += 1
+            self._dirty = True
+            if self.event_log:
+                self._pending_events.append({"seq": self._seq, "destination": destination_lower})
+            pending = self._seq - self._snapshot_seq if not self.event_log else len(self._pending_events)
+        self._notify_pending(pending)
+
+    def summary(self, top_n: int = 5) -> Dict:
+        with self._lock:
+            return {
+                "total_plans_generated": self.total_plans_generated,
+                "top_destinations": self.destinations_counter.most_common(top_n),
+                "last_reset": self.last_reset
+            }
+
+    def _snapshot(self) -> Dict:
+        # Debe llamarse con self._lock tomado
+        return {
+            "total_plans_generated": self.total_plans_generated,
+            "destinations_counter": dict(self.destinations_counter),
+            "last_reset": self.last_reset,
+            "seq": self._seq
+        }
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                events, self._pending_events = self._pending_events, []
+                compact = not self.event_log or self._log_flushes + 1 >= self.compact_every
+                snapshot = self._snapshot() if compact else None
+                self._dirty = False
+
+            try:
+                if self.event_log and events:
+                    with open(self.log_path, 'a') as f:
+                        f.write("".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    self._log_flushes += 1
+
+                if snapshot is not None:
+                    atomic_write_json(self.path, snapshot)
+                    self._snapshot_seq = snapshot["seq"]
+                    if self.event_log:
+                        # El snapshot ya incluye todos los eventos del log (seq <= snapshot["seq"])
+                        open(self.log_path, 'w').close()
+                        self._log_flushes = 0
+                self.flushes += 1
+            except Exception as e:
+                logger.warning(f"⚠️  No se pudieron guardar las estadísticas en {self.path}: {e}")
+                with self._lock:
+                    self._pending_events = events + self._pending_events
+                    self._dirty = True
+
+    def _describe(self) -> str:
+        return " (event log)" if self.event_log else ""
+
+    def store_stats(self) -> Dict:
+        with self._lock:
+            pending = len(self._pending_events) if self.event_log else (self._seq - self._snapshot_seq)
+        return {
+            "backend": "json",
+            "event_log": self.event_log,
+            "flushes": self.flushes,
+            "pending_events": pending
+        }
+
+
+class SQLiteStatsStore(BatchedStatsStore):
+    """
+    Estadísticas compartidas entre procesos en SQLite (modo WAL).
+
+    Pensado para gunicorn con varios workers: cada worker acumula deltas en memoria y los
+    suma a la base con upserts (count = count + delta) en una transacción, así ningún worker
+    sobrescribe los contadores de otro. summary() lee los totales agregados de todos los
+    workers con una consulta indexada.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval: float = 5.0,
+        flush_every: int = 50,
+        import_json_path: Optional[str] = None
+    ):
+        """
+        Args:
+            path: Ruta del archivo SQLite (compartido por todos los workers)
+            flush_interval: Segundos máximos entre flushes si hay cambios pendientes
+            flush_every: Número de eventos pendientes que fuerza un flush inmediato
+            import_json_path: stats.json a importar una única vez si la base está vacía
+        """
+        super().__init__(flush_interval=flush_interval, flush_every=flush_every)
+        self.path = path
+        self._pending_total = 0
+        self._pending_destinations: Counter = Counter()
+
+        # La conexión tiene su propio lock: una escritura esperando a otro worker
+        # (busy timeout) no debe bloquear record_plan en el event loop
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS destinations ("
+            "destination TEXT PRIMARY KEY, count INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_destinations_count ON destinations (count DESC)")
+        self._initialize(import_json_path)
+
+    def _initialize(self, import_json_path: Optional[str]) -> None:
+        # BEGIN IMMEDIATE: si varios workers arrancan a la vez, solo uno inicializa/importa
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                initialized = self._conn.execute(
+                    "SELECT value FROM meta WHERE key = 'last_reset'"
+                ).fetchone()
+                if initialized is None:
+                    last_reset = datetime.now().isoformat()
+                    imported = 0
+                    if import_json_path and os.path.exists(import_json_path):
+                        try:
+                            with open(import_json_path, 'r') as f:
+                                legacy = json.load(f)
+                            last_reset = legacy.get("last_reset", last_reset)
+                            imported = legacy.get("total_plans_generated", 0)
+                            self._upsert(imported, Counter(legacy.get("destinations_counter", {})))
+                            logger.info(f"📊 Estadísticas importadas desde {import_json_path}: {imported} planes")
+                        except Exception as e:
+                            logger.warning(f"⚠️  No se pudo importar {import_json_path}: {e}")
+                    self._conn.execute(
+                        "INSERT INTO meta (key, value) VALUES ('last_reset', ?)", (last_reset,)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logger.info(f"📊 Estadísticas en SQLite: {self.path}")
+
+    def _upsert(self, total: int, destinations: Counter) -> None:
+        # Debe llamarse dentro de una transacción
+        self._conn.execute(
+            "INSERT INTO counters (name, value) VALUES ('total_plans_generated', ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (total,)
+        )
+        self._conn.executemany(
+            "INSERT INTO destinations (destination, count) VALUES (?, ?) "
+            "ON CONFLICT(destination) DO UPDATE SET count = count + excluded.count",
+            list(destinations.items())
+        )
+
+    def record_plan(self, destination: str) -> None:
+        destination_lower = normalize_destination(destination)
+        with self._lock:
+            self._pending_total += 1
+            if destination_lower:
+                self._pending_destinations[destination_lower] += 1
+            pending = self._pending_total
+        self._notify_pending(pending)
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending_total:
+                    return
+                total, self._pending_total = self._pending_total, 0
+                destinations, self._pending_destinations = self._pending_destinations, Counter()
+
+            try:
+                with self._db_lock:
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        self._upsert(total, destinations)
+                        self._conn.execute("COMMIT")
+                    except Exception:
+                        self._conn.execute("ROLLBACK")
+                        raise
+                self.flushes += 1
+            except Exception as e:
+                logger.warning(f"⚠️  No se pudieron guardar las estadísticas en {self.path}: {e}")
+                # Devolver los deltas para reintentarlos en el próximo flush
+                with self._lock:
+                    self._pending_total += total
+                    self._pending_destinations.update(destinations)
+
+    def summary(self, top_n: int = 5) -> Dict:
+        """Totales agregados de todos los workers (sin los eventos aún no guardados)."""
+        with self._db_lock:
+            total = self._conn.execute(
+                "SELECT value FROM counters WHERE name = 'total_plans_generated'"
+            ).fetchone()
+            top = self._conn.execute(
+                "SELECT destination, count FROM destinations ORDER BY count DESC, destination LIMIT ?",
+                (top_n,)
+            ).fetchall()
+            last_reset = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'last_reset'"
+            ).fetchone()
+        return {
+            "total_plans_generated": total[0] if total else 0,
+            "top_destinations": [(destination, count) for destination, count in top],
+            "last_reset": last_reset[0] if last_reset else "N/A"
+        }
+
+    def _describe(self) -> str:
+        return " (SQLite compartido)"
+
+    def store_stats(self) -> Dict:
+        with self._lock:
+            pending = self._pending_total
+        return {
+            "backend": "sqlite",
+            "flushes": self.flushes,
+            "pending_events": pending
+        }
+
+    def close(self) -> None:
+        """Cierra la conexión a SQLite."""
+        with self._db_lock:
+            self._conn.close()
+
+
+# Instancia global del almacén de estadísticas
+_stats_store: Optional[BatchedStatsStore] = None
+
+
+def get_stats_store() -> BatchedStatsStore:
+    """
+    Obtiene la instancia singleton del almacén de estadísticas.
+
+    STATS_BACKEND=json (por defecto) guarda en STATS_FILE y sirve para un solo proceso;
+    STATS_BACKEND=sqlite guarda en STATS_DB_PATH y es consistente con varios workers.
+
+    Returns:
+        BatchedStatsStore: Instancia configurada con las variables STATS_*
+    """
+    global _stats_store
+
+    if _stats_store is None:
+        backend = os.getenv("STATS_BACKEND", "json").lower()
+        flush_interval = float(os.getenv("STATS_FLUSH_INTERVAL_SECONDS", "5"))
+        flush_every = int(os.getenv("STATS_FLUSH_EVERY", "50"))
+        stats_file = os.getenv("STATS_FILE", "stats.json")
+
+        if backend == "sqlite":
+            _stats_store = SQLiteStatsStore(
+                path=os.getenv("STATS_DB_PATH", "stats.sqlite3"),
+                flush_interval=flush_interval,
+                flush_every=flush_every,
+                import_json_path=stats_file
+            )
+        else:
+            if backend != "json":
+                logger.warning(f"⚠️  STATS_BACKEND desconocido '{backend}'. Usando 'json'.")
+            _stats_store = JSONStatsStore(
+                path=stats_file,
+                flush_interval=flush_interval,
+                flush_every=flush_every,
+                event_log=os.getenv("STATS_EVENT_LOG", "false").lower() == "true"
+            )
+
+    return _stats_store
@@ -0,0 +1,309 @@
+"""
+Trazas por solicitud: desglose de latencia por etapa (auth, validación, Gemini, clima, imágenes).
+
+- Cada solicitud HTTP abre una traza (contextvars) con un trace id que aparece en los logs.
+- Las etapas se miden con `with span("gemini"):` desde cualquier punto del código que corre
+  dentro de la solicitud (también en tareas de asyncio.gather y, con run_in_context, en hilos).
+- La respuesta incluye el header Server-Timing (visible en las DevTools del navegador) y
+  X-Trace-Id para correlacionar un reporte de usuario con los logs.
+- Opcionalmente los spans se exportan como JSON (formato OTLP de OpenTelemetry) a stdout o a
+  un archivo, una línea por traza.
+"""
+import json
+import logging
+import os
+import random
+import secrets
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Exportador de spans: "" (desactivado), "stdout" o "file"
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "").strip().lower()
+TRACE_EXPORT_FILE = os.getenv(
+    "TRACE_EXPORT_FILE",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "backend", "logs", "traces.jsonl")
+)
+# Fracción de trazas exportadas (Server-Timing y logs no se ven afectados)
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+# Solicitudes más lentas que esto se registran en el log con su desglose por etapa
+TRACE_SLOW_REQUEST_SECONDS = float(os.getenv("TRACE_SLOW_REQUEST_SECONDS", "10"))
+
+SERVICE_NAME = "viajeia-backend"
+
+
+class Span:
+    """Una etapa medida dentro de una traza."""
+
+    __slots__ = ("name", "span_id", "parent_id", "attributes", "start_ns", "end_ns", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error = False
+
+    def end(self) -> None:
+        self.end_ns = time.time_ns()
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def to_otlp(self, trace_id: str) -> Dict[str, Any]:
+        """Span en el formato JSON de OTLP."""
+        span = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2 if self.error else 1}  # ERROR / OK
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Trace:
+    """Traza de una solicitud: span raíz más las etapas medidas durante la solicitud."""
+
+    def __init__(self, name: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None):
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.root = Span(name, parent_id)
+        self.spans: List[Span] = []
+
+    def stage_durations(self) -> Dict[str, float]:
+        """Duración (ms) de cada etapa terminada, sumando las que se repiten, en orden de inicio."""
+        durations: Dict[str, float] = {}
+        for span in sorted(self.spans, key=lambda s: s.start_ns):
+            if span.end_ns is not None:
+                durations[span.name] = durations.get(span.name, 0.0) + span.duration_ms
+        return durations
+
+    def server_timing(self) -> str:
+        """Valor del header Server-Timing con las etapas terminadas y el total hasta ahora."""
+        entries = [f"{name};dur={duration:.1f}" for name, duration in self.stage_durations().items()]
+        entries.append(f"total;dur={self.root.duration_ms:.1f}")
+        return ", ".join(entries)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """Traza completa como ExportTraceServiceRequest de OTLP/JSON."""
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+                "scopeSpans": [{
+                    "scope": {"name": __name__},
+                    "spans": [span.to_otlp(self.trace_id) for span in [self.root, *self.spans]]
+                }]
+            }]
+        }
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("viajeia_trace", default=None)
+_current_span_id: ContextVar[Optional[str]] = ContextVar("viajeia_span_id", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    """Traza de la solicitud en curso (None fuera de una solicitud)."""
+    return _current_trace.get()
+
+
+def current_trace_id() -> Optional[str]:
+    """Trace id de la solicitud en curso (None fuera de una solicitud)."""
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """
+    Mide una etapa de la solicitud en curso (no hace nada fuera de una solicitud).
+
+    Los spans abiertos dentro del bloque quedan como hijos de este.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+
+    current = Span(name, _current_span_id.get() or trace.root.span_id, attributes)
+    token = _current_span_id.set(current.span_id)
+    try:
+        yield current
+    except BaseException:
+        current.error = True
+        raise
+    finally:
+        current.end()
+        _current_span_id.reset(token)
+        trace.spans.append(current)
+
+
+async def traced(name: str, awaitable, **attributes: Any) -> Any:
+    """Espera un awaitable dentro de un span (útil para las tareas de asyncio.gather)."""
+    with span(name, **attributes):
+        return await awaitable
+
+
+def run_in_context(func: Callable[..., Any], *args, **kwargs) -> Callable[[], Any]:
+    """
+    Prepara una función para correr en un executor conservando la traza actual.
+
+    run_in_executor no copia los contextvars al hilo: sin esto, los logs y spans del hilo
+    no tendrían trace id.
+    """
+    return partial(copy_context().run, func, *args, **kwargs)
+
+
+class TraceIdFilter(logging.Filter):
+    """Agrega trace_id a cada registro de log ("-" fuera de una solicitud)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = current_trace_id() or "-"
+        return True
+
+
+def _parse_traceparent(value: str) -> Optional[tuple]:
+    # W3C Trace Context: version-traceid-parentid-flags
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32:
+        return None
+    return parts[1], parts[2]
+
+
+class SpanExporter:
+    """Escribe trazas terminadas como JSON de OTLP, una línea por traza."""
+
+    def __init__(self, target: str, path: str, sample_ratio: float):
+        self.sample_ratio = sample_ratio
+        self._logger = logging.getLogger("viajeia.traces")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        if target == "file":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            handler: logging.Handler = logging.FileHandler(path, encoding="utf-8")
+        else:
+            handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._logger.addHandler(handler)
+        self.exported = 0
+
+    def export(self, trace: Trace) -> None:
+        if self.sample_ratio < 1.0 and random.random() >= self.sample_ratio:
+            return
+        self._logger.info(json.dumps(trace.to_otlp(), ensure_ascii=False, separators=(",", ":")))
+        self.exported += 1
+
+
+# Instancia global del exportador (None si TRACE_EXPORTER no está configurado)
+_exporter: Optional[SpanExporter] = None
+
+
+def get_span_exporter() -> Optional[SpanExporter]:
+    """
+    Obtiene la instancia singleton del exportador de spans.
+
+    Returns:
+        Optional[SpanExporter]: El exportador, o None si TRACE_EXPORTER no es "stdout" ni "file"
+    """
+    global _exporter
+
+    if _exporter is None and TRACE_EXPORTER in ("stdout", "file"):
+        _exporter = SpanExporter(TRACE_EXPORTER, TRACE_EXPORT_FILE, TRACE_SAMPLE_RATIO)
+        logger.info(f"🧵 Exportando trazas a {TRACE_EXPORT_FILE if TRACE_EXPORTER == 'file' else 'stdout'}")
+
+    return _exporter
+
+
+class TracingMiddleware:
+    """
+    Middleware ASGI que abre una traza por solicitud HTTP.
+
+    Respeta un header traceparent entrante (W3C) y agrega Server-Timing y X-Trace-Id a la
+    respuesta. En respuestas en streaming, Server-Timing solo incluye las etapas terminadas
+    antes del primer byte; el span raíz exportado cubre el stream completo.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope.get("method", "")
+        path = scope.get("path", "")
+        trace_id = parent_id = None
+        for header, value in scope.get("headers", []):
+            if header == b"traceparent":
+                parsed = _parse_traceparent(value.decode("latin-1"))
+                if parsed:
+                    trace_id, parent_id = parsed
+                break
+
+        trace = Trace(f"{method} {path}", trace_id=trace_id, parent_id=parent_id)
+        trace.root.attributes.update({"http.method": method, "http.target": path})
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span_id.set(trace.root.span_id)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                trace.root.attributes["http.status_code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                headers.append((b"x-trace-id", trace.trace_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException:
+            trace.root.error = True
+            raise
+        finally:
+            trace.root.end()
+            _current_span_id.reset(span_token)
+            _current_trace.reset(trace_token)
+            self._finish(trace)
+
+    def _finish(self, trace: Trace) -> None:
+        total_seconds = trace.root.duration_ms / 1000
+        if trace.spans and total_seconds >= TRACE_SLOW_REQUEST_SECONDS:
+            breakdown = ", ".join(f"{name}={duration:.0f}ms" for name, duration in trace.stage_durations().items())
+            logger.warning(f"🐢 Solicitud lenta {trace.root.name} [{trace.trace_id}]: {total_seconds:.1f}s ({breakdown})")
+        exporter = get_span_exporter()
+        # Solo se exportan solicitudes con etapas medidas (no /health ni /metrics)
+        if exporter is not None and trace.spans:
+            try:
+                exporter.export(trace)
+            except Exception as e:
+                logger.warning(f"⚠️  No se pudo exportar la traza: {e}")
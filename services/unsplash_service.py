@@ -3,10 +3,16 @@ Servicio de integración con Unsplash API para obtener imágenes de destinos.
 """
 import os
 import logging
-from typing import Optional, List
+import asyncio
+from typing import Optional, List, Dict
 import httpx
 from dotenv import load_dotenv
 
+from services.cache import TTLCache, SingleFlight
+from services.http_client import create_async_client
+from services.metrics import track_upstream
+from services.persistent_cache import SQLiteCache, get_cache_dir
+
 # Cargar variables de entorno
 load_dotenv()
 
@@ -21,6 +27,20 @@ class UnsplashService:
         """Inicializa el servicio de Unsplash y valida la API key."""
         self.api_key = os.getenv("UNSPLASH_ACCESS_KEY")
         self.base_url = "https://api.unsplash.com/search/photos"
+        # Cliente HTTP compartido (se crea en el lifespan de FastAPI o en el primer uso)
+        self.client: Optional[httpx.AsyncClient] = None
+        
+        # Caché de resultados en dos niveles: memoria (rápida) + SQLite en disco (sobrevive
+        # reinicios y redeploys). El límite demo de Unsplash es de 50 requests/hora.
+        self.image_ttl = float(os.getenv("IMAGE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+        self.memory_cache = TTLCache(
+            ttl_seconds=self.image_ttl,
+            max_entries=int(os.getenv("IMAGE_CACHE_MEMORY_ENTRIES", "256")),
+            name="image_cache"
+        )
+        self.disk_cache = self._open_disk_cache()
+        self.disk_hits = 0
+        self.singleflight = SingleFlight(name="unsplash")
         
         if not self.api_key:
             logger.warning(
@@ -30,10 +50,46 @@ class UnsplashService:
         else:
             logger.info("✅ Servicio de Unsplash inicializado correctamente")
     
+    def _open_disk_cache(self) -> Optional[SQLiteCache]:
+        """Abre la caché en disco; si falla (ej. disco de solo lectura) se continúa solo con memoria."""
+        if self.image_ttl <= 0:
+            return None
+        try:
+            return SQLiteCache(os.path.join(get_cache_dir(), "images.sqlite3"), table="unsplash_images")
+        except Exception as e:
+            logger.warning(f"⚠️  No se pudo abrir la caché de imágenes en disco: {e}. Usando solo memoria.")
+            return None
+    
+    async def startup(self):
+        """Crea el cliente HTTP compartido (llamado desde el lifespan de FastAPI)."""
+        if self.client is None:
+            self.client = create_async_client(timeout=10.0)
+            logger.info("🔌 Cliente HTTP de Unsplash creado (pool de conexiones con keep-alive)")
+    
+    async def shutdown(self):
+        """Cierra el cliente HTTP compartido y la caché de imágenes en disco."""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+            logger.info("🔌 Cliente HTTP de Unsplash cerrado")
+        if self.disk_cache is not None:
+            # Checkpoint del WAL y cierre de la conexión; se reabre si el servicio se reutiliza
+            await asyncio.get_running_loop().run_in_executor(None, self.disk_cache.close)
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Devuelve el cliente compartido, creándolo si el lifespan aún no lo hizo."""
+        if self.client is None:
+            self.client = create_async_client(timeout=10.0)
+        return self.client
+    
     async def get_destination_images(self, destination: str, count: int = 8) -> List[str]:
         """
         Obtiene imágenes de alta calidad de un destino usando Unsplash API.
         
+        Los resultados se cachean por destino normalizado y cantidad: primero en memoria,
+        luego en SQLite (persistente entre reinicios) y solo si ambos fallan se consulta la API.
+        Misses concurrentes para la misma clave comparten una sola llamada.
+        
         Manejo de errores robusto:
         - Si la API key no está configurada, retorna lista vacía silenciosamente
         - Si la API falla (código de estado != 200), registra un warning y retorna lista vacía
@@ -54,12 +110,69 @@ class UnsplashService:
         if not self.api_key:
             return []
         
+        key = f"{' '.join(destination.split()).lower()}|{count}"
+        images = self.memory_cache.get(key)
+        if images is None:
+            images = await self.singleflight.run(key, lambda: self._load_or_fetch(key, destination, count))
+        # Copia para que quien llama no modifique la lista cacheada
+        return list(images)
+    
+    async def _load_or_fetch(self, key: str, destination: str, count: int) -> List[str]:
+        """Busca en la caché en disco y, si no hay resultado vigente, consulta Unsplash."""
+        loop = asyncio.get_running_loop()
+        
+        if self.disk_cache is not None:
+            try:
+                stored = await loop.run_in_executor(None, self.disk_cache.get, key)
+            except Exception as e:
+                logger.warning(f"⚠️  Error al leer la caché de imágenes en disco: {e}")
+                stored = None
+            if stored is not None:
+                images, remaining = stored
+                self.disk_hits += 1
+                self.memory_cache.set(key, images, ttl=remaining)
+                logger.info(f"💾 {len(images)} imágenes servidas desde caché en disco para {destination}")
+                return images
+        
+        images = await self._fetch_images(destination, count)
+        # Una lista vacía suele indicar error o límite alcanzado: no se cachea
+        if images:
+            self.memory_cache.set(key, images)
+            if self.disk_cache is not None:
+                try:
+                    await loop.run_in_executor(None, self.disk_cache.set, key, images, self.image_ttl)
+                except Exception as e:
+                    logger.warning(f"⚠️  Error al guardar la caché de imágenes en disco: {e}")
+        return images
+    
+    def cache_stats(self) -> Dict:
+        """Contadores de la caché de imágenes (memoria, disco y llamadas a Unsplash)."""
+        return {
+            **self.memory_cache.stats(),
+            "disk_enabled": self.disk_cache is not None,
+            "disk_hits": self.disk_hits,
+            "upstream_calls": self.singleflight.executed,
+            "coalesced": self.singleflight.coalesced
+        }
+    
+    async def _fetch_images(self, destination: str, count: int) -> List[str]:
+        """
+        Consulta Unsplash directamente (sin caché).
+        
+        Args:
+            destination: Nombre del destino
+            count: Número de imágenes a obtener
+            
+        Returns:
+            Lista de URLs de imágenes o lista vacía si hay error
+        """
         try:
             # Construir query para buscar imágenes
             query = f"{destination} travel landscape"
             
             # Hacer llamada a la API de Unsplash
-            async with httpx.AsyncClient(timeout=10.0) as client:
+            client = self._get_client()
+            with track_upstream("unsplash") as call:
                 response = await client.get(
                     self.base_url,
                     params={
@@ -71,23 +184,25 @@ class UnsplashService:
                         "Authorization": f"Client-ID {self.api_key}"
                     }
                 )
+                if response.status_code != 200:
+                    call.outcome = "error"
+            
+            if response.status_code == 200:
+                data = response.json()
+                results = data.get("results", [])
+                
+                # Extraer URLs de las imágenes (usar regular size para buena calidad)
+                image_urls = [
+                    result["urls"]["regular"] 
+                    for result in results[:count]
+                ]
+                
+                logger.info(f"✅ {len(image_urls)} imágenes obtenidas para {destination}")
+                return image_urls
+            else:
+                logger.warning(f"⚠️  Error al obtener imágenes: {response.status_code}")
+                return []
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    results = data.get("results", [])
-                    
-                    # Extraer URLs de las imágenes (usar regular size para buena calidad)
-                    image_urls = [
-                        result["urls"]["regular"] 
-                        for result in results[:count]
-                    ]
-                    
-                    logger.info(f"✅ {len(image_urls)} imágenes obtenidas para {destination}")
-                    return image_urls
-                else:
-                    logger.warning(f"⚠️  Error al obtener imágenes: {response.status_code}")
-                    return []
-                    
         except Exception as e:
             logger.error(f"❌ Error al consultar Unsplash: {e}")
             return []
@@ -3,11 +3,17 @@ Servicio de integración con WeatherAPI.com para obtener datos del clima.
 """
 import os
 import logging
-from typing import Optional, Dict
-from datetime import datetime
+import asyncio
+import time
+from typing import Optional, Dict, Set
+from datetime import datetime, timedelta
 import httpx
 from dotenv import load_dotenv
 
+from services.cache import TTLCache, SingleFlight
+from services.http_client import create_async_client
+from services.metrics import track_upstream
+
 # Cargar variables de entorno
 load_dotenv()
 
@@ -22,6 +28,23 @@ class WeatherService:
         """Inicializa el servicio de Weather y valida la API key."""
         self.api_key = os.getenv("WEATHER_API_KEY")
         self.base_url = "https://api.weatherapi.com/v1/current.json"
+        # Cliente HTTP compartido (se crea en el lifespan de FastAPI o en el primer uso)
+        self.client: Optional[httpx.AsyncClient] = None
+        
+        # Caché por destino con stale-while-revalidate:
+        # - Menos de WEATHER_CACHE_TTL_SECONDS: dato fresco, se sirve directamente
+        # - Hasta WEATHER_CACHE_STALE_SECONDS: dato viejo, se sirve y se refresca en segundo plano
+        self.fresh_ttl = float(os.getenv("WEATHER_CACHE_TTL_SECONDS", "600"))
+        self.stale_ttl = max(float(os.getenv("WEATHER_CACHE_STALE_SECONDS", "3600")), self.fresh_ttl)
+        self.cache = TTLCache(
+            ttl_seconds=self.stale_ttl,
+            max_entries=int(os.getenv("WEATHER_CACHE_MAX_ENTRIES", "512")),
+            name="weather_cache"
+        )
+        # Misses concurrentes para el mismo destino comparten una sola llamada a WeatherAPI
+        self.singleflight = SingleFlight(name="weather")
+        self.stale_served = 0
+        self._background_refreshes: Set[asyncio.Task] = set()
         
         if not self.api_key:
             logger.warning(
@@ -31,9 +54,32 @@ class WeatherService:
         else:
             logger.info("✅ Servicio de Weather (WeatherAPI.com) inicializado correctamente")
     
+    async def startup(self):
+        """Crea el cliente HTTP compartido (llamado desde el lifespan de FastAPI)."""
+        if self.client is None:
+            self.client = create_async_client(timeout=10.0)
+            logger.info("🔌 Cliente HTTP de WeatherAPI.com creado (pool de conexiones con keep-alive)")
+    
+    async def shutdown(self):
+        """Cierra el cliente HTTP compartido y libera sus conexiones."""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+            logger.info("🔌 Cliente HTTP de WeatherAPI.com cerrado")
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Devuelve el cliente compartido, creándolo si el lifespan aún no lo hizo."""
+        if self.client is None:
+            self.client = create_async_client(timeout=10.0)
+        return self.client
+    
     async def get_weather(self, destination: str) -> Optional[Dict]:
         """
-        Obtiene el clima actual de un destino usando WeatherAPI.com.
+        Obtiene el clima actual de un destino usando WeatherAPI.com, pasando por la caché.
+        
+        - Dato fresco en caché: se devuelve sin llamar a la API
+        - Dato viejo (stale): se devuelve de inmediato y se lanza un único refresco en segundo plano
+        - Sin dato: se consulta la API; misses concurrentes del mismo destino comparten la llamada
         
         Manejo de errores robusto:
         - Si la API key no está configurada, retorna None silenciosamente
@@ -58,9 +104,70 @@ class WeatherService:
         if not self.api_key:
             return None
         
+        key = " ".join(destination.split()).lower()
+        entry = self.cache.get(key)
+        if entry is not None:
+            fetched_at, weather = entry
+            age = time.monotonic() - fetched_at
+            if age >= self.fresh_ttl:
+                self.stale_served += 1
+                self._schedule_refresh(key, destination)
+            return self._with_current_local_time(weather, age)
+        
+        return await self.singleflight.run(key, lambda: self._refresh(key, destination))
+    
+    def _schedule_refresh(self, key: str, destination: str):
+        """Lanza un refresco en segundo plano si no hay uno en curso para este destino."""
+        if self.singleflight.in_flight(key):
+            return
+        task = asyncio.create_task(self.singleflight.run(key, lambda: self._refresh(key, destination)))
+        # Mantener referencia para que la tarea no sea recolectada antes de terminar
+        self._background_refreshes.add(task)
+        task.add_done_callback(self._background_refreshes.discard)
+    
+    async def _refresh(self, key: str, destination: str) -> Optional[Dict]:
+        """Consulta la API y, si hay respuesta válida, la guarda en caché."""
+        weather = await self._fetch_weather(destination)
+        if weather is not None:
+            self.cache.set(key, (time.monotonic(), weather))
+        return weather
+    
+    @staticmethod
+    def _with_current_local_time(weather: Dict, age: float) -> Dict:
+        """Ajusta la hora local de un dato cacheado sumándole su antigüedad."""
+        local_time = weather.get("local_time")
+        if age < 60 or not local_time or local_time == "N/A":
+            return weather
+        try:
+            shifted = datetime.strptime(local_time, "%H:%M") + timedelta(seconds=age)
+        except ValueError:
+            return weather
+        return {**weather, "local_time": shifted.strftime("%H:%M")}
+    
+    def cache_stats(self) -> Dict:
+        """Contadores de la caché de clima (hits, stale servidos y llamadas coalescidas)."""
+        return {
+            **self.cache.stats(),
+            "fresh_ttl_seconds": self.fresh_ttl,
+            "stale_served": self.stale_served,
+            "upstream_calls": self.singleflight.executed,
+            "coalesced": self.singleflight.coalesced
+        }
+    
+    async def _fetch_weather(self, destination: str) -> Optional[Dict]:
+        """
+        Consulta WeatherAPI.com directamente (sin caché).
+        
+        Args:
+            destination: Nombre de la ciudad/destino
+            
+        Returns:
+            Dict con información del clima o None si hay error
+        """
         try:
             # Hacer llamada a la API de WeatherAPI.com
-            async with httpx.AsyncClient(timeout=10.0) as client:
+            client = self._get_client()
+            with track_upstream("weatherapi") as call:
                 response = await client.get(
                     self.base_url,
                     params={
@@ -70,44 +177,46 @@ class WeatherService:
                         "aqi": "no"  # No necesitamos calidad del aire
                     }
                 )
+                if response.status_code != 200:
+                    call.outcome = "error"
+            
+            if response.status_code == 200:
+                data = response.json()
+                
+                # Extraer información relevante de WeatherAPI
+                current = data.get("current", {})
+                location = data.get("location", {})
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    
-                    # Extraer información relevante de WeatherAPI
-                    current = data.get("current", {})
-                    location = data.get("location", {})
-                    
-                    temp = current.get("temp_c", 0)  # Temperatura en Celsius
-                    feels_like = current.get("feelslike_c", temp)  # Sensación térmica
-                    condition = current.get("condition", {}).get("text", "Desconocido")
-                    
-                    # WeatherAPI ya proporciona la hora local directamente
-                    local_time_str = location.get("localtime", "")
-                    if local_time_str:
-                        # Formato: "2024-01-15 14:30"
-                        try:
-                            local_time = local_time_str.split(" ")[1][:5]  # Extraer HH:MM
-                        except:
-                            local_time = "N/A"
-                    else:
+                temp = current.get("temp_c", 0)  # Temperatura en Celsius
+                feels_like = current.get("feelslike_c", temp)  # Sensación térmica
+                condition = current.get("condition", {}).get("text", "Desconocido")
+                
+                # WeatherAPI ya proporciona la hora local directamente
+                local_time_str = location.get("localtime", "")
+                if local_time_str:
+                    # Formato: "2024-01-15 14:30"
+                    try:
+                        local_time = local_time_str.split(" ")[1][:5]  # Extraer HH:MM
+                    except:
                         local_time = "N/A"
-                    
-                    logger.info(f"✅ Clima obtenido para {destination}: {temp}°C, {condition}")
-                    
-                    return {
-                        "temp": round(temp, 1),
-                        "condition": condition,
-                        "feels_like": round(feels_like, 1),
-                        "local_time": local_time,
-                        "timezone_offset": 0  # No necesario con WeatherAPI
-                    }
                 else:
-                    error_data = response.json() if response.content else {}
-                    error_msg = error_data.get("error", {}).get("message", f"Status {response.status_code}")
-                    logger.warning(f"⚠️  Error al obtener clima: {error_msg}")
-                    return None
-                    
+                    local_time = "N/A"
+                
+                logger.info(f"✅ Clima obtenido para {destination}: {temp}°C, {condition}")
+                
+                return {
+                    "temp": round(temp, 1),
+                    "condition": condition,
+                    "feels_like": round(feels_like, 1),
+                    "local_time": local_time,
+                    "timezone_offset": 0  # No necesario con WeatherAPI
+                }
+            else:
+                error_data = response.json() if response.content else {}
+                error_msg = error_data.get("error", {}).get("message", f"Status {response.status_code}")
+                logger.warning(f"⚠️  Error al obtener clima: {error_msg}")
+                return None
+                
         except Exception as e:
             logger.error(f"❌ Error al consultar WeatherAPI.com: {e}")
             return None
@@ -0,0 +1,1698 @@
+#!/usr/bin/env python3
+"""
+Pruebas de las optimizaciones de rendimiento del backend:
+1. Caché de planes (TTL + LRU)
+2. Coalescencia de llamadas concurrentes (single-flight)
+3. Caché persistente en SQLite
+4. Detector de prompt injection compilado
+5. Estadísticas con guardado en lote (JSON y SQLite compartido entre workers)
+6. Concurrencia acotada (y adaptativa) hacia Gemini
+7. Métricas Prometheus
+8. Trazas por solicitud (Server-Timing)
+9. Dobles locales de la prueba de carga
+10. Micro-benchmarks del camino crítico
+11. Instrucciones de sistema en el modelo
+12. Recorte del historial del chat por presupuesto de tokens
+13. Sesiones de chat en el servidor (memoria y SQLite)
+14. Resumen acumulado de conversaciones largas
+15. Clima e imágenes reutilizados entre turnos del chat
+16. Generación del plan por secciones en paralelo
+17. Ediciones del plan desde el chat por sección
+18. Cola persistente de planes en segundo plano
+19. Idempotency-Key en /api/plan y /api/chat
+20. Streaming de /api/plan (caché, deduplicación, errores y desconexión)
+21. Verificación de tokens de Firebase (caché hasta exp, fallos y coalescencia)
+22. Clientes HTTP compartidos de Weather y Unsplash (y cierre de las cachés en disco)
+23. Clima con stale-while-revalidate
+24. Contadores propios de los executors (en espera y en curso)
+25. Turno de Gemini ocupado hasta que termina el hilo aunque la solicitud se cancele
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import httpx
+
+os.environ.setdefault("GEMINI_API_KEY", "test_key_rendimiento")
+
+from services.cache import TTLCache, SingleFlight
+from services.concurrency import ConcurrencyGate, OverloadedError, AdaptiveLimiter, CountingExecutor
+from services.gemini_service import plan_cache_key, sanitize_input, sanitize_fields, classify_gemini_error
+from services.metrics import ServiceStatsCollector, track_upstream, UPSTREAM_LATENCY
+from services.persistent_cache import SQLiteCache
+from services.tracing import TraceIdFilter, TracingMiddleware, span, traced
+from services.stats_store import BatchedStatsStore, JSONStatsStore, SQLiteStatsStore
+from benchmarks.sanitize_corpus import legacy_sanitize_input, regression_corpus
+
+
+def print_test_header(test_name: str):
+    """Imprime un encabezado para cada prueba."""
+    print("\n" + "="*60)
+    print(f"🧪 {test_name}")
+    print("="*60)
+
+
+def test_ttl_cache_lru_eviction():
+    """La caché desaloja la entrada menos usada al superar max_entries."""
+    print_test_header("Test 1: Desalojo LRU por número de entradas")
+
+    cache = TTLCache(ttl_seconds=60, max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "a" pasa a ser la más reciente
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+    print("✅ Se desalojó la entrada menos usada")
+
+
+def test_ttl_cache_max_bytes_and_expiration():
+    """La caché respeta max_bytes y expira entradas vencidas."""
+    print_test_header("Test 2: Límite de bytes y expiración por TTL")
+
+    cache = TTLCache(ttl_seconds=60, max_entries=10, max_bytes=10)
+    cache.set("a", "x", size=6)
+    cache.set("b", "y", size=6)
+    assert cache.get("a") is None
+    assert cache.get("b") == "y"
+    assert cache.set("c", "z", size=11) is False
+
+    cache.set("d", "w", ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get("d") is None
+    assert cache.stats()["expirations"] == 1
+    print("✅ max_bytes y TTL funcionan correctamente")
+
+
+def test_ttl_cache_hit_miss_counters():
+    """Los contadores de hits y misses reflejan las consultas."""
+    print_test_header("Test 3: Contadores de hits/misses")
+
+    cache = TTLCache(ttl_seconds=60, max_entries=10)
+    cache.get("nada")
+    cache.set("k", "v")
+    cache.get("k")
+    cache.get("k")
+
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["hit_ratio"] == round(2 / 3, 4)
+    print(f"✅ Contadores: {stats}")
+
+
+def test_plan_cache_key_normalization():
+    """Solicitudes equivalentes comparten clave; campos distintos no."""
+    print_test_header("Test 4: Clave de caché de planes normalizada")
+
+    key_a = plan_cache_key("Cartagena", "junio", "Moderado", "cultural", "COP")
+    key_b = plan_cache_key("  cartagena ", "Junio", "moderado", "Cultural", "cop")
+    key_c = plan_cache_key("Cartagena", "junio", "lujo", "cultural", "COP")
+
+    assert key_a == key_b
+    assert key_a != key_c
+    assert plan_cache_key("Cartagena", "junio", "Moderado", "cultural", "") == key_a  # Como el prompt
+    # Sin default propio: omitir la moneda no puede producir otra clave que la de la API
+    try:
+        plan_cache_key("Cartagena", "junio", "Moderado", "cultural")
+        assert False, "user_currency debería ser obligatorio"
+    except TypeError:
+        pass
+    print("✅ La normalización agrupa solicitudes idénticas")
+
+
+def test_singleflight_coalesces_concurrent_calls():
+    """Llamadas concurrentes con la misma clave ejecutan el upstream una sola vez."""
+    print_test_header("Test 5: Single-flight para llamadas concurrentes")
+
+    calls = []
+
+    async def upstream():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "resultado"
+
+    async def scenario():
+        flight = SingleFlight()
+        results = await asyncio.gather(*[flight.run("clima:cartagena", upstream) for _ in range(5)])
+        return flight, results
+
+    flight, results = asyncio.run(scenario())
+    assert results == ["resultado"] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {"in_flight": 0, "executed": 1, "coalesced": 4}
+    print("✅ 5 solicitudes, 1 llamada al upstream")
+
+
+def test_sqlite_cache_survives_reopen():
+    """Los valores guardados en SQLite siguen disponibles al reabrir el archivo."""
+    print_test_header("Test 6: Caché persistente entre reinicios")
+
+    path = os.path.join(tempfile.mkdtemp(), "cache.sqlite3")
+    cache = SQLiteCache(path, table="imagenes")
+    cache.set("cartagena|8", ["https://images.unsplash.com/1"], ttl=60)
+    cache.set("expirado|8", ["https://images.unsplash.com/2"], ttl=-1)
+    cache.close()
+
+    reopened = SQLiteCache(path, table="imagenes")
+    value, remaining = reopened.get("cartagena|8")
+    assert value == ["https://images.unsplash.com/1"]
+    assert 0 < remaining <= 60
+    assert reopened.get("expirado|8") is None
+
+    # close() vuelca el WAL al archivo principal aunque otro proceso mantenga el archivo
+    # abierto (sin checkpoint el WAL quedaría con las escrituras); luego se reabre sola
+    other_worker = sqlite3.connect(path)
+    other_worker.execute("SELECT COUNT(*) FROM imagenes").fetchone()
+    reopened.set("lima|8", ["https://images.unsplash.com/3"], ttl=60)
+    assert os.path.getsize(path + "-wal") > 0
+    reopened.close()
+    assert os.path.getsize(path + "-wal") == 0
+    other_worker.close()
+    reopened.close()
+    assert reopened.get("lima|8")[0] == ["https://images.unsplash.com/3"]
+    reopened.close()
+    print("✅ La caché en disco sobrevive al reinicio, respeta el TTL y hace checkpoint al cerrar")
+
+
+def test_compiled_sanitizer_matches_legacy():
+    """El detector compilado acepta y rechaza exactamente lo mismo que el original."""
+    print_test_header("Test 7: Detector compilado vs implementación original")
+
+    corpus = regression_corpus()
+    for text in corpus:
+        for max_length in (50, 100, 500):
+            assert sanitize_input(text, max_length) == legacy_sanitize_input(text, max_length), repr(text)
+    rejected = sum(1 for text in corpus if not legacy_sanitize_input(text)[0])
+    print(f"✅ {len(corpus)} textos con el mismo resultado ({rejected} rechazados)")
+
+
+def test_batch_sanitizer_matches_single():
+    """sanitize_fields devuelve por campo lo mismo que sanitize_input."""
+    print_test_header("Test 8: Validación por lotes de varios campos")
+
+    corpus = regression_corpus()
+    for size in (1, 3, 7, 50):
+        for start in range(0, len(corpus), size):
+            fields = [(text, 100) for text in corpus[start:start + size]]
+            assert sanitize_fields(fields) == [sanitize_input(text, 100) for text, _ in fields]
+    assert sanitize_fields([]) == []
+    print("✅ Los resultados por lotes coinciden campo a campo")
+
+
+def test_stats_store_batches_and_persists():
+    """Los eventos se acumulan en memoria y un flush los guarda de forma atómica."""
+    print_test_header("Test 9: Estadísticas con guardado en lote")
+
+    path = os.path.join(tempfile.mkdtemp(), "stats.json")
+    store = JSONStatsStore(path)
+    for destination in ["París", "parís ", "Tokio"]:
+        store.record_plan(destination)
+    assert not os.path.exists(path)  # Nada se escribe en el camino de la solicitud
+
+    store.flush()
+    reopened = JSONStatsStore(path)
+    summary = reopened.summary(top_n=5)
+    assert summary["total_plans_generated"] == 3
+    assert summary["top_destinations"] == [("parís", 2), ("tokio", 1)]
+    assert summary["last_reset"] == store.last_reset
+    assert os.listdir(os.path.dirname(path)) == ["stats.json"]  # Sin temporales huérfanos
+
+    # Un backend que no implementa toda la interfaz falla al instanciarse, no en el primer flush
+    class IncompleteStore(BatchedStatsStore):
+        def record_plan(self, destination):
+            pass
+
+    try:
+        IncompleteStore()
+        assert False, "Se esperaba TypeError"
+    except TypeError as e:
+        assert "flush" in str(e)
+    print(f"✅ Estadísticas persistidas: {summary}")
+
+
+def test_stats_store_event_log_replay():
+    """En modo event log, un reinicio reproduce los eventos no compactados."""
+    print_test_header("Test 10: Reproducción del log de eventos")
+
+    path = os.path.join(tempfile.mkdtemp(), "stats.json")
+    store = JSONStatsStore(path, event_log=True, compact_every=1000)
+    for destination in ["Lima", "Cusco", "Lima"]:
+        store.record_plan(destination)
+    store.flush()
+    assert not os.path.exists(path)  # Solo se agregó al log
+    store.record_plan("Lima")
+    store.flush()
+
+    # Simular un crash a mitad de escritura de una línea
+    with open(store.log_path, "a") as f:
+        f.write('{"seq": 5, "destin')
+
+    reopened = JSONStatsStore(path, event_log=True)
+    summary = reopened.summary(top_n=5)
+    assert summary["total_plans_generated"] == 4
+    assert summary["top_destinations"] == [("lima", 3), ("cusco", 1)]
+    assert os.path.getsize(reopened.log_path) == 0  # Compactado al arrancar
+    assert JSONStatsStore(path, event_log=True).summary()["total_plans_generated"] == 4
+    print(f"✅ Eventos reproducidos: {summary}")
+
+
+def _record_plans_in_worker(path: str, destinations: list):
+    """Simula un worker de gunicorn: su propia conexión, deltas en memoria y flushes."""
+    store = SQLiteStatsStore(path, flush_every=10)
+    for i, destination in enumerate(destinations):
+        store.record_plan(destination)
+        if i % 7 == 0:
+            store.flush()
+    store.flush()
+    store.close()
+
+
+def test_sqlite_stats_store_multiple_workers():
+    """Varios procesos suman sus contadores en SQLite sin perder escrituras."""
+    print_test_header("Test 11: Estadísticas en SQLite con varios workers")
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "stats.sqlite3")
+    legacy_json = os.path.join(directory, "stats.json")
+    with open(legacy_json, "w") as f:
+        f.write('{"total_plans_generated": 5, "destinations_counter": {"lima": 5}, "last_reset": "2025-01-01"}')
+
+    # La primera apertura importa stats.json una sola vez
+    SQLiteStatsStore(path, import_json_path=legacy_json).close()
+
+    workers = [
+        multiprocessing.Process(target=_record_plans_in_worker, args=(path, ["Lima", "Cusco"] * 50))
+        for _ in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=30)
+        assert worker.exitcode == 0
+
+    store = SQLiteStatsStore(path, import_json_path=legacy_json)
+    summary = store.summary(top_n=5)
+    store.close()
+    assert summary["total_plans_generated"] == 5 + 4 * 100
+    assert summary["top_destinations"] == [("lima", 205), ("cusco", 200)]
+    assert summary["last_reset"] == "2025-01-01"
+    print(f"✅ 4 workers × 100 planes sin pérdidas: {summary}")
+
+
+def test_concurrency_gate_bounds_and_rejects():
+    """El gate limita las llamadas en curso y rechaza al llenarse la cola."""
+    print_test_header("Test 12: Concurrencia acotada con cola máxima")
+
+    async def scenario():
+        gate = ConcurrencyGate(limit=2, max_queue=2, max_wait=5)
+        running = []
+        peak = []
+
+        async def call():
+            async with gate.slot():
+                running.append(1)
+                peak.append(len(running))
+                await asyncio.sleep(0.02)
+                running.pop()
+            return "ok"
+
+        results = await asyncio.gather(*[call() for _ in range(6)], return_exceptions=True)
+        return gate, results, max(peak)
+
+    gate, results, peak = asyncio.run(scenario())
+    rejected = [r for r in results if isinstance(r, OverloadedError)]
+    assert peak == 2
+    assert results.count("ok") == 4  # 2 en curso + 2 en cola
+    assert len(rejected) == 2 and all(r.retry_after >= 1 for r in rejected)
+    stats = gate.stats()
+    assert stats["active"] == 0 and stats["queued"] == 0
+    assert stats["admitted"] == 4 and stats["rejected"] == 2
+    print(f"✅ Máximo {peak} en curso, {len(rejected)} rechazadas: {stats}")
+
+
+def test_concurrency_gate_wait_timeout():
+    """Una solicitud que espera más de max_wait se rechaza sin perder el turno."""
+    print_test_header("Test 13: Espera máxima en cola")
+
+    async def scenario():
+        gate = ConcurrencyGate(limit=1, max_queue=5, max_wait=0.01)
+        await gate.acquire()
+        try:
+            await gate.acquire()
+        except OverloadedError:
+            pass
+        else:
+            raise AssertionError("Se esperaba OverloadedError")
+        gate.release()
+        await gate.acquire()  # El turno liberado sigue disponible
+        gate.release()
+        return gate.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["timed_out"] == 1 and stats["active"] == 0
+    print(f"✅ Timeout en cola: {stats}")
+
+
+def test_adaptive_limiter_aimd():
+    """El límite crece con llamadas rápidas y se recorta a la mitad ante un 429."""
+    print_test_header("Test 14: Límite adaptativo AIMD")
+
+    gate = ConcurrencyGate(limit=2, max_queue=10, max_wait=5)
+    limiter = AdaptiveLimiter(gate, min_limit=1, max_limit=8, target_latency=1.0, cooldown=60)
+
+    for _ in range(20):
+        limiter.on_success(0.1)
+    grown = gate.limit
+    assert 2 < grown <= 8
+
+    limiter.on_failure("throttled")
+    assert gate.limit == max(1, grown // 2)
+    limiter.on_failure("timeout")  # Mismo episodio (cooldown): no vuelve a recortar
+    assert gate.limit == max(1, grown // 2)
+
+    limiter.cooldown = 0
+    limiter.on_success(5.0)  # Pico de latencia
+    stats = limiter.stats()
+    assert stats["current_limit"] == max(1, grown // 4)
+    assert stats["throttled"] == 1 and stats["timeouts"] == 1 and stats["latency_spikes"] == 1
+    print(f"✅ Límite {grown} tras éxitos, recortado a {gate.limit}: {stats}")
+
+
+def test_classify_gemini_error():
+    """Los errores envueltos por el servicio conservan su causa para clasificarlos."""
+    print_test_header("Test 15: Clasificación de errores de Gemini")
+    from google.api_core import exceptions as google_exceptions
+
+    def wrapped(cause):
+        try:
+            raise cause
+        except Exception as e:
+            try:
+                raise Exception("Ocurrió un error consultando a la IA") from e
+            except Exception as outer:
+                return outer
+
+    assert classify_gemini_error(wrapped(google_exceptions.ResourceExhausted("cuota"))) == "throttled"
+    assert classify_gemini_error(wrapped(google_exceptions.DeadlineExceeded("lento"))) == "timeout"
+    assert classify_gemini_error(wrapped(google_exceptions.ServiceUnavailable("caído"))) == "unavailable"
+    assert classify_gemini_error(wrapped(ValueError("vacía"))) is None
+    print("✅ 429, timeouts y 503 se detectan a través de la cadena de causas")
+
+
+def test_metrics_collectors():
+    """Los stats() de los servicios se exponen como métricas y track_upstream mide resultados."""
+    print_test_header("Test 16: Métricas Prometheus")
+    from prometheus_client import CollectorRegistry, generate_latest
+
+    cache = TTLCache(ttl_seconds=60, max_entries=10)
+    cache.get("nada")
+    cache.set("k", "v")
+    cache.get("k")
+
+    collector = ServiceStatsCollector()
+    collector.register("test_cache", cache.stats, counters=("hits", "misses"))
+    collector.register("roto", lambda: 1 / 0)  # Un proveedor con error no rompe el scrape
+    registry = CollectorRegistry()
+    registry.register(collector)
+    text = generate_latest(registry).decode()
+    assert "viajeia_test_cache_hits_total 1.0" in text
+    assert "viajeia_test_cache_misses_total 1.0" in text
+    assert "viajeia_test_cache_entries 1.0" in text
+
+    with track_upstream("prueba") as call:
+        call.outcome = "error"
+    try:
+        with track_upstream("prueba"):
+            raise RuntimeError("fallo")
+    except RuntimeError:
+        pass
+    errors = UPSTREAM_LATENCY.labels(upstream="prueba", outcome="error")
+    assert errors._sum.get() >= 0
+    samples = [s for m in UPSTREAM_LATENCY.collect() for s in m.samples
+               if s.name.endswith("_count") and s.labels.get("upstream") == "prueba"]
+    assert [(s.labels["outcome"], s.value) for s in samples] == [("error", 2.0)]
+    print("✅ Stats de servicios y llamadas externas expuestas como métricas")
+
+
+def test_tracing_server_timing():
+    """Cada etapa medida aparece en Server-Timing y el trace id llega a los logs."""
+    print_test_header("Test 17: Trazas por solicitud")
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    records = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append(record)
+
+    capture = Capture()
+    capture.addFilter(TraceIdFilter())
+    test_logger = logging.getLogger("test_tracing")
+    test_logger.addHandler(capture)
+
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware)
+
+    @app.get("/etapas")
+    async def etapas():
+        with span("validate"):
+            pass
+        await asyncio.gather(traced("gemini", asyncio.sleep(0.02)), traced("weather", asyncio.sleep(0.01)))
+        test_logger.warning("dentro de la solicitud")
+        return {"ok": True}
+
+    traceparent = "00-" + "ab" * 16 + "-" + "cd" * 8 + "-01"
+    response = TestClient(app).get("/etapas", headers={"traceparent": traceparent})
+    test_logger.removeHandler(capture)
+
+    timing = response.headers["server-timing"]
+    stages = [entry.split(";")[0] for entry in timing.split(", ")]
+    assert stages == ["validate", "gemini", "weather", "total"], timing
+    gemini_ms = float(timing.split("gemini;dur=")[1].split(",")[0])
+    assert gemini_ms >= 15
+    assert response.headers["x-trace-id"] == "ab" * 16
+    assert records and records[0].trace_id == "ab" * 16
+    print(f"✅ Server-Timing: {timing}")
+
+
+def test_load_test_stand_ins():
+    """Los dobles de la prueba de carga son reproducibles y hablan el formato de cada API."""
+    print_test_header("Test 18: Dobles de la prueba de carga")
+    from benchmarks.fakes import FakeGeminiModel, LatencyDistribution, StandIn, create_mock_transport
+    from benchmarks.load_test import percentile
+    from services.gemini_service import extract_finish_reason
+
+    first, second = StandIn("g", "lognormal:1.0,0.5", 0.2, seed=7), StandIn("g", "lognormal:1.0,0.5", 0.2, seed=7)
+    assert [first.next_call() for _ in range(5)] == [second.next_call() for _ in range(5)]
+    samples = [first.next_call() for _ in range(2000)]
+    assert 0.1 < sum(fail for _, fail in samples) / len(samples) < 0.3
+    assert LatencyDistribution("0.25").sample() == 0.25
+    try:
+        LatencyDistribution("pareto:1")
+        assert False, "Debió rechazar una distribución desconocida"
+    except ValueError:
+        pass
+
+    assert percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.5
+    assert percentile([5.0], 99) == 5.0
+
+    model = FakeGeminiModel(StandIn("gemini", "fixed:0"))
+    response = model.generate_content("prompt")
+    assert "## 🏨 ALOJAMIENTO" in response.text
+    assert extract_finish_reason(response) == "STOP"
+    assert "".join(chunk.text for chunk in model.generate_content("prompt", stream=True)) == response.text
+
+    async def fetch():
+        transport = create_mock_transport(StandIn("w", "fixed:0"), StandIn("u", "fixed:0"))
+        async with httpx.AsyncClient(transport=transport) as client:
+            weather = await client.get("https://api.weatherapi.com/v1/current.json", params={"q": "Lima"})
+            images = await client.get("https://api.unsplash.com/search/photos", params={"query": "Lima", "per_page": 3})
+        return weather.json(), images.json()
+
+    weather, images = asyncio.run(fetch())
+    assert weather["current"]["temp_c"] == 24.0
+    assert len(images["results"]) == 3
+    print("✅ Dobles reproducibles con semilla y con el formato de Gemini, WeatherAPI y Unsplash")
+
+
+def test_hotpath_benchmark_compare():
+    """La medición calibra iteraciones y la comparación detecta regresiones sobre el umbral."""
+    print_test_header("Test 19: Micro-benchmarks y líneas base")
+    from benchmarks.bench_hotpath import compare, measure
+
+    stats = measure(lambda: sum(range(50)), rounds=3, min_round_time=0.005)
+    assert stats["iterations"] > 1 and stats["rounds"] == 3
+    assert 0 < stats["min_us"] <= stats["median_us"]
+
+    baseline = {"benchmarks": {"a": {"median_us": 10.0}, "b": {"median_us": 10.0}, "c": {"median_us": 10.0}}}
+    current = {"benchmarks": {
+        "a": {"median_us": 12.0},   # +20%: regresión
+        "b": {"median_us": 10.5},   # +5%: dentro del umbral
+        "c": {"median_us": 5.0},    # -50%: mejora
+        "d": {"median_us": 1.0}     # nuevo, sin línea base
+    }}
+    regressions, improvements = compare(current, baseline, threshold=0.10)
+    assert regressions == ["a"]
+    assert improvements == ["c"]
+    print("✅ Regresiones y mejoras detectadas contra la línea base")
+
+
+def test_system_instruction_models():
+    """Con un SDK que soporta system_instruction, el prompt lleva solo la parte dinámica."""
+    print_test_header("Test 20: Instrucciones de sistema en el modelo")
+    from unittest import mock
+    import google.generativeai as genai
+    from services import gemini_service as gs
+
+    class RecordingModel:
+        def __init__(self, model_name=None, generation_config=None, system_instruction=None):
+            self.system_instruction = system_instruction
+            self.prompts = []
+
+        def generate_content(self, prompt, stream=False, **kwargs):
+            self.prompts.append(prompt)
+            response = mock.Mock(text="## 🏨 ALOJAMIENTO\n...", candidates=[])
+            response.usage_metadata = mock.Mock(prompt_token_count=120, cached_content_token_count=0, candidates_token_count=40)
+            return response
+
+    with mock.patch.object(genai, "GenerativeModel", RecordingModel), \
+            mock.patch.object(gs, "supports_system_instruction", return_value=True):
+        service = gs.GeminiService()
+    assert set(service.instruction_models) == {"plan", "chat", "chat_initial"}
+    assert service.instruction_models["plan"].system_instruction.endswith(gs.CURRENCY_RULES)
+
+    service.generate_travel_recommendation("Lima", "junio", "moderado", "cultural", check_cache=False)
+    plan_prompt = service.instruction_models["plan"].prompts[0]
+    assert gs.SYSTEM_INSTRUCTION_PLAN not in plan_prompt and "REGLAS DE MONEDA" not in plan_prompt
+    assert "Planifica un viaje a Lima" in plan_prompt and "moderado" in plan_prompt
+
+    history = [{"role": "user", "parts": "hola"}, {"role": "model", "parts": "¡Hola!"}]
+    service.generate_chat_response("Lima", message="¿Y de noche?", history=history)
+    chat_prompt = service.instruction_models["chat"].prompts[0]
+    assert gs.SYSTEM_INSTRUCTION_CHAT not in chat_prompt and "¿Y de noche?" in chat_prompt
+    assert service.model.prompts == []  # El modelo sin instrucciones no se usa
+
+    # Sin soporte en el SDK, el prompt conserva las instrucciones completas (mismo template)
+    inline_prompt, _ = gs.build_plan_prompt("Lima", "junio", "moderado", "cultural")
+    assert inline_prompt.startswith(gs.SYSTEM_INSTRUCTION_PLAN) and gs.CURRENCY_RULES in inline_prompt
+    assert len(plan_prompt) * 5 < len(inline_prompt)
+    print(f"✅ Prompt de plan: {len(inline_prompt)} → {len(plan_prompt)} caracteres por llamada")
+
+    # Con el SDK instalado (sin dobles del modelo): la instrucción viaja en el campo
+    # system_instruction de la solicitud y, con caché de contexto, solo como cached_content
+    from google.generativeai import protos
+
+    class RecordingClient:
+        def __init__(self):
+            self.requests = []
+            self.cache_requests = []
+
+        def generate_content(self, request, **kwargs):
+            self.requests.append(request)
+            return protos.GenerateContentResponse(
+                candidates=[{"content": {"parts": [{"text": "## 🏨 ALOJAMIENTO\n..."}], "role": "model"}, "finish_reason": 1}],
+                usage_metadata={"prompt_token_count": 120, "cached_content_token_count": 100, "candidates_token_count": 40}
+            )
+
+        def create_cached_content(self, request, **kwargs):
+            self.cache_requests.append(request)
+            return protos.CachedContent(name="cachedContents/plan", model=request.cached_content.model)
+
+    assert gs.supports_system_instruction() and gs.supports_context_cache()
+    for context_cache in ("false", "true"):
+        client = RecordingClient()
+        with mock.patch("google.generativeai.client.get_default_generative_client", return_value=client), \
+                mock.patch("google.generativeai.caching.get_default_cache_client", return_value=client), \
+                mock.patch.dict(os.environ, {"GEMINI_CONTEXT_CACHE": context_cache}):
+            service = gs.GeminiService()
+            plan, finish_reason = service.generate_travel_recommendation("Lima", "junio", "moderado", "cultural", check_cache=False)
+        assert finish_reason == "STOP" and plan.startswith("## 🏨 ALOJAMIENTO")
+        request = client.requests[0]
+        prompt = request.contents[0].parts[0].text
+        assert "Planifica un viaje a Lima" in prompt and gs.SYSTEM_INSTRUCTION_PLAN not in prompt
+        if context_cache == "true":
+            assert request.cached_content == "cachedContents/plan" and not request.system_instruction.parts
+            cached_instruction = client.cache_requests[0].cached_content.system_instruction.parts[0].text
+            assert cached_instruction == gs.SYSTEM_INSTRUCTIONS["plan"]
+        else:
+            assert request.system_instruction.parts[0].text == gs.SYSTEM_INSTRUCTIONS["plan"]
+            assert not client.cache_requests
+    print("✅ Con el SDK real la instrucción va como system_instruction o como caché de contexto")
+
+
+def test_chat_history_token_budget():
+    """El historial se recorta a un presupuesto de tokens y los planes largos se abrevian."""
+    print_test_header("Test 21: Recorte del historial por presupuesto de tokens")
+    from services.gemini_service import (
+        CHARS_PER_TOKEN, CHAT_HISTORY_TOKEN_BUDGET, SYSTEM_INSTRUCTION_CHAT,
+        build_chat_prompt, estimate_tokens, trim_history
+    )
+    from benchmarks.fakes import FAKE_PLAN
+
+    plan = FAKE_PLAN * 20
+    history = []
+    for i in range(40):
+        history.append({"role": "user", "parts": f"Pregunta número {i} sobre el viaje"})
+        history.append({"role": "model", "parts": plan if i % 5 == 0 else f"Respuesta corta {i}"})
+
+    trimmed = trim_history(history, budget_tokens=600, max_message_tokens=200)
+    assert trimmed and trimmed[-1]["parts"] == history[-1]["parts"]
+    # Los mensajes conservados son los más recientes, en orden
+    assert [msg["parts"] for msg in trimmed[:-1] if len(msg["parts"]) < 100] == \
+        [msg["parts"] for msg in history[-len(trimmed):-1] if len(msg["parts"]) < 100]
+    assert sum(estimate_tokens(msg["parts"]) + 4 for msg in trimmed) <= 600
+    elided = [msg["parts"] for msg in trimmed if "abreviado" in msg["parts"]]
+    assert elided and all(len(text) <= 200 * 4 for text in elided)
+    assert "🏨 ALOJAMIENTO" in elided[0] and "💰 COSTOS" in elided[0]
+    # Aplicarlo otra vez no cambia nada (main.py y build_chat_prompt recortan ambos)
+    assert trim_history(trimmed, budget_tokens=600, max_message_tokens=200) == trimmed
+    # Un único mensaje enorme se conserva abreviado
+    assert len(trim_history([{"role": "model", "parts": plan}], 100, 400)[0]["parts"]) <= 96 * 4
+
+    # El prompt queda acotado sin importar cuánto crezca la conversación
+    sizes = [len(build_chat_prompt("Lima", message="¿Y de noche?", history=history[:n])[0]) for n in (20, 40, 80)]
+    limit = len(SYSTEM_INSTRUCTION_CHAT) + CHAT_HISTORY_TOKEN_BUDGET * CHARS_PER_TOKEN + 300
+    assert max(sizes) <= limit, (sizes, limit)
+    print(f"✅ {len(history)} mensajes → {len(trimmed)} conservados; prompts de {min(sizes)}-{max(sizes)} caracteres")
+
+
+def test_chat_session_store():
+    """Las sesiones guardan el historial, solo las ve su dueño y se comparten vía SQLite."""
+    print_test_header("Test 22: Sesiones de chat en el servidor")
+    from services.chat_sessions import ChatSessionStore, SQLiteChatSessionStore
+
+    store = ChatSessionStore(ttl_seconds=60, max_entries=2, max_bytes=None, max_messages=4)
+    session = store.new_session("uid-a", "Lima", "junio", "moderado", "cultural")
+    store.append(session, [{"role": "user", "parts": "hola"}, {"role": "model", "parts": "¡Hola!"}])
+    store.append(session, [{"role": "user", "parts": "¿y de noche?"}, {"role": "model", "parts": "Barranco"}])
+    store.append(session, [{"role": "user", "parts": "¿y el clima?"}, {"role": "model", "parts": "Templado"}])
+    assert store.get(session.session_id, "uid-b") is None  # Otro usuario no la ve
+    loaded = store.get(session.session_id, "uid-a")
+    assert [msg["parts"] for msg in loaded.messages] == ["¿y de noche?", "Barranco", "¿y el clima?", "Templado"]
+    # LRU: con capacidad 2, la sesión menos usada se desaloja
+    for uid in ("uid-c", "uid-d"):
+        store.append(store.new_session(uid, "Quito", "", "", ""), [{"role": "user", "parts": "hola"}])
+    assert store.get(session.session_id, "uid-a") is None
+    assert store.stats()["evictions"] == 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sessions.sqlite3")
+        worker_a = SQLiteChatSessionStore(path, ttl_seconds=60, max_messages=50)
+        worker_b = SQLiteChatSessionStore(path, ttl_seconds=60, max_messages=50)
+        session = worker_a.new_session("uid-a", "Lima", "", "", "")
+        worker_a.append(session, [{"role": "user", "parts": "hola"}])
+        # Otro worker continúa la conversación y el primero ve el turno nuevo
+        other = worker_b.get(session.session_id, "uid-a")
+        worker_b.append(other, [{"role": "model", "parts": "¡Hola!"}])
+        assert [msg["parts"] for msg in worker_a.get(session.session_id, "uid-a").messages] == ["hola", "¡Hola!"]
+        # Dos turnos simultáneos leyeron la misma versión: ninguno se pierde
+        turn_a = worker_a.get(session.session_id, "uid-a")
+        turn_b = worker_b.get(session.session_id, "uid-a")
+        worker_a.append(turn_a, [{"role": "user", "parts": "¿y de noche?"}])
+        worker_b.append(turn_b, [{"role": "user", "parts": "¿y el clima?"}], {"plan": "## 🏨 ALOJAMIENTO\n..."})
+        stored = worker_a.get(session.session_id, "uid-a")
+        assert [msg["parts"] for msg in stored.messages] == ["hola", "¡Hola!", "¿y de noche?", "¿y el clima?"]
+        assert stored.plan == "## 🏨 ALOJAMIENTO\n..." and turn_b.messages == stored.messages
+        # Un plegado que termina mientras un turno espera a Gemini se conserva
+        turn = worker_b.get(session.session_id, "uid-a")
+        assert worker_a.fold(session.session_id, "uid-a", "- Saludo", stored.messages[:2])
+        assert not worker_a.fold(session.session_id, "uid-a", "- Otro", stored.messages[:2])  # Ya plegados
+        worker_b.append(turn, [{"role": "model", "parts": "Templado"}])
+        stored = worker_a.get(session.session_id, "uid-a")
+        assert stored.summary == "- Saludo" and stored.summarized_messages == 2
+        assert [msg["parts"] for msg in stored.messages] == ["¿y de noche?", "¿y el clima?", "Templado"]
+        assert asyncio.run(worker_a.get_async(session.session_id, "uid-b")) is None
+        assert asyncio.run(worker_b.delete_async(session.session_id, "uid-a"))
+        assert worker_a.get(session.session_id, "uid-a") is None
+        worker_a.disk.close()
+        worker_b.disk.close()
+
+    # Un turno que falla en Gemini no cambia la sesión (en memoria es el mismo objeto guardado)
+    from unittest import mock
+    from fastapi import HTTPException
+    import main
+
+    store = ChatSessionStore(ttl_seconds=60, max_entries=10, max_bytes=None, max_messages=50)
+    session = store.new_session("uid-a", "Lima", "junio", "moderado", "cultural")
+    store.append(session, [{"role": "user", "parts": "hola"}, {"role": "model", "parts": "¡Hola!"}])
+    request = main.ChatRequest(
+        destination="Cusco", date="julio", budget="alto", style="aventura",
+        message="¿Qué me recomiendas?", session_id=session.session_id, skip_enrichment=True
+    )
+    gemini = main.get_gemini_service()
+    with mock.patch.object(main, "get_chat_session_store", return_value=store), \
+            mock.patch.object(gemini, "generate_chat_response_async", mock.AsyncMock(side_effect=RuntimeError("Gemini falló"))):
+        try:
+            asyncio.run(main.generate_chat_reply(request, "uid-a"))
+            assert False, "El turno debería fallar"
+        except HTTPException as e:
+            assert e.status_code == 500
+    loaded = store.get(session.session_id, "uid-a")
+    assert (loaded.destination, loaded.date, loaded.budget, loaded.style) == ("Lima", "junio", "moderado", "cultural")
+    assert len(loaded.messages) == 2
+    with mock.patch.object(main, "get_chat_session_store", return_value=store), \
+            mock.patch.object(gemini, "generate_chat_response_async", mock.AsyncMock(return_value=("Machu Picchu", "STOP"))):
+        asyncio.run(main.generate_chat_reply(request, "uid-a"))
+    loaded = store.get(session.session_id, "uid-a")
+    assert (loaded.destination, loaded.date, loaded.budget, loaded.style) == ("Cusco", "julio", "alto", "aventura")
+    assert [msg["parts"] for msg in loaded.messages[2:]] == ["¿Qué me recomiendas?", "Machu Picchu"]
+    print("✅ Historial por sesión, aislado por usuario, con LRU en memoria y compartido en SQLite")
+
+
+def test_conversation_summarizer():
+    """Los turnos antiguos se pliegan en segundo plano y el prompt pasa a ser resumen + recientes."""
+    print_test_header("Test 23: Resumen acumulado de conversaciones largas")
+    from services.chat_sessions import ChatSessionStore
+    from services.chat_summary import ConversationSummarizer
+    from services.gemini_service import build_chat_prompt, build_summary_prompt
+
+    calls = []
+
+    async def fake_summarize(previous, messages, max_tokens):
+        calls.append((previous, len(messages)))
+        await asyncio.sleep(0.01)
+        if len(calls) == 3:
+            raise OverloadedError("saturado", retry_after=1)
+        return f"{previous} +{len(messages)} turnos; viaja con su pareja, sin mariscos".strip()
+
+    async def scenario():
+        store = ChatSessionStore(ttl_seconds=60, max_entries=10, max_bytes=None, max_messages=100)
+        summarizer = ConversationSummarizer(fake_summarize, trigger_messages=8, keep_recent=4, max_tokens=200)
+        session = store.new_session("uid-a", "Lima", "", "", "")
+        scheduled = []
+        for turn in range(12):
+            store.append(session, [{"role": "user", "parts": f"pregunta {turn}"}, {"role": "model", "parts": f"respuesta {turn}"}])
+            scheduled.append(summarizer.maybe_schedule(store, session))
+            if turn % 3 == 2:
+                await summarizer.drain()
+        await summarizer.drain()
+        return store.get(session.session_id, "uid-a"), summarizer, scheduled
+
+    session, summarizer, scheduled = asyncio.run(scenario())
+    # Un solo plegado en curso por sesión: los turnos intermedios no programan otro
+    assert scheduled.count(True) == len(calls) and False in scheduled
+    assert summarizer.stats()["skipped"] == 1 and summarizer.stats()["failures"] == 0
+    # Cada plegado parte del resumen anterior
+    assert calls[0][0] == "" and calls[1][0].startswith("+")
+    assert session.summarized_messages + len(session.messages) == 24
+    assert [msg["parts"] for msg in session.messages][-2:] == ["pregunta 11", "respuesta 11"]
+    assert "sin mariscos" in session.summary
+
+    prompt, used = build_chat_prompt("Lima", message="¿Y de noche?", history=session.messages, summary=session.summary)
+    assert "--- Resumen de la Conversación Anterior ---" in prompt and session.summary in prompt
+    assert used == len(session.messages) and "pregunta 0\n" not in prompt
+    # Sin resumen el prompt es el de siempre
+    assert "Resumen" not in build_chat_prompt("Lima", message="hola", history=session.messages)[0]
+    # Los planes completos se abrevian también al resumir
+    summary_prompt = build_summary_prompt("", [{"role": "model", "parts": "## 🏨 ALOJAMIENTO\n" + "texto " * 2000}], 120)
+    assert len(summary_prompt) < 4000 and "120 palabras" in summary_prompt
+    print(f"✅ {session.summarized_messages} mensajes plegados, {len(session.messages)} literales, {len(calls)} llamadas al resumidor")
+
+
+def test_chat_session_enrichment_reuse():
+    """El clima y las imágenes se guardan por destino en la sesión y expiran."""
+    print_test_header("Test 24: Clima e imágenes reutilizados entre turnos")
+    from unittest import mock
+    from services.chat_sessions import ChatSession
+
+    session = ChatSession("s1", "uid-a", destination="Lima")
+    assert session.cached_enrichment("Lima", 900) is None
+    session.set_enrichment("Lima", {"temp": 19}, ["https://images.unsplash.com/a"])
+    assert session.cached_enrichment("  lima ", 900)["weather"] == {"temp": 19}
+    assert session.cached_enrichment("Cusco", 900) is None  # Otro destino: se consulta de nuevo
+    # Sobrevive la serialización del backend SQLite
+    restored = ChatSession.from_dict(session.to_dict())
+    assert restored.cached_enrichment("Lima", 900)["images"] == ["https://images.unsplash.com/a"]
+    with mock.patch("services.chat_sessions.time.time", return_value=time.time() + 901):
+        assert session.cached_enrichment("Lima", 900) is None
+    print("✅ Reutilizado por destino, persistido con la sesión y con expiración")
+
+
+def test_plan_generation_by_sections():
+    """Cada grupo de secciones es una llamada aparte; el plan se rearma en el orden canónico."""
+    print_test_header("Test 25: Generación del plan por secciones en paralelo")
+    from unittest import mock
+    from google.api_core import exceptions as google_exceptions
+    import google.generativeai as genai
+    from services import gemini_service as gs
+    from benchmarks.fakes import FAKE_PLAN, FAKE_PLAN_SECTIONS
+
+    groups = gs.parse_plan_section_groups("lugares, consejos+costos, alojamiento+gastronomia")
+    assert groups == [["alojamiento", "gastronomia"], ["lugares"], ["consejos", "costos"]]
+    for invalid in ("alojamiento,lugares", "alojamiento,alojamiento,gastronomia,lugares,consejos,costos", "playa"):
+        try:
+            gs.parse_plan_section_groups(invalid)
+            assert False, f"'{invalid}' debería ser inválida"
+        except ValueError:
+            pass
+
+    # Separar y rearmar conserva los encabezados exactos que espera el frontend
+    intro, sections = gs.split_plan_sections(FAKE_PLAN)
+    assert intro == FAKE_PLAN_SECTIONS[0].strip() and list(sections) == list(gs.PLAN_SECTIONS)
+    assembled = gs.assemble_plan(intro, sections)
+    assert gs.split_plan_sections(assembled) == (intro, sections)
+    assert [line for line in assembled.splitlines() if line.startswith("##")] == list(gs.PLAN_SECTIONS.values())
+    # Encabezados sin tilde o sin emoji también se reconocen; el orden se normaliza
+    _, loose = gs.split_plan_sections("## Costos\n- 10 USD\n## GASTRONOMIA\n- Ceviche")
+    assert gs.assemble_plan("", loose) == "## 🥘 GASTRONOMÍA\n\n- Ceviche\n\n## 💰 COSTOS\n\n- 10 USD"
+
+    scope = gs.build_section_prompt("Lima", "junio", "moderado", "cultural", ["lugares"], include_intro=False)
+    assert "--- ALCANCE DE ESTA RESPUESTA ---" in scope and "'## 💎 LUGARES'" in scope
+    assert "introductorio" not in scope.split("--- ALCANCE")[1]
+
+    class SectionModel:
+        """Responde solo las secciones que pide el alcance del prompt."""
+        def __init__(self, model_name=None, generation_config=None, system_instruction=None):
+            self.calls = []
+            self.gate_active = []
+            self.fail_on = None
+
+        def generate_content(self, prompt, stream=False, generation_config=None, **kwargs):
+            self.calls.append(generation_config["max_output_tokens"])
+            self.gate_active.append(service.gate.active)
+            requested = prompt.split("--- ALCANCE DE ESTA RESPUESTA ---")[1]
+            if self.fail_on and self.fail_on in requested:
+                raise google_exceptions.ResourceExhausted("cuota agotada")
+            time.sleep(0.3 if self.fail_on else 0.05)
+            parts = [FAKE_PLAN_SECTIONS[0]] if "introductorio" in requested else []
+            parts += [section for section in FAKE_PLAN_SECTIONS[1:] if section.split("\n")[0] in requested]
+            response = mock.Mock(text="".join(parts), candidates=[])
+            response.usage_metadata = mock.Mock(prompt_token_count=120, cached_content_token_count=0, candidates_token_count=40)
+            return response
+
+    with mock.patch.dict(os.environ, {"GEMINI_PLAN_MODE": "sections", "GEMINI_PLAN_SECTION_GROUPS": "alojamiento+gastronomia,lugares,consejos,costos"}), \
+            mock.patch.object(genai, "GenerativeModel", SectionModel), \
+            mock.patch.object(gs, "supports_system_instruction", return_value=False):
+        service = gs.GeminiService()
+    assert service.plan_mode == "sections" and len(service.plan_section_groups) == 4
+
+    async def scenario():
+        start = time.perf_counter()
+        first = await service.generate_travel_recommendation_async("Lima", "junio", "moderado", "cultural")
+        elapsed = time.perf_counter() - start
+        second = await service.generate_travel_recommendation_async("Lima", "junio", "moderado", "cultural")
+        return first, second, elapsed
+
+    (plan, finish_reason), cached, elapsed = asyncio.run(scenario())
+    assert plan == assembled and finish_reason == "STOP"
+    # 4 llamadas de 50 ms en paralelo; la segunda solicitud sale de la caché
+    assert len(service.model.calls) == 4 and elapsed < 0.18
+    assert set(service.model.calls) == {gs.PLAN_SECTION_MAX_OUTPUT_TOKENS}
+    assert cached == (plan, finish_reason)
+    # El plan ocupa un solo turno del gate aunque lance 4 llamadas
+    assert set(service.model.gate_active) == {1} and service.gate.active == 0
+
+    # Si un grupo falla no se espera al resto, y el límite adaptativo cuenta un solo 429
+    service.model.fail_on = "'## 💎 LUGARES'"
+    throttled = service.limiter.throttled
+
+    async def failing_scenario():
+        start = time.perf_counter()
+        try:
+            await service.generate_travel_recommendation_async("Cusco", "junio", "moderado", "cultural")
+            assert False, "El plan debería fallar"
+        except Exception as e:
+            assert classify_gemini_error(e) == "throttled"
+        failed_after = time.perf_counter() - start
+        # Los grupos que ya llamaban a Gemini conservan el turno hasta terminar
+        held = service.gate.active
+        while service.gate.active and time.perf_counter() - start < 1:
+            await asyncio.sleep(0.01)
+        return failed_after, held
+
+    failed_after, held = asyncio.run(failing_scenario())
+    assert failed_after < 0.2 and held == 1 and service.gate.active == 0
+    assert service.limiter.throttled == throttled + 1
+    print(f"✅ Plan de {len(plan)} caracteres en 4 llamadas paralelas y 1 turno ({elapsed * 1000:.0f} ms); fallo en {failed_after * 1000:.0f} ms")
+
+
+def test_plan_section_edits():
+    """Un pedido de cambio en el chat regenera solo su sección y conserva el resto del plan."""
+    print_test_header("Test 26: Ediciones del plan desde el chat por sección")
+    from unittest import mock
+    import google.generativeai as genai
+    from services import gemini_service as gs
+    from services.chat_sessions import ChatSession
+    from benchmarks.fakes import FAKE_PLAN
+
+    assert gs.detect_plan_edit("Cambia los hoteles por algo más barato") == ["alojamiento"]
+    assert gs.detect_plan_edit("Prefiero restaurantes MÁS ECONÓMICOS") == ["gastronomia"]
+    assert gs.detect_plan_edit("quita el museo y ajusta los costos") == ["lugares", "costos"]
+    assert gs.detect_plan_edit("¿Puedes cambiarme los restaurantes?") == ["gastronomia"]
+    assert gs.detect_plan_edit("¿me cambias los hoteles?") == ["alojamiento"]
+    assert gs.detect_plan_edit("Quisiera que quites el museo") == ["lugares"]
+    assert gs.detect_plan_edit("Reemplace los restaurantes por opciones veganas") == ["gastronomia"]
+    # Preguntas y menciones de "cambio" que no son un pedido de cambio
+    assert gs.detect_plan_edit("¿Qué hoteles tienen piscina?") == []
+    assert gs.detect_plan_edit("¿Hay restaurantes más económicos?") == []
+    assert gs.detect_plan_edit("¿Cuál es el tipo de cambio para los costos?") == []
+    assert gs.detect_plan_edit("si cambio de fecha, ¿qué restaurantes me recomiendas?") == []
+    assert gs.detect_plan_edit("Cambié de opinión sobre los hoteles") == []
+    assert gs.detect_plan_edit("¿El precio cambia en temporada alta?") == []
+    assert gs.detect_plan_edit("¿Qué ajustes recomiendas para los costos?") == []
+    assert gs.detect_plan_edit("Cámbialo todo: hoteles, comida, lugares, consejos y costos") == []
+    assert gs.detect_plan_edit("Cambia el plan") == []
+
+    class EditModel:
+        def __init__(self, model_name=None, generation_config=None, system_instruction=None):
+            self.prompts = []
+
+        def generate_content(self, prompt, stream=False, generation_config=None, **kwargs):
+            self.prompts.append(prompt)
+            response = mock.Mock(text="## 🏨 ALOJAMIENTO\n- **Hostal Azul** - 20 USD la noche.", candidates=[])
+            response.usage_metadata = mock.Mock(prompt_token_count=300, cached_content_token_count=0, candidates_token_count=30)
+            return response
+
+    with mock.patch.object(genai, "GenerativeModel", EditModel), \
+            mock.patch.object(gs, "supports_system_instruction", return_value=False):
+        service = gs.GeminiService()
+
+    plan, changed, finish_reason = asyncio.run(service.edit_plan_async(
+        "Lima", "junio", "moderado", "cultural", FAKE_PLAN, ["alojamiento"], "Cambia los hoteles por algo más barato"
+    ))
+    assert changed == ["alojamiento"] and finish_reason == "STOP"
+    prompt = service.model.prompts[0]
+    assert "Hotel Centro" in prompt and "más barato" in prompt and "Casco histórico" not in prompt
+    intro, sections = gs.split_plan_sections(plan)
+    original_intro, original = gs.split_plan_sections(FAKE_PLAN)
+    assert sections["alojamiento"] == "- **Hostal Azul** - 20 USD la noche."
+    assert intro == original_intro and all(sections[key] == original[key] for key in original if key != "alojamiento")
+    try:
+        asyncio.run(service.edit_plan_async("Lima", "", "", "", "Sin secciones", ["costos"], "ajusta los costos"))
+        assert False, "Un plan sin la sección pedida debería fallar"
+    except ValueError:
+        pass
+
+    # El plan editado se guarda con la sesión y es la base de la próxima edición
+    session = ChatSession("s1", "uid-a", destination="Lima", plan=plan)
+    assert ChatSession.from_dict(session.to_dict()).plan == plan
+    print(f"✅ Edición de 1 sección: prompt de {len(prompt)} caracteres, plan de {len(plan)} caracteres rearmado")
+
+
+def test_plan_job_queue():
+    """Los trabajos se deduplican, se limitan por usuario, sobreviven reinicios y expiran."""
+    print_test_header("Test 27: Cola persistente de planes en segundo plano")
+    from unittest import mock
+    from services.plan_jobs import JobLimitError, PlanJobQueue
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "plan_jobs.sqlite3")
+        queue = PlanJobQueue(path, workers=2, max_per_uid=2, max_queued=3, result_ttl_seconds=60, lease_seconds=30, poll_interval=0.05)
+
+        job, deduplicated = queue.submit("uid-a", {"destination": "Lima"}, "lima")
+        again, deduplicated_again = queue.submit("uid-a", {"destination": "Lima"}, "lima")
+        assert not deduplicated and deduplicated_again and again["job_id"] == job["job_id"]
+        cusco, _ = queue.submit("uid-a", {"destination": "Cusco"}, "cusco")
+        try:
+            queue.submit("uid-a", {"destination": "Quito"}, "quito")
+            assert False, "El tercer trabajo pendiente del usuario debería rechazarse"
+        except JobLimitError:
+            pass
+        queue.submit("uid-b", {"destination": "Lima"}, "lima")  # Otro usuario: trabajo propio
+        try:
+            queue.submit("uid-c", {"destination": "Bogotá"}, "bogota")
+            assert False, "La cola llena debería responder saturación"
+        except OverloadedError:
+            pass
+        assert queue.get(job["job_id"], "uid-b") is None
+        assert queue.get(job["job_id"], "uid-a")["queue_position"] == 0
+
+        # Un proceso que muere con un trabajo tomado: otro lo retoma al vencer el lease
+        claimed_id, request = queue.claim()
+        assert claimed_id == job["job_id"] and request == {"destination": "Lima"}
+        queue.close()
+        queue = PlanJobQueue(path, workers=2, max_per_uid=2, max_queued=3, result_ttl_seconds=60, lease_seconds=30, poll_interval=0.05)
+        assert queue.get(job["job_id"], "uid-a")["status"] == "running"
+        with mock.patch("services.plan_jobs.time.time", return_value=time.time() + 31):
+            assert queue.claim()[0] == job["job_id"]
+        queue.requeue(job["job_id"])
+
+        calls = []
+
+        async def runner(request):
+            calls.append(request["destination"])
+            await asyncio.sleep(0.02)
+            if request["destination"] == "Cusco":
+                raise RuntimeError("Gemini falló")
+            if calls.count("Lima") == 1:
+                raise OverloadedError("saturado", retry_after=0)
+            return {"gemini_response": f"Plan para {request['destination']}", "finish_reason": "STOP"}
+
+        async def scenario():
+            queue.start(runner)
+            deadline = time.monotonic() + 5
+            while queue.completed + queue.failed < 3 and time.monotonic() < deadline:
+                await queue.wait_for_change(0.1)
+            await queue.stop()
+
+        asyncio.run(scenario())
+        done = queue.get(job["job_id"], "uid-a")
+        assert done["status"] == "done" and done["result"]["gemini_response"] == "Plan para Lima"
+        assert queue.stats()["requeued"] == 1 and queue.stats()["failed"] == 1 and queue.stats()["completed"] == 2
+        failed = queue.get(cusco["job_id"], "uid-a")
+        assert failed["status"] == "failed" and failed["error"] == "Ocurrió un error consultando a la IA"
+
+        # Los resultados se conservan result_ttl_seconds
+        with mock.patch("services.plan_jobs.time.time", return_value=time.time() + 61):
+            assert queue.get(job["job_id"], "uid-a") is None
+            assert queue.purge_expired() == 3
+
+        # Apagar con un trabajo en curso lo devuelve a la cola sin gastar un intento
+        started = []
+
+        async def slow_runner(request):
+            started.append(request["destination"])
+            await asyncio.sleep(10)
+
+        async def shutdown_mid_job():
+            queue.start(slow_runner)
+            deadline = time.monotonic() + 5
+            while not started and time.monotonic() < deadline:
+                await queue.wait_for_change(0.05)
+            await queue.stop()
+
+        quito, _ = queue.submit("uid-d", {"destination": "Quito"}, "quito")
+        asyncio.run(shutdown_mid_job())
+        pending = queue.get(quito["job_id"], "uid-d")
+        assert started == ["Quito"] and pending["status"] == "queued" and pending["attempts"] == 0
+        assert queue.claim()[0] == quito["job_id"]
+        queue.close()
+    print(f"✅ Deduplicado, limitado por usuario, retomado tras reinicio, reencolado al apagar y expirado ({len(calls)} ejecuciones)")
+
+
+def test_idempotency_store():
+    """Un reintento con la misma clave repite la respuesta o espera a la original en curso."""
+    print_test_header("Test 28: Idempotency-Key en /api/plan y /api/chat")
+    from services.idempotency import IdempotencyConflictError, IdempotencyStore, SQLiteIdempotencyStore
+
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"gemini_response": f"Plan {len(calls)}"}
+
+    async def failing():
+        calls.append(1)
+        raise RuntimeError("Gemini falló")
+
+    async def scenario(store):
+        # Tres envíos simultáneos con la misma clave: una sola generación
+        concurrent = await asyncio.gather(*(store.run("uid-a", "plan", "k1", "body-1", handler) for _ in range(3)))
+        replay = await store.run("uid-a", "plan", "k1", "body-1", handler)
+        # Misma clave con otro cuerpo: conflicto, también mientras la original está en curso
+        try:
+            await store.run("uid-a", "plan", "k1", "body-2", handler)
+            assert False, "La clave reutilizada con otro cuerpo debería rechazarse"
+        except IdempotencyConflictError:
+            pass
+        # Otro usuario u otro endpoint con la misma clave: solicitudes distintas
+        other_uid = await store.run("uid-b", "plan", "k1", "body-1", handler)
+        other_scope = await store.run("uid-a", "chat", "k1", "body-1", handler)
+        # Los errores no se guardan: el reintento se procesa de nuevo
+        for _ in range(2):
+            try:
+                await store.run("uid-a", "plan", "k2", "body-1", failing)
+            except RuntimeError:
+                pass
+        return concurrent, replay, other_uid, other_scope
+
+    store = IdempotencyStore(ttl_seconds=60, max_entries=10, max_bytes=None)
+    concurrent, replay, other_uid, other_scope = asyncio.run(scenario(store))
+    assert [replayed for _, replayed in concurrent] == [False, True, True]
+    assert all(response == {"gemini_response": "Plan 1"} for response, _ in concurrent)
+    assert replay == ({"gemini_response": "Plan 1"}, True)
+    assert not other_uid[1] and not other_scope[1]
+    assert len(calls) == 5  # k1 una vez, uid-b, chat y los dos intentos fallidos
+    stats = store.stats()
+    assert stats["stored"] == 3 and stats["replayed"] == 1 and stats["attached"] == 2 and stats["conflicts"] == 1
+
+    # Con SQLite la respuesta se repite en otro worker
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "idempotency.sqlite3")
+        worker_a = SQLiteIdempotencyStore(path, ttl_seconds=60)
+        worker_b = SQLiteIdempotencyStore(path, ttl_seconds=60)
+        calls.clear()
+        first = asyncio.run(worker_a.run("uid-a", "plan", "k1", "body-1", handler))
+        second = asyncio.run(worker_b.run("uid-a", "plan", "k1", "body-1", handler))
+        assert first == ({"gemini_response": "Plan 1"}, False) and second == ({"gemini_response": "Plan 1"}, True)
+        assert len(calls) == 1
+        worker_a.disk.close()
+        worker_b.disk.close()
+
+    # En el endpoint los reintentos se responden antes del rate limiting: no consumen la cuota
+    from unittest import mock
+    import main
+
+    plan = {"gemini_response": "Plan", "finish_reason": "STOP", "weather": None, "images": [], "info": None}
+    body = {"destination": "Cusco", "date": "junio", "budget": "moderado", "style": "cultural", "user_currency": "USD"}
+
+    async def post_plans():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            retries = [await client.post("/api/plan", json=body, headers={"Idempotency-Key": "retry-1"}) for _ in range(8)]
+            fresh = [await client.post("/api/plan", json=body) for _ in range(5)]
+        return retries, fresh
+
+    main.app.dependency_overrides[main.verify_token] = lambda: "uid-idempotency"
+    main.limiter.reset()
+    generate = mock.AsyncMock(return_value=plan)
+    try:
+        with mock.patch.object(main, "generate_travel_plan", generate), \
+                mock.patch.object(main, "get_idempotency_store", return_value=IdempotencyStore(ttl_seconds=60, max_entries=10, max_bytes=None)):
+            retries, fresh = asyncio.run(post_plans())
+    finally:
+        main.limiter.reset()
+        main.app.dependency_overrides.pop(main.verify_token, None)
+    assert all(response.status_code == 200 and response.json() == plan for response in retries)
+    assert [response.headers.get("Idempotent-Replayed") for response in retries] == [None] + ["true"] * 7
+    # 5/minute: la original y 4 solicitudes nuevas pasan; los 7 reintentos no contaron
+    assert [response.status_code for response in fresh] == [200] * 4 + [429]
+    assert generate.await_count == 5
+    print("✅ Reintentos repetidos o unidos a la solicitud en curso, aislados por usuario y endpoint y sin gastar cuota")
+
+
+def test_plan_stream_endpoint():
+    """El stream comparte caché, deduplicación y límite adaptativo con /api/plan."""
+    print_test_header("Test 29: Streaming de /api/plan")
+    import json
+    import threading
+    from unittest import mock
+    from google.api_core import exceptions as google_exceptions
+    import main
+
+    service = main.get_gemini_service()
+    calls = []
+
+    class Candidate:
+        finish_reason = "STOP"
+
+    class StreamedResponse:
+        def __init__(self, texts, delay, fail):
+            self.texts, self.delay, self.fail = texts, delay, fail
+            self.candidates = [Candidate()]
+            self.yielded = 0
+
+        def __iter__(self):
+            for text in self.texts:
+                time.sleep(self.delay)
+                if self.fail:
+                    raise google_exceptions.ResourceExhausted("cuota agotada")
+                self.yielded += 1
+                yield mock.Mock(text=text)
+
+    class StreamingModel:
+        def __init__(self, texts, delay=0.01, fail=False):
+            self.texts, self.delay, self.fail = texts, delay, fail
+
+        def generate_content(self, prompt, stream=False, **kwargs):
+            response = StreamedResponse(self.texts, self.delay, self.fail)
+            calls.append(response)
+            return response
+
+    def body(destination):
+        return {"destination": destination, "date": "junio", "budget": "moderado", "style": "cultural", "user_currency": "USD"}
+
+    def parse_events(raw):
+        events = []
+        for block in raw.strip().split("\n\n"):
+            lines = dict(line.split(": ", 1) for line in block.splitlines())
+            events.append((lines["event"], json.loads(lines["data"])))
+        return events
+
+    async def post_streams(*destinations):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            responses = await asyncio.gather(*[
+                client.post("/api/plan/stream", json=body(destination)) for destination in destinations
+            ])
+        return [parse_events(response.text) for response in responses]
+
+    def use_model(model):
+        return mock.patch.object(service, "_model_for", return_value=(model, True))
+
+    main.app.dependency_overrides[main.verify_token] = lambda: "uid-stream"
+    limiter_enabled, main.limiter.enabled = main.limiter.enabled, False
+    try:
+        with mock.patch.object(main.get_weather_service(), "get_weather", mock.AsyncMock(return_value={"temp": 19, "condition": "Nublado"})), \
+                mock.patch.object(main.get_unsplash_service(), "get_destination_images", mock.AsyncMock(return_value=["https://images.unsplash.com/a"])), \
+                mock.patch.object(main, "increment_plan_counter"):
+            # Orden de eventos: clima e imágenes apenas llegan, el texto por fragmentos y done al final
+            def cache_lookups():
+                return service.plan_cache.hits + service.plan_cache.misses
+
+            lookups = cache_lookups()
+            admitted = service.gate.admitted
+            with use_model(StreamingModel(["## 🏨 ALOJAMIENTO\n", "Hotel ", "boutique"], delay=0.05)), \
+                    mock.patch.object(service.limiter, "on_success", wraps=service.limiter.on_success) as on_success:
+                events, duplicate = asyncio.run(post_streams("Arequipa", "arequipa"))
+            names = [name for name, _ in events]
+            assert set(names[:2]) == {"weather", "images"} and names[2:] == ["chunk"] * 3 + ["done"]
+            # done lleva la misma respuesta que /api/plan
+            assert events[-1][1] == main.build_travel_response(
+                "## 🏨 ALOJAMIENTO\nHotel boutique", "STOP", {"temp": 19, "condition": "Nublado"}, ["https://images.unsplash.com/a"]
+            )
+            # A lo sumo una consulta a la caché por solicitud y el turno del stream cuenta en la
+            # espera y el tiempo de servicio del gate
+            assert cache_lookups() - lookups <= 2
+            lookups = cache_lookups()
+            assert service.gate.admitted == admitted + 1 and service.gate.stats()["avg_service_ms"] >= 100
+            assert "".join(data["text"] for name, data in events if name == "chunk") == "## 🏨 ALOJAMIENTO\nHotel boutique"
+            # La solicitud idéntica simultánea esperó el stream: una sola llamada y un turno
+            assert len(calls) == 1 and on_success.call_count == 1
+            assert [data for name, data in duplicate if name == "chunk"] == [{"text": "## 🏨 ALOJAMIENTO\nHotel boutique"}]
+            assert service.gate.active == 0
+
+            # Ya en caché: sin Gemini ni turno del gate
+            with mock.patch.object(service.gate, "acquire") as acquire:
+                cached, = asyncio.run(post_streams("Arequipa"))
+            assert acquire.call_count == 0 and len(calls) == 1 and cached[-1] == events[-1]
+            assert cache_lookups() == lookups + 1
+
+            # En modo por secciones el plan llega en un único chunk; la saturación es un evento error
+            sections = mock.AsyncMock(return_value=("## 🍽️ GASTRONOMÍA\nCeviche", "STOP"))
+            with mock.patch.object(service, "plan_mode", "sections"), \
+                    mock.patch.object(service, "generate_plan_by_sections_async", sections):
+                by_sections, = asyncio.run(post_streams("Piura"))
+                assert [data for name, data in by_sections if name == "chunk"] == [{"text": "## 🍽️ GASTRONOMÍA\nCeviche"}]
+                assert by_sections[-1][1]["gemini_response"] == "## 🍽️ GASTRONOMÍA\nCeviche"
+                sections.side_effect = OverloadedError("gemini: cola llena", retry_after=7)
+                overloaded, = asyncio.run(post_streams("Tacna"))
+            assert overloaded[-1] == ("error", {
+                "detail": "El servicio está saturado en este momento. Intenta de nuevo en unos segundos.", "retry_after": 7
+            })
+            assert sections.await_count == 2 and cache_lookups() == lookups + 3
+
+            # Un 429 termina el stream con un evento error (sin done) y baja el límite adaptativo
+            throttled = service.limiter.throttled
+            with use_model(StreamingModel(["nunca"], fail=True)):
+                failed, = asyncio.run(post_streams("Trujillo"))
+            assert failed[-1] == ("error", {"detail": "Ocurrió un error consultando a la IA"})
+            assert "done" not in [name for name, _ in failed]
+            assert service.limiter.throttled == throttled + 1 and service.gate.active == 0
+
+            # Cliente desconectado a mitad del stream: Gemini deja de consumirse y el turno se libera
+            slow_model = StreamingModel([f"parte {i} " for i in range(40)], delay=0.02)
+
+            async def disconnect_mid_stream():
+                first_chunk = asyncio.Event()
+                sent = []
+                request_body = json.dumps(body("Iquitos")).encode()
+                messages = [{"type": "http.request", "body": request_body, "more_body": False}]
+
+                async def receive():
+                    if messages:
+                        return messages.pop(0)
+                    await first_chunk.wait()
+                    return {"type": "http.disconnect"}
+
+                async def send(message):
+                    sent.append(message)
+                    if message["type"] == "http.response.body" and b"event: chunk" in message.get("body", b""):
+                        first_chunk.set()
+
+                scope = {
+                    "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+                    "scheme": "http", "path": "/api/plan/stream", "raw_path": b"/api/plan/stream", "query_string": b"",
+                    "headers": [(b"host", b"test"), (b"content-type", b"application/json")],
+                    "client": ("127.0.0.1", 1234), "server": ("test", 80), "root_path": ""
+                }
+                await main.app(scope, receive, send)
+                deadline = time.monotonic() + 3
+                while service.gate.active and time.monotonic() < deadline:
+                    await asyncio.sleep(0.02)
+                return sent
+
+            with use_model(slow_model):
+                sent = asyncio.run(disconnect_mid_stream())
+            assert sent[0]["status"] == 200 and service.gate.active == 0
+            assert 0 < calls[-1].yielded < 40
+            assert not main.plan_singleflight.in_flight(main.plan_cache_key(**body("Iquitos")))
+    finally:
+        main.limiter.enabled = limiter_enabled
+        main.app.dependency_overrides.pop(main.verify_token, None)
+    print(f"✅ Orden de eventos, deduplicación, caché, error 429 y desconexión ({calls[-1].yielded}/40 fragmentos consumidos)")
+
+
+def test_token_verifier():
+    """Los tokens se cachean hasta su expiración, los fallos no se cachean y se coalescen."""
+    print_test_header("Test 30: Verificación de tokens de Firebase")
+    from unittest import mock
+    import firebase_admin
+    import google.auth.credentials
+    from firebase_admin import credentials
+    from services import auth_service
+    from services.auth_service import ID_TOKEN_CERT_URI, TOKEN_EXPIRY_MARGIN_SECONDS, TokenVerifier, certificate_request
+
+    calls = []
+    expires = {"token-largo": time.time() + TOKEN_EXPIRY_MARGIN_SECONDS + 60, "token-corto": time.time() + 10}
+
+    def fake_verify(token):
+        calls.append(token)
+        time.sleep(0.05)
+        if token == "token-malo" and calls.count(token) == 1:
+            raise ValueError("token inválido")
+        return {"uid": f"uid-{token}", "exp": expires.get(token, time.time() + 3600)}
+
+    verifier = TokenVerifier()
+
+    async def verify_all(token, times):
+        return await asyncio.gather(*[verifier.verify(token) for _ in range(times)], return_exceptions=True)
+
+    with mock.patch.object(auth_service, "_verify_id_token", fake_verify):
+        # 5 solicitudes simultáneas con el mismo token: una sola verificación
+        results = asyncio.run(verify_all("token-largo", 5))
+        assert [result["uid"] for result in results] == ["uid-token-largo"] * 5 and calls == ["token-largo"]
+        assert verifier.cache_stats()["coalesced"] == 4
+        assert verifier.get_cached("token-largo")["uid"] == "uid-token-largo"
+        # La caché dura hasta exp - margen, no la hora completa
+        with mock.patch("services.cache.time.monotonic", return_value=time.monotonic() + 61):
+            assert verifier.get_cached("token-largo") is None
+        # Un token que vence dentro del margen no se cachea
+        asyncio.run(verify_all("token-corto", 1))
+        assert verifier.get_cached("token-corto") is None
+
+        # Un fallo llega a todos los que esperaban y no se cachea: el reintento verifica de nuevo
+        failures = asyncio.run(verify_all("token-malo", 3))
+        assert all(isinstance(result, ValueError) for result in failures)
+        assert verifier.get_cached("token-malo") is None
+        assert asyncio.run(verifier.verify("token-malo"))["uid"] == "uid-token-malo"
+        assert calls.count("token-malo") == 2
+
+    # Precarga de certificados: usa el transporte de la versión instalada de firebase_admin
+    class OfflineCredential(credentials.Base):
+        def get_credential(self):
+            return mock.Mock(spec=google.auth.credentials.Credentials)
+
+    app = firebase_admin.initialize_app(OfflineCredential(), {"projectId": "viajeia-test"}, name="test-token-verifier")
+    try:
+        assert certificate_request(app) is not None
+        fetched = []
+        with mock.patch.object(auth_service, "certificate_request", return_value=lambda url, method: fetched.append((url, method))):
+            async def refresh_once():
+                verifier.cert_refresh_seconds = 60
+                verifier.start_certificate_refresh(app)
+                await asyncio.sleep(0.1)
+                await verifier.stop_certificate_refresh()
+            asyncio.run(refresh_once())
+        assert fetched == [(ID_TOKEN_CERT_URI, "GET")]
+        # Si una actualización quita el transporte interno, no hay precarga pero tampoco error
+        with mock.patch.object(auth_service.auth, "_get_client", None):
+            assert certificate_request(app) is None
+            asyncio.run(verifier._refresh_certificates_loop(app))
+    finally:
+        firebase_admin.delete_app(app)
+    print(f"✅ {len(calls)} verificaciones reales para 10 solicitudes; precarga protegida ante cambios de firebase_admin")
+
+
+def test_shared_http_clients_lifespan():
+    """El lifespan crea un cliente HTTP por servicio, se reutiliza en cada llamada y se cierra al apagar."""
+    print_test_header("Test 31: Clientes HTTP compartidos en el lifespan")
+    from unittest import mock
+    import main
+    from services.http_client import create_async_client
+    from services.chat_sessions import SQLiteChatSessionStore
+    from services.idempotency import SQLiteIdempotencyStore
+
+    requests_seen = []
+    cache_dir = tempfile.mkdtemp()
+    disk_cache = SQLiteCache(os.path.join(cache_dir, "images.sqlite3"), table="unsplash_images")
+    idempotency_store = SQLiteIdempotencyStore(os.path.join(cache_dir, "idempotency.sqlite3"), ttl_seconds=60)
+    session_store = SQLiteChatSessionStore(os.path.join(cache_dir, "chat_sessions.sqlite3"), ttl_seconds=60, max_messages=10)
+
+    def handler(request):
+        requests_seen.append(request.url.host)
+        if request.url.host == "api.weatherapi.com":
+            return httpx.Response(200, json={"current": {"temp_c": 19, "condition": {"text": "Nublado"}}, "location": {"localtime": "2025-06-15 14:30"}})
+        return httpx.Response(200, json={"results": [{"urls": {"regular": f"https://images.unsplash.com/{i}"}} for i in range(2)]})
+
+    created = []
+
+    def fake_client(timeout=10.0):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler), timeout=timeout)
+        created.append(client)
+        return client
+
+    weather_service, unsplash_service = main.get_weather_service(), main.get_unsplash_service()
+
+    async def scenario():
+        async with main.app.router.lifespan_context(main.app):
+            weather_client, unsplash_client = weather_service.client, unsplash_service.client
+            assert weather_client is not None and unsplash_client is not None and len(created) == 2
+            for destination in ("Lima", "Cusco", "Quito"):
+                assert (await weather_service.get_weather(destination))["temp"] == 19
+                await unsplash_service.get_destination_images(destination, count=2)
+            # Las llamadas reutilizan el cliente del lifespan: no se crea ninguno nuevo
+            assert weather_service.client is weather_client and unsplash_service.client is unsplash_client
+            assert len(created) == 2
+            await idempotency_store.run("u1", "plan", "k1", "f1", lambda: asyncio.sleep(0, {"ok": True}))
+            await session_store.append_async(session_store.new_session("u1", "Lima", "", "", ""), [{"role": "user", "content": "Hola"}])
+        return weather_client, unsplash_client
+
+    with mock.patch("services.weather_service.create_async_client", fake_client), \
+            mock.patch("services.unsplash_service.create_async_client", fake_client), \
+            mock.patch.object(weather_service, "api_key", "test"), \
+            mock.patch.object(unsplash_service, "api_key", "test"), \
+            mock.patch.object(weather_service.cache, "get", return_value=None), \
+            mock.patch.object(unsplash_service.memory_cache, "get", return_value=None), \
+            mock.patch.object(unsplash_service, "disk_cache", disk_cache), \
+            mock.patch.object(main, "get_idempotency_store", return_value=idempotency_store), \
+            mock.patch.object(main, "get_chat_session_store", return_value=session_store):
+        weather_client, unsplash_client = asyncio.run(scenario())
+    assert weather_client.is_closed and unsplash_client.is_closed
+    assert weather_service.client is None and unsplash_service.client is None
+    # Las cachés en disco se cierran al apagar con el WAL ya volcado al archivo principal
+    for cache in (disk_cache, idempotency_store.disk, session_store.disk):
+        assert cache._conn is None and not os.path.exists(cache.path + "-wal"), cache.path
+    assert requests_seen.count("api.weatherapi.com") == 3 and requests_seen.count("api.unsplash.com") == 3
+
+    # Límites del pool configurables por entorno
+    with mock.patch.dict(os.environ, {"HTTP_MAX_CONNECTIONS": "7", "HTTP_MAX_KEEPALIVE_CONNECTIONS": "3"}):
+        client = create_async_client()
+    pool = client._transport._pool
+    assert pool._max_connections == 7 and pool._max_keepalive_connections == 3
+    asyncio.run(client.aclose())
+    print(f"✅ 2 clientes para {len(requests_seen)} llamadas, cerrados al apagar junto con 3 cachés en disco")
+
+
+def test_weather_stale_while_revalidate():
+    """El clima viejo se sirve mientras un único refresco corre en segundo plano; los fallos no se cachean."""
+    print_test_header("Test 32: Clima con stale-while-revalidate")
+    from unittest import mock
+    from services.weather_service import WeatherService
+
+    upstream = {"temp": 20.0, "fail": set()}
+    requests_seen = []
+
+    async def handler(request):
+        destination = request.url.params["q"]
+        requests_seen.append(destination)
+        await asyncio.sleep(0.05)
+        if destination in upstream["fail"]:
+            return httpx.Response(500, json={"error": {"message": "caído"}})
+        return httpx.Response(200, json={
+            "current": {"temp_c": upstream["temp"], "condition": {"text": "Soleado"}},
+            "location": {"localtime": "2025-06-15 14:30"}
+        })
+
+    with mock.patch.dict(os.environ, {"WEATHER_API_KEY": "test", "WEATHER_CACHE_TTL_SECONDS": "600", "WEATHER_CACHE_STALE_SECONDS": "3600"}):
+        service = WeatherService()
+    service.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    clock = {"offset": 0.0}
+    real_monotonic = time.monotonic
+
+    def shifted():
+        return real_monotonic() + clock["offset"]
+
+    async def scenario():
+        # Misses simultáneos: una sola llamada
+        first = await asyncio.gather(*[service.get_weather("Lima") for _ in range(3)])
+        assert [weather["temp"] for weather in first] == [20.0] * 3 and requests_seen == ["Lima"]
+
+        # Pasado el TTL fresco: se sirve el dato viejo al instante y se refresca una sola vez
+        upstream["temp"] = 24.0
+        clock["offset"] = 601
+        start = real_monotonic()
+        stale = await asyncio.gather(*[service.get_weather("Lima") for _ in range(4)])
+        assert real_monotonic() - start < 0.04
+        assert [weather["temp"] for weather in stale] == [20.0] * 4
+        assert stale[0]["local_time"] == "14:40"  # Hora local ajustada por la antigüedad
+        await asyncio.gather(*service._background_refreshes)
+        assert requests_seen == ["Lima", "Lima"] and service.stale_served == 4
+        assert (await service.get_weather("Lima"))["temp"] == 24.0
+
+        # Un refresco fallido conserva el dato viejo hasta WEATHER_CACHE_STALE_SECONDS
+        upstream["fail"].add("Lima")
+        clock["offset"] = 1300
+        assert (await service.get_weather("Lima"))["temp"] == 24.0
+        await asyncio.gather(*service._background_refreshes)
+        clock["offset"] = 1300 + 3601
+        assert await service.get_weather("Lima") is None
+
+        # Los fallos no se cachean: el siguiente pedido vuelve a consultar
+        upstream["fail"].add("Cusco")
+        assert await service.get_weather("Cusco") is None
+        assert await service.get_weather("Cusco") is None
+        upstream["fail"].discard("Cusco")
+        assert (await service.get_weather("Cusco"))["temp"] == 24.0
+        await service.shutdown()
+
+    with mock.patch("services.weather_service.time.monotonic", shifted), mock.patch("services.cache.time.monotonic", shifted):
+        asyncio.run(scenario())
+    assert requests_seen.count("Cusco") == 3
+    print(f"✅ {service.stale_served} respuestas viejas servidas, {len(requests_seen)} llamadas a WeatherAPI")
+
+
+def test_counting_executor():
+    """Los executors cuentan sus tareas en espera y en curso sin leer atributos internos."""
+    print_test_header("Test 33: Contadores de los executors")
+    import threading
+    from prometheus_client import CollectorRegistry, generate_latest
+
+    executor = CountingExecutor(max_workers=2, thread_name_prefix="test-counting")
+    release = threading.Event()
+    started = threading.Semaphore(0)
+
+    def blocked(value):
+        started.release()
+        release.wait(5)
+        return value
+
+    futures = [executor.submit(blocked, i) for i in range(5)]
+    for _ in range(2):
+        assert started.acquire(timeout=5)
+    stats = executor.stats()
+    assert stats["in_flight"] == 2 and stats["queued"] == 3, stats
+
+    # Una tarea cancelada antes de tomar hilo deja de contarse como en espera
+    assert futures[-1].cancel()
+    assert executor.stats()["queued"] == 2
+
+    collector = ServiceStatsCollector()
+    collector.register("executor", lambda: {"test": executor.stats()}, counters=("test_completed",))
+    registry = CollectorRegistry()
+    registry.register(collector)
+    text = generate_latest(registry).decode()
+    assert "viajeia_executor_test_queued 2.0" in text
+    assert "viajeia_executor_test_in_flight 2.0" in text
+
+    # loop.run_in_executor pasa por submit: también se cuenta
+    async def via_loop():
+        return await asyncio.get_running_loop().run_in_executor(executor, lambda: "ok")
+
+    release.set()
+    assert [future.result(timeout=5) for future in futures[:4]] == [0, 1, 2, 3]
+    assert asyncio.run(via_loop()) == "ok"
+    executor.shutdown(wait=True)
+    assert executor.stats() == {"queued": 0, "in_flight": 0, "completed": 5, "max_workers": 2}
+
+    # GeminiService y TokenVerifier exponen los contadores de sus executors dedicados
+    from services.auth_service import TokenVerifier
+    from services.gemini_service import get_gemini_service
+    assert set(get_gemini_service().executor_stats()) == {"queued", "in_flight", "completed", "max_workers"}
+    verifier = TokenVerifier()
+    assert verifier.executor_stats()["queued"] == 0
+    print(f"✅ Contadores: {executor.stats()}")
+
+
+def test_gemini_slot_held_until_thread_finishes():
+    """Cancelar la solicitud no libera el turno mientras el hilo sigue llamando a Gemini."""
+    print_test_header("Test 34: Turno ocupado hasta que termina el hilo")
+    import threading
+    from unittest import mock
+    from services import gemini_service as gs
+
+    with mock.patch.dict(os.environ, {"GEMINI_MAX_CONCURRENCY": "1", "GEMINI_ADAPTIVE_CONCURRENCY": "false"}):
+        service = gs.GeminiService()
+    release = threading.Event()
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def call(name):
+        with lock:
+            running.append(name)
+            peak.append(len(running))
+        try:
+            if name == "lenta":
+                release.wait(5)
+            return name
+        finally:
+            with lock:
+                running.remove(name)
+
+    async def scenario():
+        # El cliente se va (timeout) con el hilo aún llamando a Gemini: el turno sigue ocupado
+        try:
+            await asyncio.wait_for(service.run_bounded(call, "lenta"), timeout=0.05)
+            assert False, "Se esperaba TimeoutError"
+        except asyncio.TimeoutError:
+            pass
+        assert service.gate.active == 1 and running == ["lenta"]
+        follower = asyncio.create_task(service.run_bounded(call, "siguiente"))
+        await asyncio.sleep(0.05)
+        assert not follower.done() and service.gate.queued == 1
+
+        # Al terminar el hilo el turno pasa al siguiente
+        release.set()
+        assert await follower == "siguiente"
+        assert service.gate.active == 0
+        return service.gate.stats()
+
+    stats = asyncio.run(scenario())
+    assert max(peak) == 1
+    assert stats["admitted"] == 2 and stats["avg_service_ms"] >= 50
+    print(f"✅ Máximo {max(peak)} hilo llamando a Gemini con límite 1: {stats}")
+
+
+def main():
+    """Ejecuta todas las pruebas."""
+    tests = [
+        ("Desalojo LRU", test_ttl_cache_lru_eviction),
+        ("Límite de bytes y TTL", test_ttl_cache_max_bytes_and_expiration),
+        ("Contadores hits/misses", test_ttl_cache_hit_miss_counters),
+        ("Clave de caché de planes", test_plan_cache_key_normalization),
+        ("Single-flight", test_singleflight_coalesces_concurrent_calls),
+        ("Caché persistente", test_sqlite_cache_survives_reopen),
+        ("Detector compilado", test_compiled_sanitizer_matches_legacy),
+        ("Detector por lotes", test_batch_sanitizer_matches_single),
+        ("Estadísticas en lote", test_stats_store_batches_and_persists),
+        ("Log de eventos", test_stats_store_event_log_replay),
+        ("Estadísticas multi-worker", test_sqlite_stats_store_multiple_workers),
+        ("Concurrencia acotada", test_concurrency_gate_bounds_and_rejects),
+        ("Espera máxima en cola", test_concurrency_gate_wait_timeout),
+        ("Límite adaptativo AIMD", test_adaptive_limiter_aimd),
+        ("Clasificación de errores", test_classify_gemini_error),
+        ("Métricas Prometheus", test_metrics_collectors),
+        ("Trazas por solicitud", test_tracing_server_timing),
+        ("Dobles de la prueba de carga", test_load_test_stand_ins),
+        ("Micro-benchmarks", test_hotpath_benchmark_compare),
+        ("Instrucciones de sistema", test_system_instruction_models),
+        ("Presupuesto del historial", test_chat_history_token_budget),
+        ("Sesiones de chat", test_chat_session_store),
+        ("Resumen de conversaciones", test_conversation_summarizer),
+        ("Clima e imágenes por sesión", test_chat_session_enrichment_reuse),
+        ("Plan por secciones", test_plan_generation_by_sections),
+        ("Ediciones del plan por sección", test_plan_section_edits),
+        ("Cola de planes", test_plan_job_queue),
+        ("Idempotency-Key", test_idempotency_store),
+        ("Streaming de /api/plan", test_plan_stream_endpoint),
+        ("Verificación de tokens", test_token_verifier),
+        ("Clientes HTTP compartidos", test_shared_http_clients_lifespan),
+        ("Clima stale-while-revalidate", test_weather_stale_while_revalidate),
+        ("Contadores de executors", test_counting_executor),
+        ("Turno hasta fin del hilo", test_gemini_slot_held_until_thread_finishes),
+    ]
+
+    results = []
+    for name, test in tests:
+        try:
+            test()
+            results.append((name, True))
+        except AssertionError as e:
+            print(f"❌ Falló: {e}")
+            results.append((name, False))
+
+    print("\n" + "="*60)
+    print("📊 RESUMEN DE PRUEBAS")
+    print("="*60)
+    passed = sum(1 for _, result in results if result)
+    for test_name, result in results:
+        print(f"{'✅' if result else '❌'} {test_name}")
+    print(f"\n{'✅' if passed == len(results) else '⚠️ '} Resultado: {passed}/{len(results)} pruebas pasadas")
+    return passed == len(results)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)